@@ -0,0 +1,76 @@
+import asyncio
+import copy
+import logging
+from typing import Dict
+
+from ai.dish_analysis import (
+    _build_result,
+    _merge_ratings,
+    generate_text_async,
+    get_common_ingredients_batch_async,
+    get_ingredients_rating_async,
+    local_overall_rating,
+)
+from ai.ingredient_analysis import analyze_ingredient_async
+
+
+async def analyze_batch_async(foods: Dict[str, bool], user_profile: dict, include_hints: bool = False,
+                              on_complete=None) -> Dict[str, dict]:
+    """
+    Analyze many foods for one user with a fixed number of shared model calls.
+
+    The ingredient breakdowns of all dishes are requested in one call, and every
+    ingredient of every dish, plus the ingredient queries themselves, is rated in a
+    single ratings call. Overall ratings are computed locally from the weighted ingredient
+    ratings. Only hints, if requested, cost one call per food.
+
+    Args:
+        foods (Dict[str, bool]): Each food query mapped to whether it is an ingredient.
+        user_profile (dict): The user's intolerance profile.
+        include_hints (bool): Also generate hints per food.
+        on_complete: Optional coroutine called with (food, result) as each food finishes.
+
+    Returns:
+        Dict[str, dict]: Each food mapped to its analysis (overall rating, hints and rated
+        ingredients), or None if it could not be analyzed.
+    """
+    dishes = [food for food, is_ingredient in foods.items() if not is_ingredient]
+    breakdowns = await get_common_ingredients_batch_async(dishes) if dishes else {}
+
+    names = [food for food, is_ingredient in foods.items() if is_ingredient]
+    names += [name for ingredients in breakdowns.values() for name in ingredients]
+    names = list(dict.fromkeys(names))
+    ratings = await get_ingredients_rating_async(names, user_profile) if names else {}
+
+    async def dish(food: str):
+        ingredients = copy.deepcopy(breakdowns.get(food) or {})
+        if not ingredients:
+            return None
+        rated = _merge_ratings(ingredients, ratings)
+        text = await generate_text_async(rated, user_profile, food) if include_hints else []
+        return _build_result(rated, local_overall_rating(rated), text)
+
+    async def ingredient(food: str):
+        if include_hints:
+            return await analyze_ingredient_async(food, user_profile)
+        rating = ratings.get(food)
+        if rating is None:
+            return None
+        text = [{"keyword": "Tip", "text": rating["explanation"]}] if rating.get("explanation") else []
+        return {"overall_rating": rating.get("rating", 0), "text": text, "ingredients": []}
+
+    async def analyze(food: str, is_ingredient: bool):
+        try:
+            result = await (ingredient(food) if is_ingredient else dish(food))
+        except Exception as e:
+            logging.error(f"Batch analysis of {food} failed: {e}")
+            result = None
+        # A failing callback must not take the other foods of the batch down with it
+        try:
+            if on_complete is not None:
+                await on_complete(food, result)
+        except Exception as e:
+            logging.error(f"Batch completion callback of {food} failed: {e}")
+        return food, result
+
+    return dict(await asyncio.gather(*(analyze(food, is_ingredient) for food, is_ingredient in foods.items())))
@@ -0,0 +1,84 @@
+import logging
+import os
+import threading
+
+from ai.blob_store import get_blob_store
+from ai.cache import TTLCache
+
+# How long a pathname confirmed to be absent from the store is trusted, in seconds.
+NEGATIVE_TTL = float(os.environ.get("BLOB_INDEX_NEGATIVE_TTL", "60"))
+
+
+class BlobIndex:
+    """
+    Index of blob pathname -> URL for the Vercel Blob store.
+
+    Lookups are answered from the index in O(1). A pathname that is not indexed yet is
+    resolved with a single prefix query instead of listing the whole store, and the
+    answer (including "not found", for a short time) is remembered. Uploads made by
+    this process are recorded directly.
+    """
+
+    def __init__(self, name: str = "blob_index"):
+        self._urls = TTLCache(name, maxsize=int(os.environ.get("BLOB_INDEX_SIZE", "100000")))
+        self._absent = TTLCache(f"{name}_absent", maxsize=10000, ttl=NEGATIVE_TTL, persistent=False)
+        self._lock = threading.Lock()
+
+    def lookup(self, pathname: str):
+        """
+        Return the URL of the blob stored under pathname, or None if it does not exist.
+        """
+        url = self._urls.get(pathname)
+        if url is not None:
+            return url
+        if self._absent.get(pathname):
+            return None
+
+        try:
+            blobs = get_blob_store().list({"prefix": pathname, "limit": "10"}).get("blobs", [])
+        except Exception as e:
+            logging.error(f"Blob lookup for {pathname} failed: {e}")
+            return None
+
+        for blob in blobs:
+            self._urls.set(blob["pathname"], blob["url"])
+            if blob["pathname"] == pathname:
+                url = blob["url"]
+        if url is None:
+            self._absent.set(pathname, True)
+        return url
+
+    def add(self, pathname: str, url: str):
+        """
+        Record a blob that has just been uploaded.
+        """
+        self._urls.set(pathname, url)
+        self._absent.delete(pathname)
+
+    def discard(self, pathname: str):
+        """
+        Forget a pathname whose URL turned out to be stale.
+        """
+        self._urls.delete(pathname)
+
+    def refresh(self):
+        """
+        Index every blob in the store, one page at a time. Run by every pre-warm run, so
+        blobs uploaded by other instances or out of band are found without a lookup query.
+        """
+        with self._lock:
+            cursor = None
+            while True:
+                options = {"cursor": cursor} if cursor else {}
+                page = get_blob_store().list(options)
+                for blob in page.get("blobs", []):
+                    self.add(blob["pathname"], blob["url"])
+                cursor = page.get("cursor")
+                if not page.get("hasMore") or not cursor:
+                    break
+
+    def stats(self) -> dict:
+        return self._urls.stats()
+
+
+blob_index = BlobIndex()
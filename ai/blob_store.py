@@ -0,0 +1,56 @@
+import os
+
+from ai.startup import lazy_import
+
+requests = lazy_import("requests")
+vercel_blob = lazy_import("vercel_blob")
+
+# "vercel" uses Vercel Blob, "fake" keeps blobs in memory (see ai.fake).
+BLOB_BACKEND = os.getenv("BLOB_BACKEND", "vercel")
+
+
+class VercelBlobStore:
+    """
+    Blob store backed by Vercel Blob.
+
+    A blob store provides list(options) and put(pathname, data) with the semantics of
+    vercel_blob.list and vercel_blob.put, and get(url) returning the blob's bytes or None.
+    """
+
+    def list(self, options: dict = None) -> dict:
+        return vercel_blob.list(options or {})
+
+    def put(self, pathname: str, data: bytes) -> dict:
+        return vercel_blob.put(pathname, data, {"addRandomSuffix": False})
+
+    def get(self, url: str) -> bytes:
+        response = requests.get(url)
+        if response.status_code == 200:
+            return response.content
+        return None
+
+
+_store = None
+
+
+def get_blob_store():
+    """
+    Return the blob store selected by BLOB_BACKEND, creating it on first use.
+    """
+    global _store
+    if _store is None:
+        if BLOB_BACKEND == "fake":
+            from ai.fake import FakeBlobStore
+
+            _store = FakeBlobStore()
+        else:
+            _store = VercelBlobStore()
+    return _store
+
+
+def set_blob_store(store):
+    """
+    Replace the blob store used by the image cache.
+    """
+    global _store
+    _store = store
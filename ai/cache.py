@@ -0,0 +1,425 @@
+import asyncio
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from ai.startup import lazy_import
+
+requests = lazy_import("requests")
+
+LOCAL_CACHE_DIR = os.environ.get("LOCAL_CACHE_DIR", "local_cachedir")
+# Seconds between writes to the SQLite tier; changes made in between are written in one transaction.
+CACHE_FLUSH_INTERVAL = float(os.environ.get("CACHE_FLUSH_INTERVAL", "0.5"))
+
+# Optional shared tier on a Redis REST API (Vercel KV or Upstash), enabled when both are set.
+KV_REST_API_URL = os.environ.get("KV_REST_API_URL")
+KV_REST_API_TOKEN = os.environ.get("KV_REST_API_TOKEN")
+KV_TIMEOUT = float(os.environ.get("KV_TIMEOUT", "0.5"))
+
+# Every cache created, for metrics.
+_caches = weakref.WeakSet()
+
+
+class TTLCache:
+    """
+    Size-bounded LRU cache with a time-to-live per entry and hit/miss counters.
+
+    Entries are kept in memory and, if the cache is persistent, in a SQLite file in
+    LOCAL_CACHE_DIR so they survive restarts. Writes to SQLite (new entries, deletions and
+    the access times used for eviction) are collected and written by a background thread
+    every CACHE_FLUSH_INTERVAL seconds, so set() never waits for the disk. With a remote
+    tier (see remote_tier) entries are also shared between instances, and entries found
+    there are copied to the local tiers. Values must be JSON serialisable; every get
+    returns a fresh copy, so callers may mutate the result.
+
+    get() may read SQLite and the remote tier; async callers use get_async(), which does
+    that in a worker thread.
+    """
+
+    def __init__(self, name: str, maxsize: int = 1024, ttl: Optional[float] = None, persistent: bool = True,
+                 remote: Optional["RestKV"] = None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.remote = remote
+        self.hits = 0
+        self.misses = 0
+        self.tier_hits = {"memory": 0, "disk": 0, "remote": 0}
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._path = os.path.join(LOCAL_CACHE_DIR, f"{name}.sqlite")
+        # key -> entry to write, or None to delete; the batch being written is kept in
+        # _flushing until it is committed so lookups still see it
+        self._dirty: Dict[str, Optional[tuple]] = {}
+        self._flushing: Dict[str, Optional[tuple]] = {}
+        # key -> time of the last hit, for eviction
+        self._touched: Dict[str, float] = {}
+        self._cleared = False
+        self._write_lock = threading.Lock()
+        self._writer_db = None
+        self._disk_size = 0
+        _caches.add(self)
+        if persistent:
+            try:
+                os.makedirs(LOCAL_CACHE_DIR, exist_ok=True)
+                self._db = sqlite3.connect(self._path, check_same_thread=False, isolation_level=None)
+                # WAL lets lookups read while the writer thread commits
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS entries "
+                    "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL, accessed REAL NOT NULL)"
+                )
+                self._db.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+                self._disk_size = self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            except sqlite3.Error as e:
+                logging.warning(f"Cache {name} is memory only, could not open SQLite store: {e}")
+                self._db = None
+            else:
+                _disk_writer.start()
+
+    def _load(self, key: str):
+        # Called with the lock held
+        if self._db is None:
+            return None
+        row = self._db.execute("SELECT value, expires FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires = row
+        if expires is not None and expires < time.time():
+            self._dirty[key] = None
+            return None
+        return value, expires
+
+    def _remember(self, key: str, entry: tuple):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _memory(self, key: str):
+        # Called with the lock held
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] is not None and entry[1] < time.time():
+            del self._entries[key]
+            return None
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def _local(self, key: str) -> Tuple[Optional[tuple], str]:
+        with self._lock:
+            entry = self._memory(key)
+            if entry is not None:
+                return entry, "memory"
+            for pending in (self._dirty, self._flushing):
+                if key in pending:
+                    # Written or deleted, but not on disk yet
+                    entry = pending[key]
+                    if entry is not None and entry[1] is not None and entry[1] < time.time():
+                        entry = None
+                    break
+            else:
+                entry = self._load(key)
+            if entry is not None:
+                self._remember(key, entry)
+            return entry, "disk"
+
+    def _fetch_remote(self, key: str):
+        value = self.remote.get(f"{self.name}:{key}")
+        if value is None:
+            return None
+        try:
+            entry = tuple(json.loads(value))
+        except (TypeError, ValueError):
+            return None
+        if entry[1] is not None and entry[1] < time.time():
+            return None
+        return entry
+
+    def _lookup(self, key: str) -> Tuple[Optional[tuple], str]:
+        entry, tier = self._local(key)
+        if entry is None and self.remote is not None:
+            # Outside the lock, so a slow remote does not block local lookups
+            tier = "remote"
+            entry = self._fetch_remote(key)
+            if entry is not None:
+                with self._lock:
+                    self._remember(key, entry)
+                    if self._db is not None:
+                        self._dirty[key] = entry
+        return entry, tier
+
+    def _result(self, key: str, entry: Optional[tuple], tier: str, default: Any) -> Any:
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.tier_hits[tier] += 1
+            if self._db is not None:
+                self._touched[key] = time.time()
+        return json.loads(entry[0])
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """
+        Return the cached value for key, or default if it is missing or expired.
+        """
+        entry, tier = self._lookup(key)
+        return self._result(key, entry, tier, default)
+
+    async def get_async(self, key: str, default: Any = None) -> Any:
+        """
+        Async variant of get. Memory hits are answered directly, SQLite and remote lookups
+        run in a worker thread so they do not block the event loop.
+        """
+        with self._lock:
+            entry = self._memory(key)
+        if entry is not None:
+            return self._result(key, entry, "memory", default)
+        entry, tier = await asyncio.to_thread(self._lookup, key)
+        return self._result(key, entry, tier, default)
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        """
+        Store a value, evicting the least recently used entries beyond maxsize.
+
+        Only updates memory; the SQLite and remote tiers are written in the background.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        entry = (json.dumps(value), time.time() + ttl if ttl else None)
+        with self._lock:
+            self._remember(key, entry)
+            if self._db is not None:
+                self._dirty[key] = entry
+        if self.remote is not None:
+            self.remote.set(f"{self.name}:{key}", json.dumps(entry), ttl)
+
+    async def set_async(self, key: str, value: Any, ttl: Optional[float] = None):
+        """
+        Async variant of set, for symmetry with get_async. set itself never blocks on
+        SQLite or the remote tier, both are written in the background.
+        """
+        self.set(key, value, ttl)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._touched.pop(key, None)
+            if self._db is not None:
+                self._dirty[key] = None
+        if self.remote is not None:
+            self.remote.delete(f"{self.name}:{key}")
+
+    def clear(self):
+        """
+        Drop all local entries. The shared remote tier is left untouched.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._dirty.clear()
+            self._touched.clear()
+            self._cleared = True
+
+    def flush(self):
+        """
+        Write the pending changes to SQLite now. Runs in the background every
+        CACHE_FLUSH_INTERVAL seconds and at exit.
+        """
+        if self._db is None:
+            return
+        with self._write_lock:
+            with self._lock:
+                if not (self._dirty or self._touched or self._cleared):
+                    return
+                self._flushing, self._dirty = self._dirty, {}
+                touched, self._touched = self._touched, {}
+                cleared, self._cleared = self._cleared, False
+            try:
+                self._write(self._flushing, touched, cleared)
+            except sqlite3.Error as e:
+                logging.warning(f"Cache {self.name} could not write to SQLite: {e}")
+            finally:
+                with self._lock:
+                    self._flushing = {}
+
+    def _write(self, dirty: Dict[str, Optional[tuple]], touched: Dict[str, float], cleared: bool):
+        # Called with the write lock held, on a connection of its own
+        if self._writer_db is None:
+            self._writer_db = sqlite3.connect(self._path, check_same_thread=False, isolation_level=None)
+        db = self._writer_db
+        now = time.time()
+        written = [(key, entry[0], entry[1], touched.get(key, now)) for key, entry in dirty.items() if entry]
+        deleted = [(key,) for key, entry in dirty.items() if entry is None]
+        db.execute("BEGIN")
+        try:
+            if cleared:
+                db.execute("DELETE FROM entries")
+                self._disk_size = 0
+            db.executemany("INSERT OR REPLACE INTO entries (key, value, expires, accessed) VALUES (?, ?, ?, ?)", written)
+            db.executemany("DELETE FROM entries WHERE key = ?", deleted)
+            db.executemany(
+                "UPDATE entries SET accessed = ? WHERE key = ?",
+                [(accessed, key) for key, accessed in touched.items() if key not in dirty],
+            )
+            # Replacing an entry does not grow the table, so this over-estimates
+            self._disk_size += len(written)
+            if self._disk_size > self.maxsize:
+                self._disk_size = db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+                if self._disk_size > self.maxsize:
+                    # Evict a tenth more than needed, so this does not run on every write
+                    excess = self._disk_size - self.maxsize + self.maxsize // 10
+                    db.execute(
+                        "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY accessed LIMIT ?)",
+                        (excess,),
+                    )
+                    self._disk_size -= excess
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def items(self) -> list:
+        """
+        Return all unexpired (key, value) pairs of the local tiers, without counting lookups.
+        """
+        self.flush()
+        now = time.time()
+        with self._lock:
+            if self._db is not None:
+                rows = self._db.execute(
+                    "SELECT key, value FROM entries WHERE expires IS NULL OR expires >= ?", (now,)
+                ).fetchall()
+            else:
+                rows = [(k, v) for k, (v, expires) in self._entries.items() if expires is None or expires >= now]
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def stats(self) -> dict:
+        """
+        Return the hit/miss counters and current size of the cache.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "name": self.name,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "tier_hits": dict(self.tier_hits),
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+            }
+
+
+class _DiskWriter:
+    """
+    Background thread writing the pending changes of every persistent cache to SQLite.
+    """
+
+    def __init__(self, interval: float = CACHE_FLUSH_INTERVAL):
+        self.interval = interval
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="cache-writer", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            flush_caches()
+
+
+_disk_writer = _DiskWriter()
+
+
+def flush_caches():
+    """
+    Write the pending changes of every cache to SQLite.
+    """
+    for cache in list(_caches):
+        try:
+            cache.flush()
+        except Exception as e:
+            logging.error(f"Flushing cache {cache.name} failed: {e}")
+
+
+# Changes made in the last CACHE_FLUSH_INTERVAL would be lost otherwise
+atexit.register(flush_caches)
+
+
+class RestKV:
+    """
+    Shared cache tier on a Redis REST API such as Vercel KV or Upstash.
+
+    Reads are bounded by a short timeout and writes happen in the background, so a slow or
+    unavailable store only costs a cache miss.
+    """
+
+    def __init__(self, url: str, token: str, timeout: float = KV_TIMEOUT):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self._session = requests.Session()
+        self._session.headers["Authorization"] = f"Bearer {token}"
+        self._writer = ThreadPoolExecutor(max_workers=2, thread_name_prefix="kv-writer")
+
+    def _command(self, *args):
+        response = self._session.post(self.url, json=[str(a) for a in args], timeout=self.timeout)
+        response.raise_for_status()
+        return response.json().get("result")
+
+    def _background(self, *args):
+        def run():
+            try:
+                self._command(*args)
+            except Exception as e:
+                logging.warning(f"Remote cache {args[0]} failed: {e}")
+
+        self._writer.submit(run)
+
+    def get(self, key: str) -> Optional[str]:
+        try:
+            return self._command("GET", key)
+        except Exception as e:
+            logging.warning(f"Remote cache GET failed: {e}")
+            return None
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None):
+        if ttl:
+            self._background("SET", key, value, "EX", max(1, int(ttl)))
+        else:
+            self._background("SET", key, value)
+
+    def delete(self, key: str):
+        self._background("DEL", key)
+
+
+_remote = None
+
+
+def remote_tier() -> Optional[RestKV]:
+    """
+    Return the shared remote cache tier, or None if KV_REST_API_URL/KV_REST_API_TOKEN are not set.
+    """
+    global _remote
+    if _remote is None and KV_REST_API_URL and KV_REST_API_TOKEN:
+        _remote = RestKV(KV_REST_API_URL, KV_REST_API_TOKEN)
+    return _remote
+
+
+def all_caches() -> List[TTLCache]:
+    """
+    Return every live cache, e.g. to export their statistics.
+    """
+    return sorted(_caches, key=lambda cache: cache.name)
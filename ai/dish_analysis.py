@@ -1,22 +1,53 @@
+import asyncio
 import json
+import logging
+import os
 import re
-
-from rich import print
-
-from ai.utils import gemini, build_user_profile
-
-
-def get_common_ingredients(dish_name: str) -> list:
-    """
-    Get common ingredients for a given dish name.
-
-    Args:
-        dish_name (str): The name of the dish.
-
-    Returns:
-        list: A list of common ingredients for the dish.
-    """
-    prompt = (
+import time
+from typing import List, Optional, Tuple
+
+from pydantic import BaseModel, ValidationError
+
+from ai.cache import TTLCache
+from ai.pipeline import Step, run_graph
+from ai.resilience import ModelUnavailable, fallback
+from ai.singleflight import flights
+from ai.tracing import traced
+from ai.utils import (
+    build_user_profile,
+    generate_content,
+    generate_content_async,
+    normalize_food_name,
+    profile_key,
+)
+
+# Dish -> ingredient breakdown. Deterministic and independent of the user profile.
+ingredients_cache = TTLCache(
+    "dish_ingredients",
+    maxsize=int(os.environ.get("DISH_CACHE_SIZE", "5000")),
+    ttl=float(os.environ.get("DISH_CACHE_TTL", str(30 * 24 * 3600))),
+)
+
+# (canonical profile, ingredient) -> {"rating", "explanation"}. Shared with ingredient analysis.
+ratings_cache = TTLCache(
+    "ingredient_ratings",
+    maxsize=int(os.environ.get("RATING_CACHE_SIZE", "50000")),
+    ttl=float(os.environ.get("RATING_CACHE_TTL", str(30 * 24 * 3600))),
+)
+
+
+# "graph" runs the four-step analysis (ingredients, ratings, overall, hints), "single"
+# asks for the whole analysis in one structured call and falls back to the graph.
+DISH_ANALYSIS_MODE = os.environ.get("DISH_ANALYSIS_MODE", "graph")
+DISH_SINGLE_CALL_MODEL = os.environ.get("DISH_SINGLE_CALL_MODEL", "gemini-2.0-flash")
+
+
+def rating_key(ingredient: str, user_profile: dict) -> str:
+    return f"{profile_key(user_profile)}::{normalize_food_name(ingredient)}"
+
+
+def _common_ingredients_prompt(dish_name: str) -> str:
+    return (
         f"List common ingredients for {dish_name} and their estimated grams per 100g of the whole dish. "
         "Respond as a single JSON object where each key is the ingredient name and the value is its grams per 100g, using the key 'g_100'. "
         "For example, for 'spaghetti carbonara', the response should be: "
@@ -24,12 +55,8 @@ def get_common_ingredients(dish_name: str) -> list:
         "Do not include any other text or explanation."
     )
 
-    response = gemini().models.generate_content(
-        model="gemini-2.0-flash-lite",
-        contents=prompt,
-        config={"response_modalities": ["TEXT"], "temperature": 0.0},
-    )
 
+def _parse_common_ingredients(response) -> dict:
     for part in response.candidates[0].content.parts:
         if part.text is not None:
             try:
@@ -43,17 +70,116 @@ def get_common_ingredients(dish_name: str) -> list:
                     else:
                         raise ValueError("Expected a JSON object.")
             except Exception as e:
-                print(f"Error parsing response: {e}")
-                return []
-    print("No valid JSON object found in response.")
-    return []
+                logging.error(f"Error parsing response: {e}")
+                return {}
+    logging.error("No valid JSON object found in response.")
+    return {}
 
 
-def get_ingredients_rating(ingredient: list, user_profile: dict) -> float:
+@traced("ingredients")
+def get_common_ingredients(dish_name: str) -> dict:
     """
-    Use gemini to assess the ingredient rating based on user profile.
+    Get common ingredients for a given dish name.
+
+    The breakdown does not depend on the user, so it is cached per normalised dish name.
+
+    Args:
+        dish_name (str): The name of the dish.
+
+    Returns:
+        dict: The common ingredients for the dish mapped to their grams per 100g.
     """
-    prompt = (
+    key = normalize_food_name(dish_name)
+    ingredients = ingredients_cache.get(key)
+    if ingredients is not None:
+        return ingredients
+
+    response = generate_content(
+        model="gemini-2.0-flash-lite",
+        contents=_common_ingredients_prompt(dish_name),
+        config={"response_modalities": ["TEXT"], "temperature": 0.0},
+    )
+    ingredients = _parse_common_ingredients(response)
+    if ingredients:
+        ingredients_cache.set(key, ingredients)
+    return ingredients
+
+
+@traced("ingredients")
+async def get_common_ingredients_async(dish_name: str) -> dict:
+    """
+    Async variant of get_common_ingredients.
+    """
+    key = normalize_food_name(dish_name)
+    ingredients = await ingredients_cache.get_async(key)
+    if ingredients is not None:
+        return ingredients
+
+    async def fetch():
+        response = await generate_content_async(
+            model="gemini-2.0-flash-lite",
+            contents=_common_ingredients_prompt(dish_name),
+            config={"response_modalities": ["TEXT"], "temperature": 0.0},
+        )
+        ingredients = _parse_common_ingredients(response)
+        if ingredients:
+            ingredients_cache.set(key, ingredients)
+        return ingredients
+
+    return await flights.do(("ingredients", key), fetch)
+
+
+def _batch_ingredients_prompt(dish_names: list) -> str:
+    return (
+        f"For each dish in this JSON list: {json.dumps(dish_names)}, list its common ingredients and their estimated grams per 100g of the whole dish. "
+        "Respond as a single JSON object where each key is the dish name exactly as given and the value is an object "
+        "mapping each ingredient name to its grams per 100g, using the key 'g_100'. "
+        "For example, for ['spaghetti carbonara'], the response should be: "
+        '{"spaghetti carbonara": {"spaghetti": {"g_100": 40}, "egg": {"g_100": 20}, "bacon": {"g_100": 20}, "cheese": {"g_100": 20}}}. '
+        "Do not include any other text or explanation."
+    )
+
+
+@traced("ingredients_batch")
+async def get_common_ingredients_batch_async(dish_names: list) -> dict:
+    """
+    Get the common ingredients of many dishes, asking the model once for all uncached dishes.
+
+    Args:
+        dish_names (list): The names of the dishes.
+
+    Returns:
+        dict: Each dish name mapped to its ingredients ({} if the model gave no breakdown).
+    """
+    breakdowns, missing = {}, []
+    dish_names = list(dict.fromkeys(dish_names))
+    cached = await asyncio.gather(*(ingredients_cache.get_async(normalize_food_name(name)) for name in dish_names))
+    for dish_name, ingredients in zip(dish_names, cached):
+        if ingredients is not None:
+            breakdowns[dish_name] = ingredients
+        else:
+            missing.append(dish_name)
+    if not missing:
+        return breakdowns
+
+    response = await generate_content_async(
+        model="gemini-2.0-flash-lite",
+        contents=_batch_ingredients_prompt(missing),
+        config={"response_modalities": ["TEXT"], "temperature": 0.0},
+    )
+    by_key = {normalize_food_name(name): value for name, value in _parse_common_ingredients(response).items()}
+    for dish_name in missing:
+        ingredients = by_key.get(normalize_food_name(dish_name))
+        if isinstance(ingredients, dict) and ingredients:
+            ingredients_cache.set(normalize_food_name(dish_name), ingredients)
+            breakdowns[dish_name] = ingredients
+        else:
+            breakdowns[dish_name] = {}
+    return breakdowns
+
+
+def _ingredients_rating_prompt(ingredient, user_profile: dict) -> str:
+    return (
         f"Given the user's intolerance profile: \n\n {build_user_profile(user_profile)} \n\n, rate the compatibility of each ingredient below. "
         "Only consider intolerances the user actually has; ignore those marked as 'Not Intolerant'. "
         f"Ingredients: {ingredient}. "
@@ -63,12 +189,8 @@ def get_ingredients_rating(ingredient: list, user_profile: dict) -> float:
         "Do not include any other text or explanation."
     )
 
-    response = gemini().models.generate_content(
-        model="gemini-2.0-flash-lite",
-        contents=prompt,
-        config={"response_modalities": ["TEXT"], "temperature": 0.0},
-    )
 
+def _parse_ingredients_rating(response) -> dict:
     for part in response.candidates[0].content.parts:
         if part.text is not None:
             try:
@@ -82,21 +204,96 @@ def get_ingredients_rating(ingredient: list, user_profile: dict) -> float:
                     else:
                         raise ValueError("Expected a JSON object.")
             except Exception as e:
-                print(f"Error parsing response: {e}")
+                logging.error(f"Error parsing response: {e}")
                 return {}
-    print("No valid JSON object found in response.")
+    logging.error("No valid JSON object found in response.")
     return {}
 
 
-def generate_overall_rating(ingredients: dict, user_profile: dict) -> float:
+def _split_cached_ratings(ingredient, user_profile: dict) -> Tuple[dict, list]:
+    cached, missing = {}, []
+    for name in ingredient:
+        rating = ratings_cache.get(rating_key(name, user_profile))
+        if rating is not None:
+            cached[name] = rating
+        else:
+            missing.append(name)
+    return cached, missing
+
+
+async def _split_cached_ratings_async(ingredient, user_profile: dict) -> Tuple[dict, list]:
+    # Cache misses in memory are looked up on disk and in the remote tier off the event loop
+    names = list(ingredient)
+    ratings = await asyncio.gather(*(ratings_cache.get_async(rating_key(name, user_profile)) for name in names))
+    cached = {name: rating for name, rating in zip(names, ratings) if rating is not None}
+    return cached, [name for name, rating in zip(names, ratings) if rating is None]
+
+
+def _store_ratings(result: dict, missing: list, user_profile: dict) -> dict:
+    # Match the model's keys back to the requested names, ignoring case and whitespace
+    by_key = {normalize_food_name(name): value for name, value in result.items()}
+    ratings = {}
+    for name in missing:
+        value = by_key.get(normalize_food_name(name))
+        if isinstance(value, dict) and "rating" in value:
+            ratings_cache.set(rating_key(name, user_profile), value)
+            ratings[name] = value
+    return ratings
+
+
+@traced("ratings")
+def get_ingredients_rating(ingredient, user_profile: dict) -> dict:
     """
-    Generate an overall rating for a dish based on the ingredients and user profile.
+    Use gemini to assess the ingredient rating based on user profile.
+
+    Ratings are cached per ingredient and canonical profile, so only ingredients that
+    have not been rated for this profile yet are sent to the model.
+
+    Args:
+        ingredient: The ingredient names, or a dict keyed by ingredient name.
+        user_profile (dict): The user's intolerance profile.
+
+    Returns:
+        dict: Each ingredient name mapped to its 'rating' and 'explanation'.
     """
-    if not ingredients:
-        return 0.0
+    ratings, missing = _split_cached_ratings(ingredient, user_profile)
+    if not missing:
+        return ratings
+
+    response = generate_content(
+        model="gemini-2.0-flash-lite",
+        contents=_ingredients_rating_prompt(missing, user_profile),
+        config={"response_modalities": ["TEXT"], "temperature": 0.0},
+    )
+    ratings.update(_store_ratings(_parse_ingredients_rating(response), missing, user_profile))
+    return ratings
+
+
+@traced("ratings")
+async def get_ingredients_rating_async(ingredient, user_profile: dict) -> dict:
+    """
+    Async variant of get_ingredients_rating.
+    """
+    ratings, missing = await _split_cached_ratings_async(ingredient, user_profile)
+    if not missing:
+        return ratings
+
+    async def fetch():
+        response = await generate_content_async(
+            model="gemini-2.0-flash-lite",
+            contents=_ingredients_rating_prompt(missing, user_profile),
+            config={"response_modalities": ["TEXT"], "temperature": 0.0},
+        )
+        return _store_ratings(_parse_ingredients_rating(response), missing, user_profile)
+
+    key = (profile_key(user_profile), tuple(sorted(normalize_food_name(name) for name in missing)))
+    ratings.update(await flights.do(("ratings", key), fetch))
+    return ratings
 
+
+def _overall_rating_prompt(ingredients: dict, user_profile: dict) -> str:
     # Use LLM to predict the overall rating based on the ingredients and user profile
-    prompt = (
+    return (
         f"Given the following dish ingredients and their analysis: {json.dumps(ingredients)}, "
         f"and the user's intolerance profile: \n\n {build_user_profile(user_profile)} \n\n, "
         "predict an overall compatibility rating for the dish from 0 (problematic) to 100 (fully compatible). "
@@ -104,12 +301,8 @@ def generate_overall_rating(ingredients: dict, user_profile: dict) -> float:
         "Do not include any other text or explanation."
     )
 
-    response = gemini().models.generate_content(
-        model="gemini-2.0-flash-lite",
-        contents=prompt,
-        config={"response_modalities": ["TEXT"], "temperature": 0.0},
-    )
 
+def _parse_overall_rating(response) -> Optional[float]:
     for part in response.candidates[0].content.parts:
         if part.text is not None:
             try:
@@ -120,36 +313,108 @@ def generate_overall_rating(ingredients: dict, user_profile: dict) -> float:
                     if isinstance(result, dict) and "overall_rating" in result:
                         return float(result["overall_rating"])
             except Exception as e:
-                print(f"Error parsing LLM response for overall rating: {e}")
+                logging.error(f"Error parsing LLM response for overall rating: {e}")
                 continue
+    return None
 
-    # Fallback: use simple average if LLM fails
-    ratings = [ingredient.get("rating", 0) for ingredient in ingredients.values()]
+
+def _unusable_overall_rating(ingredients: dict) -> float:
+    # Compute the score locally if the model's answer is unusable; fallback() marks the
+    # result degraded so it is not cached as if the model had answered
+    fallback("overall", ModelUnavailable("Unusable overall rating answer"))
+    return local_overall_rating(ingredients)
+
+
+def local_overall_rating(ingredients: dict) -> float:
+    """
+    Compute an overall rating without the LLM, weighting each ingredient by its grams per 100g.
+    """
+    weighted = [
+        (data.get("rating", 0), data.get("g_100", 0))
+        for data in ingredients.values()
+        if isinstance(data, dict)
+    ]
+    known = [
+        (rating, weight)
+        for rating, weight in weighted
+        if isinstance(weight, (int, float)) and weight > 0
+    ]
+    total_weight = sum(weight for _, weight in known)
+    if total_weight:
+        return sum(rating * weight for rating, weight in known) / total_weight
+
+    # Fallback: use simple average if no weights are known
+    ratings = [rating for rating, _ in weighted]
     return sum(ratings) / len(ratings) if ratings else 0.0
 
 
-def generate_text(ingredients: dict, user_profile: dict, dish_name: str) -> list:
+@traced("overall")
+def generate_overall_rating(ingredients: dict, user_profile: dict) -> float:
     """
-    Generate a list of 1-2 hints (max 3), each as a dict with a keyword and a single-sentence tip.
+    Generate an overall rating for a dish based on the ingredients and user profile.
+    The rating is computed locally from the ingredient ratings if the model is unavailable.
+    """
+    if not ingredients:
+        return 0.0
+
+    try:
+        response = generate_content(
+            model="gemini-2.0-flash-lite",
+            contents=_overall_rating_prompt(ingredients, user_profile),
+            config={"response_modalities": ["TEXT"], "temperature": 0.0},
+        )
+    except ModelUnavailable as e:
+        fallback("overall", e)
+        return local_overall_rating(ingredients)
+    rating = _parse_overall_rating(response)
+    return rating if rating is not None else _unusable_overall_rating(ingredients)
+
+
+@traced("overall")
+async def generate_overall_rating_async(ingredients: dict, user_profile: dict) -> float:
     """
+    Async variant of generate_overall_rating.
+    """
+    if not ingredients:
+        return 0.0
+
+    async def fetch():
+        response = await generate_content_async(
+            model="gemini-2.0-flash-lite",
+            contents=_overall_rating_prompt(ingredients, user_profile),
+            config={"response_modalities": ["TEXT"], "temperature": 0.0},
+        )
+        return _parse_overall_rating(response)
+
+    key = (profile_key(user_profile), json.dumps(ingredients, sort_keys=True))
+    try:
+        rating = await flights.do(("overall", key), fetch)
+    except ModelUnavailable as e:
+        fallback("overall", e)
+        return local_overall_rating(ingredients)
+    # Checked outside the flight so every caller sharing the answer records the fallback
+    return rating if rating is not None else _unusable_overall_rating(ingredients)
+
+
+def _text_prompt(ingredients: dict, user_profile: dict, dish_name: str) -> str:
     # Calculate overall rating to determine if replacements are needed
     ratings = [ingredient.get("rating", 0) for ingredient in ingredients.values()]
     avg_rating = sum(ratings) / len(ratings) if ratings else 0.0
-    
+
     prompt = (
         f"Given the dish '{dish_name}' and its ingredients analysis: {json.dumps(ingredients)}, "
         f"and the user's intolerance profile: \n\n {build_user_profile(user_profile)} \n\n, "
         f"provide 1-2 helpful hints for the user (maximum 3), each as a single sentence. "
         "Always include at least one 'Tip' hint about the dish or its preparation. "
     )
-    
+
     # Add replacement instruction only if the dish has a bad rating (<40)
     if avg_rating < 40:
         prompt += (
             "Since this dish has compatibility issues, also include an 'Alternative' or 'Replacement' hint "
             "suggesting how to modify the dish or replace problematic ingredients. "
         )
-    
+
     prompt += (
         "Each hint must be a dict with a 'keyword' (such as 'Tip', 'Did you know', 'Care', 'Alternative', 'Replacement', etc.) and a 'text' field (the single-sentence tip). "
         "Return a JSON list of these dicts. "
@@ -159,13 +424,10 @@ def generate_text(ingredients: dict, user_profile: dict, dish_name: str) -> list
         "] "
         "Do not include any other text or explanation."
     )
+    return prompt
 
-    response = gemini().models.generate_content(
-        model="gemini-2.5-flash-preview-05-20",
-        contents=prompt,
-        config={"response_modalities": ["TEXT"], "temperature": 0.0},
-    )
 
+def _parse_text(response) -> Optional[list]:
     for part in response.candidates[0].content.parts:
         if part.text is not None:
             try:
@@ -176,29 +438,179 @@ def generate_text(ingredients: dict, user_profile: dict, dish_name: str) -> list
                     if isinstance(result, list):
                         return result
             except Exception as e:
-                print(f"Error parsing response: {e}")
+                logging.error(f"Error parsing response: {e}")
                 continue
+    return None
+
 
+def _local_hints(ingredients: dict) -> list:
+    # Hints derived from the ratings alone, used while the hints model is unavailable
+    rated = sorted(
+        (value.get("rating", 0), name) for name, value in ingredients.items() if isinstance(value, dict)
+    )
+    worst = [name for rating, name in rated if rating < 40][:2]
+    if worst:
+        return [{
+            "keyword": "Care",
+            "text": f"{' and '.join(worst).capitalize()} {'are' if len(worst) > 1 else 'is'} the least compatible with your profile, consider leaving {'them' if len(worst) > 1 else 'it'} out.",
+        }]
     return [
         {"keyword": "Tip", "text": "Consider consulting with a nutritionist for personalized advice about this dish."}
     ]
 
 
-def analyze_dish(dish_name: str, user_profile: dict) -> dict:
+@traced("hints")
+def generate_text(ingredients: dict, user_profile: dict, dish_name: str) -> list:
     """
-    Analyze a dish and return a rating and explanation.
+    Generate a list of 1-2 hints (max 3), each as a dict with a keyword and a single-sentence tip.
+    Hints are derived from the ratings if the model is unavailable.
+    """
+    try:
+        response = generate_content(
+            model="gemini-2.5-flash-preview-05-20",
+            contents=_text_prompt(ingredients, user_profile, dish_name),
+            config={"response_modalities": ["TEXT"], "temperature": 0.0},
+        )
+    except ModelUnavailable as e:
+        fallback("hints", e)
+        return _local_hints(ingredients)
+    text = _parse_text(response)
+    if text is None:
+        fallback("hints", ModelUnavailable("Unusable hints answer"))
+        return _local_hints(ingredients)
+    return text
+
+
+@traced("hints")
+async def generate_text_async(ingredients: dict, user_profile: dict, dish_name: str) -> list:
+    """
+    Async variant of generate_text.
+    """
+
+    async def fetch():
+        response = await generate_content_async(
+            model="gemini-2.5-flash-preview-05-20",
+            contents=_text_prompt(ingredients, user_profile, dish_name),
+            config={"response_modalities": ["TEXT"], "temperature": 0.0},
+        )
+        return _parse_text(response)
+
+    key = (normalize_food_name(dish_name), profile_key(user_profile), json.dumps(ingredients, sort_keys=True))
+    try:
+        text = await flights.do(("hints", key), fetch)
+    except ModelUnavailable as e:
+        fallback("hints", e)
+        return _local_hints(ingredients)
+    if text is None:
+        fallback("hints", ModelUnavailable("Unusable hints answer"))
+        return _local_hints(ingredients)
+    return text
+
+
+class IngredientAnalysis(BaseModel):
+    ingredient_name: str
+    g_100: float
+    rating: float
+    explanation: str
+
+
+class Hint(BaseModel):
+    keyword: str
+    text: str
+
+
+class DishAnalysis(BaseModel):
+    """Response schema of the single-call dish analysis."""
+
+    ingredients: List[IngredientAnalysis]
+    overall_rating: float
+    text: List[Hint]
+
+
+def _dish_analysis_prompt(dish_name: str, user_profile: dict) -> str:
+    return (
+        f"Analyze the dish '{dish_name}' for a user with the following intolerance profile: \n\n {build_user_profile(user_profile)} \n\n"
+        "List its common ingredients with their estimated grams per 100g of the whole dish (g_100). "
+        "Rate the compatibility of each ingredient from 0 (problematic) to 100 (fully compatible) with a brief explanation. "
+        "Only consider intolerances the user actually has; ignore those marked as 'Not Intolerant'. "
+        "Then predict an overall compatibility rating for the dish from 0 to 100. "
+        "Finally provide 1-2 helpful hints for the user (maximum 3), each as a single sentence with a 'keyword' "
+        "(such as 'Tip', 'Did you know', 'Care', 'Alternative', 'Replacement', etc.). "
+        "Always include at least one 'Tip' hint about the dish or its preparation. "
+        "If the overall rating is below 40, also include an 'Alternative' or 'Replacement' hint "
+        "suggesting how to modify the dish or replace problematic ingredients."
+    )
+
+
+_DISH_ANALYSIS_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": DishAnalysis,
+    "temperature": 0.0,
+}
+
+
+def _parse_dish_analysis(response) -> Optional[DishAnalysis]:
+    try:
+        analysis = DishAnalysis.model_validate_json(response.text or "")
+    except (ValidationError, ValueError) as e:
+        logging.error(f"Error parsing structured dish analysis: {e}")
+        return None
+    return analysis if analysis.ingredients else None
+
+
+def _store_dish_analysis(dish_name: str, analysis: DishAnalysis, user_profile: dict) -> dict:
+    # Feed the shared caches so the multi-call path and batch searches reuse the answer
+    ingredients = {}
+    for item in analysis.ingredients:
+        ingredients[item.ingredient_name] = {"g_100": item.g_100, "rating": item.rating}
+        ratings_cache.set(
+            rating_key(item.ingredient_name, user_profile),
+            {"rating": item.rating, "explanation": item.explanation},
+        )
+    ingredients_cache.set(
+        normalize_food_name(dish_name),
+        {name: {"g_100": value["g_100"]} for name, value in ingredients.items()},
+    )
+    return ingredients
+
+
+@traced("dish_analysis")
+async def analyze_dish_single_async(dish_name: str, user_profile: dict) -> Optional[dict]:
+    """
+    Analyze a dish with a single structured-output model call.
+
+    Returns:
+        dict: The rated ingredients (with g_100), overall rating and hints, or None if the
+        model's answer was unusable.
     """
-    ingredients = get_common_ingredients(dish_name)
-    ratings = get_ingredients_rating(ingredients, user_profile)
 
+    async def fetch():
+        response = await generate_content_async(
+            model=DISH_SINGLE_CALL_MODEL,
+            contents=_dish_analysis_prompt(dish_name, user_profile),
+            config=_DISH_ANALYSIS_CONFIG,
+        )
+        analysis = _parse_dish_analysis(response)
+        if analysis is None:
+            return None
+        return {
+            "ingredients": _store_dish_analysis(dish_name, analysis, user_profile),
+            "overall_rating": analysis.overall_rating,
+            "text": [hint.model_dump() for hint in analysis.text],
+        }
+
+    key = (normalize_food_name(dish_name), profile_key(user_profile))
+    return await flights.do(("dish", key), fetch)
+
+
+def _merge_ratings(ingredients: dict, ratings: dict) -> dict:
     for name, value in ingredients.items():
         rating = ratings.get(name, {}).get("rating", 0)
         ingredients[name]["rating"] = rating
+    return ingredients
 
-    # Use the dedicated functions
-    overall_rating = generate_overall_rating(ingredients, user_profile)
-    text = generate_text(ingredients, user_profile, dish_name)
 
+def _build_result(ingredients: dict, overall_rating: float, text: list) -> dict:
     # Transform ingredients dict to list of objects with ingredient_name and rating
     ingredients_list = [
         {
@@ -208,13 +620,92 @@ def analyze_dish(dish_name: str, user_profile: dict) -> dict:
         for name, data in ingredients.items()
     ]
 
-    final_return_json = {
+    return {
         "overall_rating": overall_rating,
         "text": text,
         "ingredients": ingredients_list,
     }
 
-    return final_return_json
+
+def analyze_dish(dish_name: str, user_profile: dict, mode: Optional[str] = None) -> dict:
+    """
+    Analyze a dish and return a rating and explanation.
+    """
+    return asyncio.run(analyze_dish_async(dish_name, user_profile, mode=mode))
+
+
+async def analyze_dish_async(dish_name: str, user_profile: dict, on_complete=None, mode: Optional[str] = None) -> dict:
+    """
+    Async variant of analyze_dish.
+
+    In "graph" mode the analysis runs as a graph: the overall rating and the hints both
+    only depend on the rated ingredients and are requested concurrently. In "single" mode
+    one structured call answers everything, and the graph is used if that call fails.
+    The per-step durations in milliseconds are returned under "timings".
+
+    Args:
+        dish_name (str): The name of the dish.
+        user_profile (dict): The user's intolerance profile.
+        on_complete: Optional coroutine called with (step, result, elapsed_ms) per finished step.
+        mode (str): "graph" or "single", defaults to DISH_ANALYSIS_MODE.
+
+    Returns:
+        dict: The overall rating, hints, rated ingredients and step timings.
+    """
+    if (mode or DISH_ANALYSIS_MODE) == "single":
+        start = time.perf_counter()
+        try:
+            single = await analyze_dish_single_async(dish_name, user_profile)
+        except Exception as e:
+            logging.warning(f"Single-call dish analysis failed: {e}")
+            single = None
+        if single is not None:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            if on_complete is not None:
+                ingredients = single["ingredients"]
+                await on_complete("ingredients", {n: {"g_100": v["g_100"]} for n, v in ingredients.items()}, elapsed_ms)
+                await on_complete("ratings", ingredients, elapsed_ms)
+                await on_complete("overall", single["overall_rating"], elapsed_ms)
+                await on_complete("hints", single["text"], elapsed_ms)
+            result = _build_result(single["ingredients"], single["overall_rating"], single["text"])
+            result["timings"] = {"analysis": elapsed_ms}
+            return result
+        logging.info("Falling back to the multi-call dish analysis")
+
+    async def ingredients():
+        ingredients = await get_common_ingredients_async(dish_name)
+        if not ingredients:
+            # Rating an empty breakdown would silently report a 0 rating
+            raise ModelUnavailable(f"No ingredient breakdown for {dish_name}")
+        return ingredients
+
+    async def ratings(ingredients):
+        ratings = await get_ingredients_rating_async(ingredients, user_profile)
+        return _merge_ratings(ingredients, ratings)
+
+    async def overall(ratings):
+        try:
+            return await generate_overall_rating_async(ratings, user_profile)
+        except Exception as e:
+            fallback("overall", e)
+            return local_overall_rating(ratings)
+
+    async def hints(ratings):
+        return await generate_text_async(ratings, user_profile, dish_name)
+
+    results, timings = await run_graph(
+        [
+            Step("ingredients", ingredients),
+            Step("ratings", ratings, requires=("ingredients",)),
+            Step("overall", overall, requires=("ratings",)),
+            Step("hints", hints, requires=("ratings",)),
+        ],
+        on_complete=on_complete,
+    )
+
+    result = _build_result(results["ratings"], results["overall"], results["hints"])
+    result["timings"] = timings
+    return result
 
 
 if __name__ == "__main__":
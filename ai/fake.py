@@ -0,0 +1,168 @@
+from __future__ import annotations
+
+import ast
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from io import BytesIO
+from string import Template
+
+from ai.startup import lazy_import
+
+types = lazy_import("google.genai.types")
+
+RECORDINGS_PATH = os.getenv(
+    "FAKE_RECORDINGS", os.path.join(os.path.dirname(__file__), "data", "fake_recordings.json")
+)
+
+# Mean response time in seconds per model, scaled by FAKE_LATENCY_SCALE.
+MODEL_LATENCIES = {
+    "gemini-2.0-flash-lite": 0.5,
+    "gemini-2.0-flash": 0.7,
+    "gemini-2.5-flash-preview-05-20": 2.5,
+    "gemini-2.0-flash-exp-image-generation": 6.0,
+}
+LATENCY_SCALE = float(os.getenv("FAKE_LATENCY_SCALE", "1.0"))
+# Relative jitter, e.g. 0.2 draws latencies uniformly from +-20% around the mean.
+JITTER = float(os.getenv("FAKE_JITTER", "0.2"))
+BLOB_LATENCY = float(os.getenv("FAKE_BLOB_LATENCY", "0.05"))
+
+
+def _response(text: str = None, image: bytes = None) -> types.GenerateContentResponse:
+    parts = []
+    if text is not None:
+        parts.append(types.Part(text=text))
+    if image is not None:
+        parts.append(types.Part(inline_data=types.Blob(data=image, mime_type="image/png")))
+    return types.GenerateContentResponse(
+        candidates=[types.Candidate(content=types.Content(parts=parts))]
+    )
+
+
+def _placeholder_image(prompt: str) -> bytes:
+    from PIL import Image
+
+    colour = tuple(hashlib.sha256(prompt.encode("utf-8")).digest()[:3])
+    buf = BytesIO()
+    Image.new("RGB", (1024, 768), colour).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+class FakeBackend:
+    """
+    Deterministic stand-in for the Gemini API.
+
+    Prompts are answered from recordings: each recording has a "match" regex and either a
+    "text" template, filled with the regex's named groups via string.Template, or
+    "image": true for a generated placeholder image. The first matching recording wins.
+    Batched prompts use "foreach": the list captured by the "items" group is answered item
+    by item through foreach["prompt"] (with $item) and combined into a JSON list, or an
+    object keyed by item if foreach["combine"] is "object".
+    Every call sleeps for the model's latency with jitter to mimic the real service.
+
+    Args:
+        recordings_path (str): JSON file with the recordings.
+        latency_scale (float): Multiplier applied to MODEL_LATENCIES, 0 disables sleeping.
+        jitter (float): Relative latency jitter.
+        seed (int): Seed of the jitter, for reproducible runs.
+    """
+
+    def __init__(self, recordings_path: str = RECORDINGS_PATH, latency_scale: float = LATENCY_SCALE,
+                 jitter: float = JITTER, seed: int = 0):
+        with open(recordings_path, encoding="utf-8") as f:
+            self.recordings = [
+                {**recording, "pattern": re.compile(recording["match"], re.DOTALL)}
+                for recording in json.load(f)
+            ]
+        self.latency_scale = latency_scale
+        self.jitter = jitter
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def _latency(self, model: str) -> float:
+        with self._lock:
+            self.calls += 1
+            spread = self._random.uniform(-self.jitter, self.jitter)
+        return max(0.0, MODEL_LATENCIES.get(model, 1.0) * self.latency_scale * (1 + spread))
+
+    def _text(self, prompt: str):
+        for recording in self.recordings:
+            match = recording["pattern"].search(prompt)
+            if match is None:
+                continue
+            if recording.get("image"):
+                return None
+            if "foreach" in recording:
+                return json.dumps(self._foreach(recording["foreach"], match.group("items")))
+            values = {name: (value or "").strip().lower() for name, value in match.groupdict().items()}
+            return Template(recording["text"]).safe_substitute(values)
+        return ""
+
+    def _foreach(self, foreach: dict, items: str):
+        # Batched prompts embed their items as a JSON or Python list literal
+        try:
+            items = json.loads(items)
+        except ValueError:
+            items = ast.literal_eval(items)
+        answers = []
+        for item in items:
+            text = self._text(Template(foreach["prompt"]).safe_substitute(item=item))
+            try:
+                answers.append(json.loads(text))
+            except (TypeError, ValueError):
+                answers.append(text)
+        if foreach.get("combine") == "object":
+            return dict(zip(items, answers))
+        return answers
+
+    def _answer(self, model: str, contents) -> types.GenerateContentResponse:
+        prompt = str(contents)
+        text = self._text(prompt)
+        if text is None:
+            return _response(image=_placeholder_image(prompt))
+        return _response(text=text)
+
+    def generate_content(self, model: str, contents, config=None) -> types.GenerateContentResponse:
+        time.sleep(self._latency(model))
+        return self._answer(model, contents)
+
+    async def generate_content_async(self, model: str, contents, config=None) -> types.GenerateContentResponse:
+        await asyncio.sleep(self._latency(model))
+        return self._answer(model, contents)
+
+
+class FakeBlobStore:
+    """
+    In-memory stand-in for Vercel Blob with a fixed latency per operation.
+    """
+
+    def __init__(self, latency: float = BLOB_LATENCY):
+        self.latency = latency
+        self.blobs = {}
+
+    def list(self, options: dict = None) -> dict:
+        options = options or {}
+        time.sleep(self.latency)
+        pathnames = sorted(p for p in self.blobs if p.startswith(options.get("prefix", "")))
+        start = int(options.get("cursor") or 0)
+        end = start + int(options.get("limit", 1000))
+        return {
+            "blobs": [{"pathname": p, "url": f"fake-blob://{p}"} for p in pathnames[start:end]],
+            "hasMore": end < len(pathnames),
+            "cursor": str(end) if end < len(pathnames) else None,
+        }
+
+    def put(self, pathname: str, data: bytes) -> dict:
+        time.sleep(self.latency)
+        self.blobs[pathname] = data
+        return {"pathname": pathname, "url": f"fake-blob://{pathname}"}
+
+    def get(self, url: str) -> bytes:
+        time.sleep(self.latency)
+        return self.blobs.get(url.removeprefix("fake-blob://"))
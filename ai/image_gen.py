@@ -1,64 +1,190 @@
+from __future__ import annotations
+
+import asyncio
 import base64
+import functools
+import importlib.util
 import logging
 import os
 from io import BytesIO
+from urllib.parse import quote, urlsplit
 
-import requests
-import vercel_blob
-from PIL import Image
-
-from ai.utils import gemini
+from ai.blob_index import blob_index
+from ai.blob_store import get_blob_store
+from ai.singleflight import flights
+from ai.startup import lazy_import
+from ai.tracing import traced
+from ai.upload_queue import upload_queue
+from ai.utils import generate_content, generate_content_async, normalize_food_name
 
 logging.basicConfig(level=logging.INFO)
 
+# Pillow is only needed once an image is generated or converted
+Image = lazy_import("PIL.Image")
 
-def search_for_existing_image(food_query: str) -> str:
-    """Return the image as base64 string if exists."""
-    blobs = vercel_blob.list().get("blobs", [])
-    url = next(
-        (
-            obj
-            for obj in blobs
-            if obj["pathname"] == food_query.replace(" ", "_").lower() + ".jpg"
-        ),
-        None,
-    )
-    if url:  # Check if url is not None
-        response = requests.get(url["url"])
-        if response.status_code == 200:
-            img = Image.open(BytesIO(response.content))
-            buf = BytesIO()
-            img.save(buf, format="JPEG")
-            image_bytes = buf.getvalue()
-            return base64.b64encode(image_bytes).decode("utf-8")
 
-    logging.info(f"No cached image found for {food_query}")
-    return None
+# Widths of the stored derivatives; "full" keeps the generated resolution.
+IMAGE_SIZES = {"thumb": 160, "medium": 480, "full": None}
 
+# format -> (PIL format, file extension, media type, encoder options)
+IMAGE_FORMATS = {
+    "jpeg": ("JPEG", "jpg", "image/jpeg", {"quality": 82, "optimize": True, "progressive": True}),
+    "webp": ("WEBP", "webp", "image/webp", {"quality": 78, "method": 4}),
+}
+# Only available if Pillow was built with AVIF support (see image_formats)
+AVIF_FORMAT = ("AVIF", "avif", "image/avif", {"quality": 60})
+
+
+@functools.lru_cache(maxsize=None)
+def image_formats() -> dict:
+    """
+    Return the formats images are stored in: IMAGE_FORMATS, plus "avif" if Pillow supports it.
+    The check imports the PIL package, so it runs on first use instead of at startup.
+    """
+    formats = dict(IMAGE_FORMATS)
+    # Same check as PIL.features.check("avif") without importing the plugins
+    if importlib.util.find_spec("PIL._avif") is not None:
+        formats["avif"] = AVIF_FORMAT
+    return formats
+
+# Prefix of the /image URLs returned while an image is still being uploaded, e.g. the public API origin.
+IMAGE_BASE_URL = os.getenv("IMAGE_BASE_URL", "").rstrip("/")
+
+
+def _blob_pathname(food_query: str, size: str = "full", format: str = "jpeg") -> str:
+    name = food_query.replace(" ", "_").lower()
+    if size == "full" and format == "jpeg":
+        # Original location of the generated image, kept for existing blobs and clients
+        return name + ".jpg"
+    return f"{name}_{size}.{image_formats()[format][1]}"
+
+
+def media_type(format: str) -> str:
+    return image_formats()[format][2]
+
+
+def _encode(image: Image.Image, size: str, format: str) -> bytes:
+    width = IMAGE_SIZES[size]
+    if width and image.width > width:
+        image = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+    pil_format, _, _, options = image_formats()[format]
+    buf = BytesIO()
+    image.save(buf, format=pil_format, **options)
+    return buf.getvalue()
+
+
+def _encode_derivatives(image: Image.Image) -> dict:
+    """Encode the image in every size and format, keyed by (size, format)."""
+    return {
+        (size, format): _encode(image, size, format)
+        for size in IMAGE_SIZES
+        for format in image_formats()
+    }
+
+
+def _download(url: str) -> bytes:
+    return get_blob_store().get(url)
+
+
+def _local_url(food_query: str, size: str, format: str) -> str:
+    """URL of the image on the /image endpoint, which also serves images that are still being uploaded."""
+    return f"{IMAGE_BASE_URL}/image/{quote(food_query)}?size={size}&format={format}"
+
+
+def _upload(pathname: str, image_bytes: bytes):
+    url = get_blob_store().put(pathname, image_bytes).get("url")
+    if not url:
+        raise RuntimeError("blob store returned no URL")
+    blob_index.add(pathname, url)
 
-def _save_and_upload_image(food_query: str, image_bytes: bytes):
-    """Save image locally and upload to Vercel Blob."""
-    vercel_blob.put(
-        food_query.replace(" ", "_").lower() + ".jpg",
-        image_bytes,
-        {"addRandomSuffix": False},
-    )
 
+def is_local_url(url: str) -> bool:
+    """Whether url is an /image URL, i.e. the image was not uploaded to the blob store yet."""
+    return urlsplit(url).path.startswith(urlsplit(IMAGE_BASE_URL).path + "/image/")
 
-def generate_image(food_query: str) -> str:
+
+def _save_image(food_query: str, derivatives: dict):
     """
-    Generate an image using Gemini API and return as base64 string.
-    Args:
-        food_query (str): The food query.
-    Returns:
-        str: Base64-encoded image.
+    Queue every derivative for upload to the blob store without waiting for it (see ai.upload_queue).
+    If the spool cannot be written, e.g. the disk is full, the derivative is uploaded right away.
     """
-    image_base64 = search_for_existing_image(food_query)
-    if image_base64:
-        logging.info(f"Found cached image for {food_query}")
-        return image_base64
+    for key, image_bytes in derivatives.items():
+        pathname = _blob_pathname(food_query, *key)
+        try:
+            upload_queue.put(pathname, image_bytes)
+        except OSError as e:
+            logging.warning(f"Could not spool {pathname}, uploading it now: {e}")
+            try:
+                _upload(pathname, image_bytes)
+            except Exception as e:
+                logging.error(f"Failed to upload {pathname}: {e}")
+
+
+def _image_url(food_query: str, size: str, format: str) -> str:
+    """Return the blob URL once the image is uploaded, or its /image URL while the upload is pending."""
+    pathname = _blob_pathname(food_query, size, format)
+    if upload_queue.pending(pathname):
+        return _local_url(food_query, size, format)
+    return blob_index.lookup(pathname) or _local_url(food_query, size, format)
+
+
+def _backfill_derivatives(food_query: str) -> dict:
+    """Create the derivatives of an image stored before derivatives existed."""
+    original = load_image(food_query)
+    if not original:
+        return None
+    logging.info(f"Creating image derivatives for {food_query}")
+    derivatives = _encode_derivatives(Image.open(BytesIO(original)).convert("RGB"))
+    derivatives.pop(("full", "jpeg"))
+    _save_image(food_query, derivatives)
+    return derivatives
+
 
-    prompt = (
+@traced("image_lookup")
+def find_image_url(food_query: str, size: str = "full", format: str = "jpeg") -> str:
+    """Return the URL of the stored or spooled image, or None if there is none."""
+    pathname = _blob_pathname(food_query, size, format)
+    if upload_queue.pending(pathname):
+        return _local_url(food_query, size, format)
+    url = blob_index.lookup(pathname)
+    if url is None and (size, format) != ("full", "jpeg") and _backfill_derivatives(food_query):
+        url = _image_url(food_query, size, format)
+    return url
+
+
+@traced("image_lookup")
+def load_image(food_query: str, size: str = "full", format: str = "jpeg") -> bytes:
+    """Return the stored image bytes as they are in the blob store (or the upload spool), or None."""
+    pathname = _blob_pathname(food_query, size, format)
+    if upload_queue.pending(pathname):
+        image_bytes = upload_queue.read(pathname)
+        if image_bytes is not None:
+            return image_bytes
+    url = blob_index.lookup(pathname)
+    if url:  # Check if url is not None
+        image_bytes = _download(url)
+        if image_bytes is not None:
+            return image_bytes
+        blob_index.discard(pathname)
+    if (size, format) != ("full", "jpeg"):
+        derivatives = _backfill_derivatives(food_query)
+        if derivatives:
+            return derivatives[(size, format)]
+    return None
+
+
+def search_for_existing_image(food_query: str, size: str = "full", format: str = "jpeg") -> str:
+    """Return the image as base64 string if exists."""
+    image_bytes = load_image(food_query, size, format)
+    if image_bytes:
+        return base64.b64encode(image_bytes).decode("utf-8")
+
+    logging.info(f"No cached image found for {food_query}")
+    return None
+
+
+def _image_prompt(food_query: str) -> str:
+    return (
         f"Generate a high-resolution, photorealistic image of {food_query} for a food blog. "
         "The food should be centered and viewed from the side, with no other objects in the image. "
         "Use a plain white background — no shadows touching the border, gray tints, borders, or edges touching the frame. No reflections. "
@@ -69,37 +195,140 @@ def generate_image(food_query: str) -> str:
         "Enforce 4:3 wide aspect ratio and a white background."
     )
 
-    response = gemini().models.generate_content(
-        model="gemini-2.0-flash-exp-image-generation",
-        contents=prompt,
-        config={"response_modalities": ["TEXT", "IMAGE"]},
-    )
 
+def _extract_image(response) -> dict:
+    """Return the generated image's derivatives, or None if the response has no image."""
     for part in response.candidates[0].content.parts:
         if getattr(part, "inline_data", None) and not getattr(part, "text", None):
             image = Image.open(BytesIO(part.inline_data.data)).convert("RGB")
-            buf = BytesIO()
-            image.save(buf, format="JPEG")
-            image_bytes = buf.getvalue()
-            _save_and_upload_image(food_query, image_bytes)
-            return base64.b64encode(image_bytes).decode("utf-8")
+            return _encode_derivatives(image)
     return None
 
 
-def get_image(food_query: str) -> str:
+@traced("image_generation", cached=False)
+def _generate_derivatives(food_query: str) -> dict:
+    response = generate_content(
+        model="gemini-2.0-flash-exp-image-generation",
+        contents=_image_prompt(food_query),
+        config={"response_modalities": ["TEXT", "IMAGE"]},
+    )
+    return _extract_image(response)
+
+
+@traced("image_generation", cached=False)
+async def _generate_derivatives_async(food_query: str) -> dict:
+    response = await generate_content_async(
+        model="gemini-2.0-flash-exp-image-generation",
+        contents=_image_prompt(food_query),
+        config={"response_modalities": ["TEXT", "IMAGE"]},
+    )
+    # Encoding every derivative is CPU bound, keep it off the event loop
+    return await asyncio.to_thread(_extract_image, response)
+
+
+async def _generate_and_save_async(food_query: str) -> dict:
+    """
+    Generate and encode the image once, even if several requests ask for it at the same time,
+    and queue it for upload. The upload happens in the background.
+
+    Returns:
+        dict: The derivatives keyed by (size, format), or None if generation failed.
+    """
+
+    async def generate():
+        derivatives = await _generate_derivatives_async(food_query)
+        if derivatives is not None:
+            await asyncio.to_thread(_save_image, food_query, derivatives)
+        return derivatives
+
+    return await flights.do(("image", normalize_food_name(food_query)), generate)
+
+
+def generate_image(food_query: str, size: str = "full", format: str = "jpeg") -> str:
+    """
+    Generate an image using Gemini API and return as base64 string.
+    Does not check the blob store first; use get_image for that.
+    Args:
+        food_query (str): The food query.
+        size (str): The derivative size to return, one of IMAGE_SIZES.
+        format (str): The derivative format to return, one of image_formats().
+    Returns:
+        str: Base64-encoded image.
+    """
+    derivatives = _generate_derivatives(food_query)
+    if derivatives is None:
+        return None
+    _save_image(food_query, derivatives)
+    return base64.b64encode(derivatives[(size, format)]).decode("utf-8")
+
+
+def get_image(food_query: str, size: str = "full", format: str = "jpeg") -> str:
     """
     Get the image for the given food query.
     Args:
         food_query (str): The food query.
+        size (str): The derivative size, one of IMAGE_SIZES.
+        format (str): The derivative format, one of image_formats().
     Returns:
         str: Base64-encoded image.
     """
-    image_base64 = search_for_existing_image(food_query)
+    image_base64 = search_for_existing_image(food_query, size, format)
+    if image_base64:
+        logging.info(f"Found image for {food_query} using search_for_existing_image")
+        return image_base64
+    logging.info(f"Generating new image for {food_query}")
+    return generate_image(food_query, size, format)
+
+
+def get_image_url(food_query: str, size: str = "full", format: str = "jpeg") -> str:
+    """
+    Get the blob URL of the image for the given food query, generating the image if needed.
+    Args:
+        food_query (str): The food query.
+        size (str): The derivative size, one of IMAGE_SIZES.
+        format (str): The derivative format, one of image_formats().
+    Returns:
+        str: The public URL of the image, or its /image URL while it is being uploaded.
+    """
+    url = find_image_url(food_query, size, format)
+    if url:
+        return url
+    logging.info(f"Generating new image for {food_query}")
+    derivatives = _generate_derivatives(food_query)
+    if derivatives is None:
+        return None
+    _save_image(food_query, derivatives)
+    return _image_url(food_query, size, format)
+
+
+async def get_image_async(food_query: str, size: str = "full", format: str = "jpeg") -> str:
+    """
+    Async variant of get_image. Blob store access runs in the default thread pool.
+    """
+    image_base64 = await asyncio.to_thread(search_for_existing_image, food_query, size, format)
     if image_base64:
         logging.info(f"Found image for {food_query} using search_for_existing_image")
         return image_base64
     logging.info(f"Generating new image for {food_query}")
-    return generate_image(food_query)
+
+    derivatives = await _generate_and_save_async(food_query)
+    if derivatives is None:
+        return None
+    return base64.b64encode(derivatives[(size, format)]).decode("utf-8")
+
+
+async def get_image_url_async(food_query: str, size: str = "full", format: str = "jpeg") -> str:
+    """
+    Async variant of get_image_url.
+    """
+    url = await asyncio.to_thread(find_image_url, food_query, size, format)
+    if url:
+        return url
+    logging.info(f"Generating new image for {food_query}")
+
+    if await _generate_and_save_async(food_query) is None:
+        return None
+    return await asyncio.to_thread(_image_url, food_query, size, format)
 
 
 if __name__ == "__main__":
@@ -1,58 +1,45 @@
 import json
+import logging
+import os
 import re
+from typing import Optional
 
-from rich import print
+from ai.cache import TTLCache
+from ai.dish_analysis import rating_key, ratings_cache
+from ai.resilience import ModelUnavailable, fallback
+from ai.singleflight import flights
+from ai.tracing import traced
+from ai.utils import build_user_profile, generate_content, generate_content_async
 
-from ai.utils import gemini, build_user_profile
+# (canonical profile, ingredient) -> full analysis with rating and hints.
+analysis_cache = TTLCache(
+    "ingredient_analysis",
+    maxsize=int(os.environ.get("RATING_CACHE_SIZE", "50000")),
+    ttl=float(os.environ.get("RATING_CACHE_TTL", str(30 * 24 * 3600))),
+)
 
 
-def analyze_ingredient(ingredient: str, user_profile: dict) -> dict:
-    """
-    Analyze a single ingredient and return a rating and explanation.
-
-    Args:
-        ingredient (str): The ingredient to analyze.
-        user_profile (dict): The user's intolerance profile.
-
-    Returns:
-        dict: A dictionary containing the analysis results.
-    """
-    # First, get a preliminary rating to decide on hint types
-    rating_prompt = (
-        f"Given the user's intolerance profile: \n\n {build_user_profile(user_profile)} \n\n, "
-        f"rate the compatibility of {ingredient} from 0 (problematic) to 100 (fully compatible). "
-        "Respond with only a number."
-    )
-    
-    rating_response = gemini().models.generate_content(
-        model="gemini-2.5-flash-preview-05-20",
-        contents=rating_prompt,
-        config={"response_modalities": ["TEXT"], "temperature": 0.0},
-    )
-    
-    preliminary_rating = 0
-    for part in rating_response.candidates[0].content.parts:
-        if part.text is not None:
-            try:
-                preliminary_rating = float(re.search(r'\d+\.?\d*', part.text).group())
-                break
-            except:
-                preliminary_rating = 0
-    
+def _analysis_prompt(ingredient: str, user_profile: dict, known_rating: Optional[float] = None) -> str:
     prompt = (
         f"Given the user's intolerance profile: \n\n {build_user_profile(user_profile)} \n\n, analyze the ingredient: {ingredient}. "
         "Provide a rating from 0 (problematic) to 100 (fully compatible). "
         "Also provide 1-2 helpful hints about this ingredient (maximum 3), each as a single sentence. "
         "Always include at least one 'Tip' hint about the ingredient or its use. "
     )
-    
-    # Add replacement instruction only if the ingredient has a bad rating (<40)
-    if preliminary_rating < 40:
+
+    # Ask for replacements only for badly rated ingredients (<40). Without a known rating
+    # the model applies the rule to its own rating, so no separate rating call is needed.
+    if known_rating is None:
+        prompt += (
+            "If your rating is below 40, the ingredient has compatibility issues: then also include an "
+            "'Alternative' or 'Replacement' hint suggesting suitable substitutes for this ingredient. "
+        )
+    elif known_rating < 40:
         prompt += (
             "Since this ingredient has compatibility issues, also include an 'Alternative' or 'Replacement' hint "
             "suggesting suitable substitutes for this ingredient. "
         )
-    
+
     prompt += (
         "Respond with a single JSON object with the following structure: "
         '{"overall_rating": float, "text": [{"keyword": "string", "text": "string"}]}. '
@@ -61,13 +48,10 @@ def analyze_ingredient(ingredient: str, user_profile: dict) -> dict:
         '{"overall_rating": 95.0, "text": [{"keyword": "Tip", "text": "This ingredient is best used in moderation."}, {"keyword": "Alternative", "text": "You can replace this with a lactose-free alternative."}]}. '
         "Do not include any other text or explanation."
     )
+    return prompt
 
-    response = gemini().models.generate_content(
-        model="gemini-2.5-flash-preview-05-20",
-        contents=prompt,
-        config={"response_modalities": ["TEXT"], "temperature": 0.0},
-    )
 
+def _parse_analysis(response) -> dict:
     for part in response.candidates[0].content.parts:
         if part.text is not None:
             try:
@@ -81,15 +65,115 @@ def analyze_ingredient(ingredient: str, user_profile: dict) -> dict:
                     else:
                         raise ValueError("Expected a JSON object with overall_rating and text fields.")
             except Exception as e:
-                print(f"Error parsing response: {e}")
+                logging.error(f"Error parsing response: {e}")
                 continue
+    return None
+
+
+def _known_rating(ingredient: str, user_profile: dict) -> Optional[float]:
+    # A rating from a dish analysis or batch search is enough to decide on replacement hints
+    rating = ratings_cache.get(rating_key(ingredient, user_profile))
+    return rating.get("rating") if rating is not None else None
+
+
+async def _known_rating_async(ingredient: str, user_profile: dict) -> Optional[float]:
+    rating = await ratings_cache.get_async(rating_key(ingredient, user_profile))
+    return rating.get("rating") if rating is not None else None
+
 
+def _store_analysis(ingredient: str, user_profile: dict, result: dict, known_rating: Optional[float]) -> Optional[dict]:
+    if result is None:
+        return None
+    key = rating_key(ingredient, user_profile)
+    analysis_cache.set(key, result)
+    if known_rating is None:
+        hints = [hint.get("text") for hint in result.get("text", []) if isinstance(hint, dict) and hint.get("text")]
+        ratings_cache.set(key, {"rating": result["overall_rating"], "explanation": hints[0] if hints else ""})
+    return result
+
+
+def _unusable_analysis(ingredient: str, rating: Optional[dict]) -> dict:
+    # The model answered in an unexpected format. fallback() marks the result degraded, so
+    # neither this cache nor the response cache keeps it and the next request asks again.
+    fallback("ingredient_analysis", ModelUnavailable(f"Unusable analysis of {ingredient}"))
     return {
-        "overall_rating": preliminary_rating, 
+        "overall_rating": rating.get("rating", 0) if rating is not None else 0,
         "text": [{"keyword": "Tip", "text": "Consider consulting with a nutritionist for personalized advice about this ingredient."}]
     }
 
 
+def _cached_rating_analysis(rating: Optional[dict], error: ModelUnavailable) -> dict:
+    # Without the model, a rating from a dish analysis or batch search is still a useful answer
+    if rating is None:
+        raise error
+    fallback("ingredient_analysis", error)
+    text = [{"keyword": "Tip", "text": rating["explanation"]}] if rating.get("explanation") else []
+    return {"overall_rating": rating.get("rating", 0), "text": text}
+
+
+@traced("ingredient_analysis")
+def analyze_ingredient(ingredient: str, user_profile: dict) -> dict:
+    """
+    Analyze a single ingredient and return a rating and explanation.
+
+    The rating and hints come from one model call. If the ingredient was already rated
+    for this profile (e.g. as part of a dish), that rating decides whether replacement
+    hints are requested; otherwise the model decides based on its own rating.
+
+    Args:
+        ingredient (str): The ingredient to analyze.
+        user_profile (dict): The user's intolerance profile.
+
+    Returns:
+        dict: A dictionary containing the analysis results. If the model is unavailable,
+        the cached rating without hints.
+    """
+    key = rating_key(ingredient, user_profile)
+    result = analysis_cache.get(key)
+    if result is not None:
+        return result
+
+    known_rating = _known_rating(ingredient, user_profile)
+    try:
+        response = generate_content(
+            model="gemini-2.5-flash-preview-05-20",
+            contents=_analysis_prompt(ingredient, user_profile, known_rating),
+            config={"response_modalities": ["TEXT"], "temperature": 0.0},
+        )
+    except ModelUnavailable as e:
+        return _cached_rating_analysis(ratings_cache.get(key), e)
+    result = _store_analysis(ingredient, user_profile, _parse_analysis(response), known_rating)
+    return result if result is not None else _unusable_analysis(ingredient, ratings_cache.get(key))
+
+
+@traced("ingredient_analysis")
+async def analyze_ingredient_async(ingredient: str, user_profile: dict) -> dict:
+    """
+    Async variant of analyze_ingredient.
+    """
+    key = rating_key(ingredient, user_profile)
+    result = await analysis_cache.get_async(key)
+    if result is not None:
+        return result
+
+    async def fetch():
+        known_rating = await _known_rating_async(ingredient, user_profile)
+        response = await generate_content_async(
+            model="gemini-2.5-flash-preview-05-20",
+            contents=_analysis_prompt(ingredient, user_profile, known_rating),
+            config={"response_modalities": ["TEXT"], "temperature": 0.0},
+        )
+        return _store_analysis(ingredient, user_profile, _parse_analysis(response), known_rating)
+
+    try:
+        result = await flights.do(("ingredient", key), fetch)
+    except ModelUnavailable as e:
+        return _cached_rating_analysis(await ratings_cache.get_async(key), e)
+    if result is None:
+        return _unusable_analysis(ingredient, await ratings_cache.get_async(key))
+    return result
+
+
 if __name__ == "__main__":
     # Example usage
     ingredient = "Chocolate"
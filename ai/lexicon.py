@@ -0,0 +1,155 @@
+import difflib
+import json
+import logging
+import os
+import threading
+import time
+import unicodedata
+from collections import Counter
+from typing import Dict, Optional, Set, Tuple
+
+from ai.cache import TTLCache
+from ai.utils import normalize_query
+
+LEXICON_PATH = os.getenv("FOOD_LEXICON_PATH", os.path.join(os.path.dirname(__file__), "data", "food_lexicon.json"))
+# Minimum similarity (0-1) of a fuzzy match, 0 disables fuzzy matching.
+FUZZY_THRESHOLD = float(os.getenv("FOOD_LEXICON_FUZZY", "0.85"))
+# Queries shorter than this are only matched exactly, too many short words are one edit apart.
+FUZZY_MIN_LENGTH = 5
+# Seconds a food learned from the model is trusted, as long as a cached safety verdict.
+LEARNED_TTL = float(os.getenv("SAFETY_CACHE_TTL", str(30 * 24 * 3600)))
+
+
+def _key(query: str) -> str:
+    # Fold accents so "käse" and "kase" share a key
+    decomposed = unicodedata.normalize("NFKD", normalize_query(query))
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def _trigrams(key: str) -> Set[str]:
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class FoodLexicon:
+    """
+    Local index of food names answering is_safe for known foods without a model call.
+
+    Names and synonyms (including non-English ones) map to the canonical singular English
+    food query and whether it is an ingredient. Queries are matched exactly on their
+    normalised key first, then fuzzily: candidates sharing character trigrams with the
+    query are ranked by edit similarity. Foods classified by the model are learned and
+    persisted, so repeated misses do not reach the model again; like cached safety
+    verdicts they expire after SAFETY_CACHE_TTL seconds and are then asked again.
+    """
+
+    def __init__(self, path: str = LEXICON_PATH, fuzzy_threshold: float = FUZZY_THRESHOLD):
+        self.fuzzy_threshold = fuzzy_threshold
+        self._entries: Dict[str, Tuple[str, bool]] = {}
+        self._grams: Dict[str, Set[str]] = {}
+        self._lock = threading.Lock()
+        # key -> time a learned food expires, seed foods never do
+        self._expires: Dict[str, float] = {}
+        self._learned = TTLCache("food_lexicon", maxsize=int(os.getenv("FOOD_LEXICON_SIZE", "50000")),
+                                 ttl=LEARNED_TTL)
+        self.exact_hits = 0
+        self.fuzzy_hits = 0
+        self.misses = 0
+
+        try:
+            with open(path, encoding="utf-8") as f:
+                seed = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error(f"Could not load food lexicon {path}: {e}")
+            seed = []
+        for entry in seed:
+            for name in [entry["name"], *entry.get("synonyms", [])]:
+                self._add(name, entry["name"], entry["is_ingredient"])
+        for key, (food_query, is_ingredient, *expires) in self._learned.items():
+            if key not in self._entries:
+                self._expires[key] = expires[0] if expires else time.time() + LEARNED_TTL
+            self._add(key, food_query, is_ingredient)
+
+    def _add(self, name: str, food_query: str, is_ingredient: bool):
+        key = _key(name)
+        if not key or key in self._entries:
+            return
+        self._entries[key] = (food_query, is_ingredient)
+        for gram in _trigrams(key):
+            self._grams.setdefault(gram, set()).add(key)
+
+    def _expire(self, key: str) -> bool:
+        """
+        Forget a learned food whose TTL has passed. Returns whether it was forgotten.
+        """
+        expires = self._expires.get(key)
+        if expires is None or expires >= time.time():
+            return False
+        del self._expires[key]
+        self._entries.pop(key, None)
+        for gram in _trigrams(key):
+            self._grams.get(gram, set()).discard(key)
+        return True
+
+    def _fuzzy(self, key: str) -> Optional[str]:
+        if self.fuzzy_threshold <= 0 or len(key) < FUZZY_MIN_LENGTH:
+            return None
+        grams = _trigrams(key)
+        shared = Counter(candidate for gram in grams for candidate in self._grams.get(gram, ()))
+        best, best_score = None, self.fuzzy_threshold
+        for candidate, _ in shared.most_common(10):
+            score = difflib.SequenceMatcher(None, key, candidate).ratio()
+            if score >= best_score:
+                best, best_score = candidate, score
+        return best
+
+    def lookup(self, query: str) -> Optional[Tuple[bool, str, bool]]:
+        """
+        Return (is_safe, food_query, is_ingredient) for a known food, or None.
+        """
+        key = _key(query)
+        with self._lock:
+            self._expire(key)
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.exact_hits += 1
+            else:
+                match = self._fuzzy(key)
+                entry = self._entries.get(match) if match and not self._expire(match) else None
+                if entry is not None:
+                    self.fuzzy_hits += 1
+                    logging.info(f"Lexicon matched '{query}' to '{match}'")
+                else:
+                    self.misses += 1
+        if entry is None:
+            return None
+        food_query, is_ingredient = entry
+        return True, food_query, is_ingredient
+
+    def learn(self, query: str, food_query: str, is_ingredient: bool):
+        """
+        Add a food classified by the model under both the query and its canonical name.
+        """
+        expires = time.time() + LEARNED_TTL
+        with self._lock:
+            for name in (query, food_query):
+                key = _key(name)
+                if key and key not in self._entries:
+                    self._add(key, food_query, is_ingredient)
+                    self._expires[key] = expires
+                    self._learned.set(key, [food_query, is_ingredient, expires])
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.exact_hits + self.fuzzy_hits + self.misses
+            return {
+                "name": "food_lexicon",
+                "exact_hits": self.exact_hits,
+                "fuzzy_hits": self.fuzzy_hits,
+                "misses": self.misses,
+                "hit_rate": (self.exact_hits + self.fuzzy_hits) / lookups if lookups else 0.0,
+                "size": len(self._entries),
+            }
+
+
+lexicon = FoodLexicon()
@@ -0,0 +1,74 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, Optional, Sequence, Tuple
+
+
+@dataclass
+class Step:
+    """
+    A node in an analysis graph.
+
+    The step's function is awaited with the results of its required steps as keyword
+    arguments, named after those steps.
+    """
+
+    name: str
+    func: Callable[..., Awaitable]
+    requires: Sequence[str] = field(default_factory=tuple)
+
+
+async def run_graph(
+    steps: Sequence[Step],
+    on_complete: Optional[Callable[[str, object, float], Awaitable]] = None,
+) -> Tuple[Dict[str, object], Dict[str, float]]:
+    """
+    Run a graph of steps, starting each one as soon as all of its inputs are available.
+
+    Args:
+        steps (Sequence[Step]): The steps of the graph.
+        on_complete: Optional coroutine called with (name, result, elapsed_ms) when a step finishes.
+
+    Returns:
+        Tuple[dict, dict]: The result of every step and its duration in milliseconds.
+    """
+    by_name = {step.name: step for step in steps}
+    for step in steps:
+        missing = [name for name in step.requires if name not in by_name]
+        if missing:
+            raise ValueError(f"Step {step.name} requires unknown steps: {missing}")
+
+    tasks: Dict[str, asyncio.Task] = {}
+    timings: Dict[str, float] = {}
+
+    async def run(step: Step):
+        inputs = {name: await tasks[name] for name in step.requires}
+        start = time.perf_counter()
+        result = await step.func(**inputs)
+        timings[step.name] = (time.perf_counter() - start) * 1000
+        if on_complete is not None:
+            await on_complete(step.name, result, timings[step.name])
+        return result
+
+    # Tasks are created in dependency order, so every awaited input already exists.
+    pending = list(steps)
+    while pending:
+        ready = [step for step in pending if all(name in tasks for name in step.requires)]
+        if not ready:
+            raise ValueError(f"Cycle in steps: {[step.name for step in pending]}")
+        for step in ready:
+            tasks[step.name] = asyncio.create_task(run(step))
+            pending.remove(step)
+
+    try:
+        results = await asyncio.gather(*tasks.values())
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        raise
+
+    logging.info(
+        "Step timings: " + ", ".join(f"{name}={ms:.0f}ms" for name, ms in timings.items())
+    )
+    return dict(zip(tasks.keys(), results)), timings
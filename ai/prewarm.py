@@ -0,0 +1,283 @@
+import argparse
+import asyncio
+import atexit
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+from ai.blob_index import blob_index
+from ai.cache import TTLCache
+from ai.dish_analysis import (
+    _split_cached_ratings_async,
+    get_common_ingredients_async,
+    get_ingredients_rating_async,
+    ingredients_cache,
+    rating_key,
+)
+from ai.image_gen import find_image_url, get_image_url_async
+from ai.ingredient_analysis import analysis_cache, analyze_ingredient_async
+from ai.safety import is_safe_async, known_verdict_async
+from ai.scheduler import BACKGROUND, priority
+from ai.upload_queue import upload_queue
+from ai.utils import canonical_profile, normalize_food_name, normalize_query
+
+SEED_PATH = os.getenv("PREWARM_SEED", os.path.join(os.path.dirname(__file__), "data", "prewarm_seed.json"))
+# Intolerance sets always warmed in addition to the most frequently observed ones.
+PREWARM_PROFILES = [
+    profile.split("+")
+    for profile in os.getenv("PREWARM_PROFILES", "lactose,fructose,gluten,histamine").split(",")
+    if profile
+]
+PREWARM_TOP_N = int(os.getenv("PREWARM_TOP_N", "50"))
+PREWARM_TOP_PROFILES = int(os.getenv("PREWARM_TOP_PROFILES", "5"))
+# Model calls allowed per run and per minute, and how long a run may take in seconds.
+PREWARM_MAX_CALLS = int(os.getenv("PREWARM_MAX_CALLS", "200"))
+PREWARM_RATE = float(os.getenv("PREWARM_RATE", "30"))
+# The default fits the 60s function limit of the Vercel cron invocation.
+PREWARM_TIME_BUDGET = float(os.getenv("PREWARM_TIME_BUDGET", "50"))
+PREWARM_CONCURRENCY = int(os.getenv("PREWARM_CONCURRENCY", "2"))
+
+# Observed searches: normalised query -> {"query", "count"}, intolerance set -> {"intolerances", "count"}.
+query_counts = TTLCache("query_counts", maxsize=10000, ttl=float(os.getenv("PREWARM_HISTORY_TTL", str(14 * 24 * 3600))))
+profile_counts = TTLCache("profile_counts", maxsize=1000, ttl=float(os.getenv("PREWARM_HISTORY_TTL", str(14 * 24 * 3600))))
+# Seconds searches are counted in memory before they are added to the counters above.
+RECORD_FLUSH_INTERVAL = 5.0
+
+# Counts not yet added to query_counts and profile_counts: key -> entry with the count delta
+_pending: Dict[str, Dict[str, dict]] = {"query_counts": {}, "profile_counts": {}}
+_pending_lock = threading.Lock()
+# Serialises flushes, so concurrent ones do not lose each other's increments
+_flush_lock = threading.Lock()
+_flush_timer: Optional[threading.Timer] = None
+
+
+def _buffer(counts: Dict[str, dict], key: str, value: dict):
+    entry = counts.setdefault(key, {**value, "count": 0})
+    entry["count"] += 1
+
+
+def record_query(query: str, user_profile: dict):
+    """
+    Count a search so the most frequent queries and profiles are pre-warmed.
+
+    Only updates an in-memory buffer; a background thread adds it to the persistent
+    counters every RECORD_FLUSH_INTERVAL seconds (see flush_counts).
+    """
+    global _flush_timer
+    key = normalize_query(query)
+    intolerances, _ = canonical_profile(user_profile)
+    with _pending_lock:
+        if key:
+            _buffer(_pending["query_counts"], key, {"query": query.strip()})
+        if intolerances:
+            _buffer(_pending["profile_counts"], ",".join(intolerances), {"intolerances": list(intolerances)})
+        if _flush_timer is None:
+            _flush_timer = threading.Timer(RECORD_FLUSH_INTERVAL, flush_counts)
+            _flush_timer.daemon = True
+            _flush_timer.start()
+
+
+def flush_counts():
+    """
+    Add the buffered search counts to query_counts and profile_counts.
+    """
+    global _flush_timer
+    with _flush_lock:
+        with _pending_lock:
+            pending = dict(_pending)
+            for name in _pending:
+                _pending[name] = {}
+            _flush_timer = None
+        for cache in (query_counts, profile_counts):
+            for key, delta in pending[cache.name].items():
+                entry = cache.get(key) or {**delta, "count": 0}
+                entry["count"] += delta["count"]
+                cache.set(key, entry)
+
+
+# Runs before the caches are written to disk at exit, atexit handlers run in reverse order
+atexit.register(flush_counts)
+
+
+def _load_seed(path: str = SEED_PATH) -> List[str]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.error(f"Could not load pre-warm seed {path}: {e}")
+        return []
+
+
+def _top_queries(top_n: int) -> List[tuple]:
+    # Seed queries count as searched once, so observed traffic outranks them
+    counts = {normalize_query(query): (query, 1) for query in _load_seed()}
+    for key, entry in query_counts.items():
+        seeded = counts.get(key, (entry["query"], 0))
+        counts[key] = (seeded[0], seeded[1] + entry["count"])
+    ranked = sorted(counts.values(), key=lambda item: -item[1])
+    return ranked[:top_n]
+
+
+def _top_profiles(top_n: int) -> List[dict]:
+    profiles = {",".join(sorted(p)): p for p in PREWARM_PROFILES}
+    observed = sorted(profile_counts.items(), key=lambda item: -item[1]["count"])
+    for key, entry in observed[:top_n]:
+        profiles.setdefault(key, entry["intolerances"])
+    return [{"intolerances": list(intolerances), "notes": ""} for intolerances in profiles.values()]
+
+
+class Budget:
+    """
+    Rate and total budget of model calls for one pre-warm run.
+    """
+
+    def __init__(self, max_calls: int, rate: float, time_budget: float):
+        self.max_calls = max_calls
+        self.interval = 60.0 / rate if rate > 0 else 0.0
+        self.deadline = time.monotonic() + time_budget
+        self.calls = 0
+        self._next = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    @property
+    def exhausted(self) -> bool:
+        return self.calls >= self.max_calls or time.monotonic() >= self.deadline
+
+    async def acquire(self, calls: int = 1) -> bool:
+        """
+        Wait until calls more model calls may start. Returns False if the budget is used up.
+        """
+        async with self._lock:
+            if self.calls + calls > self.max_calls:
+                return False
+            delay = self._next - time.monotonic()
+            if time.monotonic() + max(delay, 0) >= self.deadline:
+                return False
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.calls += calls
+            self._next = max(self._next, time.monotonic()) + self.interval * calls
+            return True
+
+
+async def prewarm(top_n: int = PREWARM_TOP_N, max_calls: int = PREWARM_MAX_CALLS, rate: float = PREWARM_RATE,
+                  time_budget: float = PREWARM_TIME_BUDGET, concurrency: int = PREWARM_CONCURRENCY) -> dict:
+    """
+    Fill the caches for the most popular foods ahead of demand.
+
+    Candidates are the seed list plus observed searches, ranked by frequency. For each
+    food, in priority order, the safety verdict, the stored image and, for the most
+    common intolerance sets, the ingredient analysis (ingredients) or the ingredient
+    breakdown and ratings (dishes) are produced if they are missing. Steps that are
+    already cached cost nothing; the others wait for the rate budget and the run stops
+    when the call or time budget is used up.
+
+    The overall rating and hints of a dish depend on its rated ingredients and are not
+    cached on their own, so they are not pre-warmed; a dish search still asks for them.
+
+    Returns:
+        dict: Counts of warmed, already cached and skipped steps and the model calls made.
+    """
+    budget = Budget(max_calls, rate, time_budget)
+    await asyncio.to_thread(flush_counts)
+    # Index blobs uploaded by other instances or out of band before looking for images
+    try:
+        await asyncio.to_thread(blob_index.refresh)
+    except Exception as e:
+        logging.error(f"Blob index refresh failed: {e}")
+    profiles = _top_profiles(PREWARM_TOP_PROFILES)
+    stats = {"foods": 0, "warmed": 0, "cached": 0, "skipped": 0, "failed": 0}
+
+    # (-priority, sequence, step, food) with the most searched foods first
+    queue = []
+    for sequence, (query, count) in enumerate(_top_queries(top_n)):
+        heapq.heappush(queue, (-count, sequence, "safety", query))
+    sequence = len(queue)
+
+    async def names(food: str) -> List[str]:
+        return list((await get_common_ingredients_async(food)).keys())
+
+    async def cost(step: str, food: str, is_ingredient: Optional[bool]) -> int:
+        # Model calls a step needs, 0 if everything it produces is cached already
+        if step == "safety":
+            return 0 if await known_verdict_async(food) is not None else 1
+        if step == "ingredients":
+            return 0 if await ingredients_cache.get_async(normalize_food_name(food)) is not None else 1
+        if step == "ratings":
+            items = await names(food)
+            missing = await asyncio.gather(*(_split_cached_ratings_async(items, profile) for profile in profiles))
+            return sum(1 for _, uncached in missing if uncached)
+        if step == "analysis":
+            cached = await asyncio.gather(*(analysis_cache.get_async(rating_key(food, profile)) for profile in profiles))
+            return sum(1 for analysis in cached if analysis is None)
+        if step == "image":
+            return 0 if await asyncio.to_thread(find_image_url, food) is not None else 1
+        return 0
+
+    async def run_step(step: str, food: str, is_ingredient: Optional[bool]) -> list:
+        if step == "safety":
+            safe, food_query, is_ingredient = await is_safe_async(food)
+            if not safe:
+                return []
+            stats["foods"] += 1
+            # Ingredient searches read the full analysis, dish searches the ingredient ratings
+            return [("analysis" if is_ingredient else "ingredients", food_query, is_ingredient),
+                    ("image", food_query, is_ingredient)]
+        if step == "ingredients":
+            ingredients = await get_common_ingredients_async(food)
+            return [("ratings", food, is_ingredient)] if ingredients else []
+        if step == "ratings":
+            items = await names(food)
+            for profile in profiles:
+                await get_ingredients_rating_async(items, profile)
+        elif step == "analysis":
+            for profile in profiles:
+                await analyze_ingredient_async(food, profile)
+        elif step == "image":
+            await get_image_url_async(food)
+        return []
+
+    async def worker():
+        nonlocal sequence
+        while queue and not budget.exhausted:
+            priority, _, step, item = heapq.heappop(queue)
+            food, is_ingredient = item if isinstance(item, tuple) else (item, None)
+            try:
+                calls = await cost(step, food, is_ingredient)
+                if calls == 0 and step == "image":
+                    stats["cached"] += 1
+                    continue
+                if calls and not await budget.acquire(calls):
+                    stats["skipped"] += 1
+                    continue
+                for follow_step, follow_food, follow_is_ingredient in await run_step(step, food, is_ingredient):
+                    sequence += 1
+                    heapq.heappush(queue, (priority, sequence, follow_step, (follow_food, follow_is_ingredient)))
+                stats["warmed" if calls else "cached"] += 1
+            except Exception as e:
+                stats["failed"] += 1
+                logging.error(f"Pre-warm {step} of {food} failed: {e}")
+
+    # Interactive searches go first when both wait for the same model
+    with priority(BACKGROUND):
+        await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    stats["skipped"] += len(queue)
+    # Images are uploaded in the background, let them finish within the time budget
+    await asyncio.to_thread(upload_queue.flush, max(0.0, budget.deadline - time.monotonic()))
+    stats["calls"] = budget.calls
+    logging.info(f"Pre-warm finished: {stats}")
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fill the caches for the most popular foods.")
+    parser.add_argument("--top", type=int, default=PREWARM_TOP_N)
+    parser.add_argument("--max-calls", type=int, default=PREWARM_MAX_CALLS)
+    parser.add_argument("--rate", type=float, default=PREWARM_RATE, help="Model calls per minute")
+    parser.add_argument("--time-budget", type=float, default=PREWARM_TIME_BUDGET)
+    args = parser.parse_args()
+    print(asyncio.run(prewarm(args.top, args.max_calls, args.rate, args.time_budget)))
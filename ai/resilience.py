@@ -0,0 +1,353 @@
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from ai.scheduler import admission
+from ai.startup import lazy_import
+from ai.tracing import current_span, metrics
+
+types = lazy_import("google.genai.types")
+
+# Seconds a stage may take from its start, including time queued in the scheduler. Can be
+# overridden with STAGE_DEADLINES="safety=5,hints=15".
+STAGE_DEADLINES = {
+    "safety": 10.0,
+    "safety_batch": 30.0,
+    "ingredients": 15.0,
+    "ingredients_batch": 30.0,
+    "ratings": 15.0,
+    "overall": 10.0,
+    "hints": 25.0,
+    "dish_analysis": 30.0,
+    "ingredient_analysis": 25.0,
+    "image_generation": 60.0,
+    "tips": 30.0,
+}
+for _entry in filter(None, os.getenv("STAGE_DEADLINES", "").split(",")):
+    _stage, _, _seconds = _entry.partition("=")
+    STAGE_DEADLINES[_stage.strip()] = float(_seconds)
+
+# Temperature-0 calls still running after the HEDGE_QUANTILE latency of their model get a
+# second, identical request; the first answer wins. At most HEDGE_MAX_RATIO of a model's
+# calls are hedged, and only once HEDGE_MIN_SAMPLES latencies are known.
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "1") == "1"
+HEDGE_QUANTILE = float(os.getenv("HEDGE_QUANTILE", "0.95"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_MAX_RATIO = float(os.getenv("HEDGE_MAX_RATIO", "0.1"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.2"))
+
+# Consecutive failures that open a model's circuit breaker, and seconds until it lets a probe call through.
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))
+
+# Detail returned to clients when a model is unavailable and no fallback could answer.
+MODEL_UNAVAILABLE_DETAIL = "The analysis is temporarily unavailable, please try again shortly."
+
+_fallbacks: contextvars.ContextVar = contextvars.ContextVar("fallbacks", default=None)
+
+
+class ModelUnavailable(RuntimeError):
+    """
+    A model could not give a usable answer in time: the call failed or missed its
+    deadline, the model's circuit breaker is open or the answer was unusable.
+
+    Args:
+        message (str): What was unavailable.
+        retry_after (float): Seconds after which trying again makes sense.
+    """
+
+    def __init__(self, message: str, retry_after: float = 0.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(ModelUnavailable):
+    """
+    A model call did not finish within the deadline of its stage or the model's timeout.
+    """
+
+
+class CircuitBreaker:
+    """
+    Closed while a model works; opens after BREAKER_FAILURES consecutive failures so calls
+    fail fast instead of piling up, and after BREAKER_COOLDOWN lets one probe call through
+    (half-open) whose outcome closes or re-opens it.
+    """
+
+    def __init__(self, name: str, failures: int = BREAKER_FAILURES, cooldown: float = BREAKER_COOLDOWN):
+        self.name = name
+        self.max_failures = failures
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """
+        Whether a call may be made now. In the half-open state only one probe is allowed.
+        """
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open":
+                if time.monotonic() - self.opened < self.cooldown:
+                    return False
+                self.state = "half_open"
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def retry_after(self) -> float:
+        with self._lock:
+            return max(0.0, self.cooldown - (time.monotonic() - self.opened)) if self.state != "closed" else 0.0
+
+    def success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._probing = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == "half_open" or self.failures >= self.max_failures:
+                if self.state != "open":
+                    logging.warning(f"Circuit breaker of {self.name} opened after {self.failures} failures")
+                self.state = "open"
+                self.opened = time.monotonic()
+
+    def abandon(self):
+        """
+        Forget a call that was cancelled by its caller, without counting it either way.
+        """
+        with self._lock:
+            self._probing = False
+
+
+class LatencyWindow:
+    """
+    The most recent latencies of a model.
+    """
+
+    def __init__(self, size: int = 200):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        with self._lock:
+            if len(self._samples) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Resilience:
+    """
+    Deadlines, hedging and circuit breakers around model calls (see generate_content).
+    """
+
+    def __init__(self):
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._latencies: Dict[str, LatencyWindow] = {}
+        self._calls: Dict[str, int] = {}
+        self._hedges: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        with self._lock:
+            if model not in self._breakers:
+                self._breakers[model] = CircuitBreaker(model)
+                self._latencies[model] = LatencyWindow()
+            return self._breakers[model]
+
+    def timeout(self, model: str, model_timeout: float) -> float:
+        """
+        Return the seconds a call may take: the model's timeout, or less if the deadline of
+        the current stage is nearer. Raises DeadlineExceeded if the deadline has passed.
+        """
+        span = current_span()
+        deadline = STAGE_DEADLINES.get(span.name) if span is not None else None
+        if deadline is None:
+            return model_timeout
+        remaining = deadline - (time.perf_counter() - span.start)
+        if remaining <= 0:
+            self._deadline_exceeded(model, span.name)
+            raise DeadlineExceeded(f"The {span.name} stage exceeded its {deadline:.0f}s deadline")
+        return min(model_timeout, remaining)
+
+    def _deadline_exceeded(self, model: str, stage: Optional[str]):
+        metrics.inc("eatsafe_model_deadline_exceeded_total", "Model calls that missed their deadline.",
+                    model=model, stage=stage or "other")
+
+    def _queue_timeout(self, model: str, stage: Optional[str]):
+        metrics.inc("eatsafe_model_queue_timeouts_total",
+                    "Model calls that missed their deadline while queued in the scheduler.",
+                    model=model, stage=stage or "other")
+
+    def _admit(self, model: str) -> CircuitBreaker:
+        breaker = self.breaker(model)
+        if not breaker.allow():
+            metrics.inc("eatsafe_model_breaker_rejections_total", "Model calls rejected by an open circuit breaker.",
+                        model=model)
+            raise ModelUnavailable(f"{model} is unavailable", retry_after=breaker.retry_after())
+        with self._lock:
+            self._calls[model] = self._calls.get(model, 0) + 1
+        return breaker
+
+    def _succeeded(self, model: str, breaker: CircuitBreaker, start: float):
+        breaker.success()
+        self._latencies[model].add(time.perf_counter() - start)
+
+    def call(self, model: str, fn: Callable[[], object]):
+        """
+        Make a blocking model call through the model's circuit breaker.
+        The deadline is enforced by the request timeout passed to the client.
+        """
+        breaker = self._admit(model)
+        start = time.perf_counter()
+        with admission() as admitted:
+            try:
+                response = fn()
+            except Exception as e:
+                # Only calls that reached the model say something about its health
+                if admitted.started:
+                    breaker.failure()
+                else:
+                    breaker.abandon()
+                raise ModelUnavailable(f"{model} failed: {e}") from e
+        self._succeeded(model, breaker, start)
+        return response
+
+    async def call_async(self, model: str, config: types.GenerateContentConfig,
+                         fn: Callable[[], Awaitable], timeout: float):
+        """
+        Make a model call through the model's circuit breaker, cancel it after timeout
+        seconds and hedge it if it is idempotent and slow.
+
+        Only failures and timeouts of calls that got a scheduler slot count against the
+        breaker. A call whose deadline passes while it is still queued is shed: it raises
+        DeadlineExceeded as well, but is counted as a queue timeout, not a model failure.
+        """
+        breaker = self._admit(model)
+        start = time.perf_counter()
+        with admission() as admitted:
+            try:
+                response = await asyncio.wait_for(self._hedged(model, config, fn), timeout)
+            except asyncio.TimeoutError:
+                span = current_span()
+                stage = span.name if span is not None else None
+                if admitted.started:
+                    breaker.failure()
+                    self._deadline_exceeded(model, stage)
+                    raise DeadlineExceeded(f"{model} did not answer within {timeout:.2f}s")
+                breaker.abandon()
+                self._queue_timeout(model, stage)
+                raise DeadlineExceeded(f"{model} had no free slot within {timeout:.2f}s")
+            except asyncio.CancelledError:
+                breaker.abandon()
+                raise
+            except Exception as e:
+                if admitted.started:
+                    breaker.failure()
+                else:
+                    breaker.abandon()
+                raise ModelUnavailable(f"{model} failed: {e}") from e
+        self._succeeded(model, breaker, start)
+        return response
+
+    def _hedge_delay(self, model: str, config: types.GenerateContentConfig) -> Optional[float]:
+        if not HEDGE_ENABLED or config.temperature != 0:
+            return None
+        with self._lock:
+            if self._hedges.get(model, 0) >= HEDGE_MAX_RATIO * self._calls.get(model, 0):
+                return None
+        delay = self._latencies[model].quantile(HEDGE_QUANTILE)
+        return None if delay is None else max(delay, HEDGE_MIN_DELAY)
+
+    async def _hedged(self, model: str, config: types.GenerateContentConfig, fn: Callable[[], Awaitable]):
+        delay = self._hedge_delay(model, config)
+        if delay is None:
+            return await fn()
+        first = asyncio.ensure_future(fn())
+        tasks = [first]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                with self._lock:
+                    self._hedges[model] = self._hedges.get(model, 0) + 1
+                metrics.inc("eatsafe_model_hedges_total", "Hedged model calls.", model=model, outcome="sent")
+                tasks.append(asyncio.ensure_future(fn()))
+            pending, error = set(tasks), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            metrics.inc("eatsafe_model_hedges_total", "Hedged model calls.", model=model, outcome="won")
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def stats(self) -> dict:
+        """
+        Return the breaker state, call count, hedges and p95 latency per model.
+        """
+        with self._lock:
+            models = list(self._breakers)
+        return {
+            model: {
+                "state": self._breakers[model].state,
+                "calls": self._calls.get(model, 0),
+                "hedges": self._hedges.get(model, 0),
+                "p95": self._latencies[model].quantile(0.95),
+            }
+            for model in models
+        }
+
+
+resilience = Resilience()
+
+
+def fallback(stage: str, error: Exception):
+    """
+    Record that a stage answered with a cached or locally computed result because of error.
+    """
+    logging.warning(f"{stage} unavailable, using fallback: {error}")
+    metrics.inc("eatsafe_stage_fallbacks_total", "Stages answered by a fallback.", stage=stage)
+    stages = _fallbacks.get()
+    if stages is not None:
+        stages.append(stage)
+
+
+@contextmanager
+def track_fallbacks():
+    """
+    Collect the stages answered by a fallback in this context (and tasks created from it)
+    in the yielded list, e.g. to avoid caching a degraded result.
+    """
+    stages: List[str] = []
+    token = _fallbacks.set(stages)
+    try:
+        yield stages
+    finally:
+        _fallbacks.reset(token)
@@ -0,0 +1,159 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from ai.cache import TTLCache, remote_tier
+from ai.dish_analysis import DISH_SINGLE_CALL_MODEL
+from ai.tracing import trace_request
+
+# Seconds a cached response is served as is, and how long after that it is still served
+# while it is refreshed in the background (stale-while-revalidate).
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", str(24 * 3600)))
+RESPONSE_CACHE_STALE = float(os.environ.get("RESPONSE_CACHE_STALE", str(7 * 24 * 3600)))
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "20000"))
+
+# Version of everything that shapes a cached response: the prompts and model names of the
+# safety check, the dish, ingredient and image stages, build_user_profile and the food
+# lexicon. Bump it with any change to them so deploys never serve responses built by the
+# old ones. RESPONSE_CACHE_VERSION drops every cached response without a code change.
+PROMPT_VERSION = 3
+
+
+def _generation() -> str:
+    parts = [str(PROMPT_VERSION), os.environ.get("RESPONSE_CACHE_VERSION", ""), DISH_SINGLE_CALL_MODEL]
+    return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()[:12]
+
+
+def response_etag(value: dict) -> str:
+    """
+    Return a strong ETag for a JSON response body.
+    """
+    body = json.dumps(value, sort_keys=True, default=str).encode("utf-8")
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def etag_matches(etag: str, if_none_match: Optional[str]) -> bool:
+    """
+    Whether an If-None-Match header matches etag: "*" or a comma-separated list of entity
+    tags containing it. Weak tags (W/"...") are compared by their value, as RFC 9110 asks
+    for If-None-Match.
+    """
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag.removeprefix("W/"):
+            return True
+    return False
+
+
+class ResponseCache:
+    """
+    Cache of complete JSON responses with stale-while-revalidate.
+
+    Fresh entries are served as is. Stale entries are still served for RESPONSE_CACHE_STALE
+    seconds, but the caller refreshes them in the background (see revalidate). Keys start
+    with the cache generation, so responses built by older prompts or models are never
+    served after a deploy that changes them; they simply age out.
+
+    Args:
+        name (str): Name of the underlying TTLCache.
+        volatile (tuple): Fields that change on every rebuild (e.g. a timestamp). A refresh
+            that only changes these keeps the cached response, so its ETag stays valid.
+    """
+
+    def __init__(self, name: str, ttl: float = RESPONSE_CACHE_TTL, stale: float = RESPONSE_CACHE_STALE,
+                 generation: str = None, volatile: tuple = ()):
+        self.ttl = ttl
+        self.stale = stale
+        self.generation = generation or _generation()
+        self.volatile = volatile
+        self._entries = TTLCache(name, maxsize=RESPONSE_CACHE_SIZE, ttl=ttl + stale, remote=remote_tier())
+        self._revalidating: Dict[str, asyncio.Task] = {}
+
+    def key(self, *parts) -> str:
+        """
+        Return the cache key of a response identified by parts.
+        """
+        return "|".join([self.generation, *map(str, parts)])
+
+    def get(self, key: str) -> Optional[Tuple[dict, str, bool]]:
+        """
+        Return the cached (response, ETag, stale) for key, or None.
+        """
+        return self._unpack(self._entries.get(key))
+
+    async def get_async(self, key: str) -> Optional[Tuple[dict, str, bool]]:
+        """
+        Async variant of get, SQLite and remote lookups run in a worker thread.
+        """
+        return self._unpack(await self._entries.get_async(key))
+
+    def _unpack(self, entry: Optional[dict]) -> Optional[Tuple[dict, str, bool]]:
+        if entry is None:
+            return None
+        return entry["value"], entry["etag"], entry["fresh_until"] < time.time()
+
+    def set(self, key: str, value: dict, degraded: bool = False, previous: dict = None) -> str:
+        """
+        Cache a response and return its ETag.
+
+        A degraded response (e.g. the image is missing) is stale right away, so it is only
+        served until a refresh replaces it. When refreshing, pass the previous response so
+        it is kept if only its volatile fields changed.
+        """
+        etag, entry, ttl = self._pack(value, degraded, previous)
+        self._entries.set(key, entry, ttl=ttl)
+        return etag
+
+    async def set_async(self, key: str, value: dict, degraded: bool = False, previous: dict = None) -> str:
+        """
+        Async variant of set.
+        """
+        etag, entry, ttl = self._pack(value, degraded, previous)
+        await self._entries.set_async(key, entry, ttl=ttl)
+        return etag
+
+    def _pack(self, value: dict, degraded: bool, previous: Optional[dict]) -> Tuple[str, dict, Optional[float]]:
+        if previous is not None and self._stable(previous) == self._stable(value):
+            value = previous
+        etag = response_etag(value)
+        fresh_until = time.time() + (0 if degraded else self.ttl)
+        return etag, {"value": value, "etag": etag, "fresh_until": fresh_until}, self.stale if degraded else None
+
+    def _stable(self, value: dict) -> dict:
+        return {field: item for field, item in value.items() if field not in self.volatile}
+
+    def revalidate(self, key: str, refresh: Callable[[], Awaitable]):
+        """
+        Run refresh in the background to replace a stale entry, at most once per key at a time.
+        """
+        if key in self._revalidating:
+            return
+
+        async def run():
+            # Record the refresh in its own trace, not in the request that served the stale entry
+            with trace_request():
+                try:
+                    await refresh()
+                except Exception as e:
+                    logging.warning(f"Revalidation of cached response {key} failed: {e}")
+
+        task = asyncio.get_running_loop().create_task(run())
+        # Keep a reference until the task is done so it is not garbage collected
+        self._revalidating[key] = task
+        task.add_done_callback(lambda _: self._revalidating.pop(key, None))
+
+    def clear(self):
+        """
+        Drop every locally cached response.
+        """
+        self._entries.clear()
+
+
+# Complete /search responses, keyed by food, canonical profile and response mode.
+search_responses = ResponseCache("search_responses", volatile=("timestamp",))
@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from pydantic import BaseModel
+
+from ai.cache import LOCAL_CACHE_DIR
+from ai.startup import lazy_import
+
+types = lazy_import("google.genai.types")
+
+# "passthrough" disables the store, "record" stores every response and answers repeated
+# deterministic (temperature 0) prompts from it, "replay" answers every stored prompt
+# from it and records the rest.
+RESPONSE_STORE_MODE = os.getenv("RESPONSE_STORE_MODE", "passthrough")
+RESPONSE_STORE_DIR = os.getenv("RESPONSE_STORE_DIR", os.path.join(LOCAL_CACHE_DIR, "responses"))
+# In replay mode, fail on prompts that were never recorded instead of calling the model.
+RESPONSE_STORE_STRICT = os.getenv("RESPONSE_STORE_STRICT", "0") == "1"
+
+
+class ResponseStore:
+    """
+    Content-addressed store of raw model responses.
+
+    A response is stored as JSON under the sha256 of its model, contents and config
+    (without the transport options), one file per response, so recordings made by one
+    instance can be copied to seed another.
+    """
+
+    def __init__(self, path: str = RESPONSE_STORE_DIR):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model: str, contents, config: types.GenerateContentConfig) -> str:
+        """
+        Return the content address of a request.
+        """
+        schema = config.response_schema
+        if isinstance(schema, type) and issubclass(schema, BaseModel):
+            # Schema classes are not serialisable, their JSON Schema identifies them
+            schema = schema.model_json_schema()
+        elif isinstance(schema, BaseModel):
+            schema = schema.model_dump(mode="json", exclude_none=True)
+        request = {
+            "model": model,
+            "contents": contents if isinstance(contents, str) else json.dumps(contents, default=str),
+            "config": config.model_dump(mode="json", exclude_none=True, exclude={"http_options", "response_schema"}),
+            "response_schema": schema,
+        }
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], f"{key}.json")
+
+    def get(self, key: str):
+        """
+        Return the stored response for key, or None.
+        """
+        try:
+            with open(self._file(key), encoding="utf-8") as f:
+                response = types.GenerateContentResponse.model_validate_json(f.read())
+        except FileNotFoundError:
+            response = None
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable stored response {key}: {e}")
+            response = None
+        with self._lock:
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return response
+
+    def put(self, key: str, response: types.GenerateContentResponse):
+        """
+        Store a response under key.
+        """
+        file = self._file(key)
+        try:
+            os.makedirs(os.path.dirname(file), exist_ok=True)
+            # Write to a temporary file first so readers never see a partial response
+            tmp = f"{file}.{threading.get_ident()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(response.model_dump_json(exclude_none=True))
+            os.replace(tmp, file)
+        except OSError as e:
+            logging.warning(f"Could not store response {key}: {e}")
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "name": "responses",
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+def _deterministic(config: types.GenerateContentConfig) -> bool:
+    return config.temperature == 0
+
+
+class RecordReplayBackend:
+    """
+    Model backend answering from a ResponseStore before calling the wrapped backend.
+
+    Args:
+        backend: The backend that actually calls the model.
+        store (ResponseStore): Where responses are recorded and replayed from.
+        mode (str): "record" or "replay", see RESPONSE_STORE_MODE.
+        strict (bool): In replay mode, raise LookupError for prompts that were never recorded.
+    """
+
+    def __init__(self, backend, store: ResponseStore = None, mode: str = RESPONSE_STORE_MODE,
+                 strict: bool = RESPONSE_STORE_STRICT):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown response store mode: {mode}")
+        self.backend = backend
+        self.store = store or ResponseStore()
+        self.mode = mode
+        self.strict = strict
+
+    def _replayable(self, config: types.GenerateContentConfig) -> bool:
+        return self.mode == "replay" or _deterministic(config)
+
+    def _missing(self, model: str, key: str):
+        if self.mode == "replay" and self.strict:
+            raise LookupError(f"No recorded response for {model} request {key}")
+
+    def generate_content(self, model: str, contents, config: types.GenerateContentConfig):
+        key = self.store.key(model, contents, config)
+        if self._replayable(config):
+            response = self.store.get(key)
+            if response is not None:
+                return response
+            self._missing(model, key)
+        response = self.backend.generate_content(model, contents, config)
+        self.store.put(key, response)
+        return response
+
+    async def generate_content_async(self, model: str, contents, config: types.GenerateContentConfig):
+        key = self.store.key(model, contents, config)
+        if self._replayable(config):
+            response = await asyncio.to_thread(self.store.get, key)
+            if response is not None:
+                return response
+            self._missing(model, key)
+        response = await self.backend.generate_content_async(model, contents, config)
+        await asyncio.to_thread(self.store.put, key, response)
+        return response
@@ -1,32 +1,36 @@
+import asyncio
 import json
 import logging
 import os
 import re
-import time
-from typing import Tuple
+from typing import Dict, List, Optional, Tuple
 
-from google.genai import types
-from joblib import Memory
-
-from ai.utils import gemini
+from ai.cache import TTLCache, remote_tier
+from ai.lexicon import lexicon
+from ai.singleflight import flights
+from ai.tracing import traced
+from ai.utils import generate_content, generate_content_async, normalize_query
 
 logging.basicConfig(level=logging.INFO)
-memory = Memory(os.environ.get("LOCAL_CACHE_DIR", "local_cachedir"))
 
+# Verdicts keyed by the normalised query. Unsafe verdicts are kept for a shorter time.
+safety_cache = TTLCache(
+    "safety",
+    maxsize=int(os.environ.get("SAFETY_CACHE_SIZE", "20000")),
+    ttl=float(os.environ.get("SAFETY_CACHE_TTL", str(30 * 24 * 3600))),
+    remote=remote_tier(),
+)
+SAFETY_NEGATIVE_TTL = float(os.environ.get("SAFETY_NEGATIVE_TTL", str(24 * 3600)))
 
-@memory.cache
-def is_safe(search_term: str) -> Tuple[bool, str]:
-    """Check if the content is safe using Gemini API.
 
-    Args:
-        search_term (str): The content to check for safety.
+def _store_verdict(search_term: str, key: str, result: Tuple[bool, str, bool]):
+    safety_cache.set(key, list(result), ttl=None if result[0] else SAFETY_NEGATIVE_TTL)
+    if result[0]:
+        lexicon.learn(search_term, result[1], result[2])
 
-    Returns:
-        bool: True if the content is safe, False otherwise.
-    """
-    start_time = time.time()
 
-    content = (
+def _safety_prompt(search_term: str) -> str:
+    return (
         f"You have 2 tasks. First task is to check if the content is a food query. If not it is not safe. "
         f"Content: {search_term}. Second task is to return the food query in singular english form. "
         f'So for example "pizzas" return "pizza" and "Pommes" return "Potatoe Fries". '
@@ -37,13 +41,11 @@ def is_safe(search_term: str) -> Tuple[bool, str]:
         f"Answer only with the json object. Do not include any other text or explanation."
     )
 
-    response = gemini().models.generate_content(
-        model="gemini-2.0-flash",
-        contents=content,
-        config=types.GenerateContentConfig(
-            response_modalities=["TEXT"],
-        ),
-    )
+
+_SAFETY_CONFIG = {"response_modalities": ["TEXT"], "temperature": 0.0}
+
+
+def _parse_safety(response, search_term: str):
     for part in response.candidates[0].content.parts:
         if part.text is not None:
             try:
@@ -63,18 +65,200 @@ def is_safe(search_term: str) -> Tuple[bool, str]:
                         logging.info(
                             f"Content: {search_term}, Is Safe: {is_safe}, Food Query: {food_query}, Is Ingredient: {is_ingredient}"
                         )
-                        logging.info(
-                            f"Time taken: {time.time() - start_time:.2f} seconds"
-                        )
                         return is_safe, food_query, is_ingredient
                 else:
                     logging.error("No JSON object found in response.")
             except Exception as e:
                 logging.error(f"Error parsing response: {e}")
                 logging.error(f"Response text: {part.text}")
-                return False, ""
+                return None
     logging.error("No valid response received.")
-    return False, ""
+    return None
+
+
+@traced("safety")
+def is_safe(search_term: str) -> Tuple[bool, str, bool]:
+    """Check if the content is safe, using the local food lexicon or the Gemini API.
+
+    Args:
+        search_term (str): The content to check for safety.
+
+    Returns:
+        Tuple[bool, str, bool]: Whether the content is safe, the normalised food query
+        and whether it is an ingredient.
+    """
+    known = lexicon.lookup(search_term)
+    if known is not None:
+        return known
+    key = normalize_query(search_term)
+    cached = safety_cache.get(key)
+    if cached is not None:
+        return tuple(cached)
+
+    response = generate_content(
+        model="gemini-2.0-flash",
+        contents=_safety_prompt(search_term),
+        config=_SAFETY_CONFIG,
+    )
+    result = _parse_safety(response, search_term)
+    if result is None:
+        return False, "", False
+    _store_verdict(search_term, key, result)
+    return result
+
+
+@traced("safety")
+async def is_safe_async(search_term: str) -> Tuple[bool, str, bool]:
+    """Async variant of is_safe sharing the same cache."""
+    known = lexicon.lookup(search_term)
+    if known is not None:
+        return known
+    key = normalize_query(search_term)
+    cached = await safety_cache.get_async(key)
+    if cached is not None:
+        return tuple(cached)
+
+    async def fetch():
+        response = await generate_content_async(
+            model="gemini-2.0-flash",
+            contents=_safety_prompt(search_term),
+            config=_SAFETY_CONFIG,
+        )
+        result = _parse_safety(response, search_term)
+        if result is None:
+            return False, "", False
+        _store_verdict(search_term, key, result)
+        return result
+
+    return await flights.do(("safety", key), fetch)
+
+
+def _known_verdict(search_term: str) -> Optional[Tuple[bool, str, bool]]:
+    known = lexicon.lookup(search_term)
+    if known is not None:
+        return known
+    cached = safety_cache.get(normalize_query(search_term))
+    return tuple(cached) if cached is not None else None
+
+
+async def known_verdict_async(search_term: str) -> Optional[Tuple[bool, str, bool]]:
+    """
+    Return the verdict for a search term from the lexicon or the cache, or None if the
+    model has to be asked. Disk and remote cache lookups do not block the event loop.
+    """
+    known = lexicon.lookup(search_term)
+    if known is not None:
+        return known
+    cached = await safety_cache.get_async(normalize_query(search_term))
+    return tuple(cached) if cached is not None else None
+
+
+def _batch_safety_prompt(search_terms: List[str]) -> str:
+    return (
+        f"You get a JSON list of contents: {json.dumps(search_terms, ensure_ascii=False)}. "
+        f"For each content, first check if it is a food query. If not it is not safe. "
+        f"Then return the food query in singular english form. "
+        f'So for example "pizzas" return "pizza" and "Pommes" return "Potatoe Fries". '
+        f"Return only the english name in no other language. Keep the name short. "
+        f"Then decide if the food is an ingredient or a dish. A dish is a food that is prepared and served as a meal, while an ingredient is a substance used in the preparation of food. "
+        f'Return a JSON list with one object per content, in the same order, with the keys "content", "is_safe", "food_query" and "is_ingredient". '
+        f'For example: [{{"content": "pizzas", "is_safe": true, "food_query": "pizza", "is_ingredient": false}}] '
+        f"Answer only with the JSON list. Do not include any other text or explanation."
+    )
+
+
+def _match_batch_items(items: List[dict], search_terms: List[str]) -> Dict[str, Tuple[bool, str, bool]]:
+    """
+    Match the model's items to the search terms by their "content". Items are only matched
+    by position if the model answered every term, and never to a term another item names.
+    Terms without a matching item are left out, so they are neither cached nor learned.
+    """
+    by_content = {}
+    for item in items:
+        by_content.setdefault(normalize_query(str(item.get("content", ""))), item)
+    positional = len(items) == len(search_terms)
+    verdicts = {}
+    for index, search_term in enumerate(search_terms):
+        item = by_content.get(normalize_query(search_term))
+        if item is None and positional:
+            candidate = items[index]
+            content = normalize_query(str(candidate.get("content", "")))
+            if content not in map(normalize_query, search_terms):
+                item = candidate
+        if item is not None:
+            verdicts[search_term] = (bool(item["is_safe"]), item["food_query"], bool(item.get("is_ingredient", False)))
+    return verdicts
+
+
+def _parse_batch_safety(response, search_terms: List[str]) -> Dict[str, Tuple[bool, str, bool]]:
+    for part in response.candidates[0].content.parts:
+        if part.text is not None:
+            try:
+                match = re.search(r"\[.*\]", part.text, re.DOTALL)
+                if match:
+                    items = [
+                        item for item in json.loads(match.group(0))
+                        if isinstance(item, dict) and "is_safe" in item and "food_query" in item
+                    ]
+                    return _match_batch_items(items, search_terms)
+                logging.error("No JSON list found in batch safety response.")
+            except Exception as e:
+                logging.error(f"Error parsing batch safety response: {e}")
+                return {}
+    return {}
+
+
+def _resolve_batch(search_terms: List[str], verdicts: Dict[str, Tuple[bool, str, bool]],
+                   missing: List[str], answers: Dict[str, Tuple[bool, str, bool]]) -> List[Tuple[bool, str, bool]]:
+    for search_term in missing:
+        result = answers.get(search_term)
+        if result is not None:
+            _store_verdict(search_term, normalize_query(search_term), result)
+            verdicts[search_term] = result
+    # Terms the model did not answer are treated as unsafe and not cached
+    return [verdicts.get(search_term, (False, "", False)) for search_term in search_terms]
+
+
+@traced("safety_batch")
+def is_safe_batch(search_terms: List[str]) -> List[Tuple[bool, str, bool]]:
+    """Check many contents at once.
+
+    Known foods and cached verdicts are answered locally; all remaining contents are
+    classified by a single model call.
+
+    Args:
+        search_terms (List[str]): The contents to check.
+
+    Returns:
+        List[Tuple[bool, str, bool]]: One is_safe result per content, in order.
+    """
+    verdicts = {search_term: _known_verdict(search_term) for search_term in search_terms}
+    missing = list(dict.fromkeys(term for term, verdict in verdicts.items() if verdict is None))
+    answers = {}
+    if missing:
+        response = generate_content(
+            model="gemini-2.0-flash",
+            contents=_batch_safety_prompt(missing),
+            config=_SAFETY_CONFIG,
+        )
+        answers = _parse_batch_safety(response, missing)
+    return _resolve_batch(search_terms, verdicts, missing, answers)
+
+
+@traced("safety_batch")
+async def is_safe_batch_async(search_terms: List[str]) -> List[Tuple[bool, str, bool]]:
+    """Async variant of is_safe_batch sharing the same cache."""
+    verdicts = dict(zip(search_terms, await asyncio.gather(*map(known_verdict_async, search_terms))))
+    missing = list(dict.fromkeys(term for term, verdict in verdicts.items() if verdict is None))
+    answers = {}
+    if missing:
+        response = await generate_content_async(
+            model="gemini-2.0-flash",
+            contents=_batch_safety_prompt(missing),
+            config=_SAFETY_CONFIG,
+        )
+        answers = _parse_batch_safety(response, missing)
+    return _resolve_batch(search_terms, verdicts, missing, answers)
 
 
 if __name__ == "__main__":
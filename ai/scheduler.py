@@ -0,0 +1,293 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict, Tuple
+
+# Priority classes, lower runs first.
+INTERACTIVE = 0
+BATCH = 1
+BACKGROUND = 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BATCH: "batch", BACKGROUND: "background"}
+
+_priority: contextvars.ContextVar = contextvars.ContextVar("model_call_priority", default=INTERACTIVE)
+_admission: contextvars.ContextVar = contextvars.ContextVar("model_call_admission", default=None)
+
+# (max concurrent calls, max calls per minute) per model. Can be overridden with
+# GEMINI_LIMITS="gemini-2.0-flash-exp-image-generation=2:10,gemini-2.0-flash=32:2000".
+DEFAULT_LIMITS = (
+    int(os.getenv("GEMINI_DEFAULT_CONCURRENCY", "8")),
+    float(os.getenv("GEMINI_DEFAULT_RPM", "600")),
+)
+MODEL_LIMITS = {
+    "gemini-2.0-flash-lite": (32, 4000.0),
+    "gemini-2.0-flash": (32, 2000.0),
+    "gemini-2.5-flash-preview-05-20": (8, 1000.0),
+    "gemini-2.0-flash-exp-image-generation": (4, 60.0),
+}
+for _entry in filter(None, os.getenv("GEMINI_LIMITS", "").split(",")):
+    _model, _, _limits = _entry.partition("=")
+    _concurrency, _, _rpm = _limits.partition(":")
+    MODEL_LIMITS[_model.strip()] = (int(_concurrency), float(_rpm or DEFAULT_LIMITS[1]))
+
+
+@contextmanager
+def priority(level: int):
+    """
+    Run model calls made in this context (and tasks created from it) at the given priority.
+    """
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def set_priority(level: int):
+    """
+    Set the priority of model calls for the rest of the current context, e.g. a request handler.
+    """
+    _priority.set(level)
+
+
+class Admission:
+    """
+    Whether a model call got a scheduler slot, i.e. was sent to the model (see admission).
+    """
+    __slots__ = ("started",)
+
+    def __init__(self):
+        self.started = False
+
+
+@contextmanager
+def admission():
+    """
+    Yield an Admission that records whether a model call made in this context (or a task
+    created from it) got a slot, so a caller can tell time spent queued from time spent
+    waiting for the model.
+    """
+    marker = Admission()
+    token = _admission.set(marker)
+    try:
+        yield marker
+    finally:
+        _admission.reset(token)
+
+
+class _Waiter:
+    __slots__ = ("wake",)
+
+    def __init__(self, wake):
+        self.wake = wake
+
+
+class _ModelQueue:
+    """
+    Concurrency limit, token bucket and priority queue of one model.
+    """
+
+    def __init__(self, concurrency: int, rpm: float):
+        self.concurrency = concurrency
+        self.rate = rpm / 60.0
+        self.capacity = float(max(1, concurrency))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.active = 0
+        self.waiters = []
+        self.started = 0
+        self.queue_time = {}
+        self.max_queue_time = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_start(self, entry: tuple):
+        """
+        Start the waiter if it is first in line and a slot and a token are free.
+
+        Returns:
+            0 if started, the seconds until the next token if only the rate limit blocks,
+            or None if the waiter has to wait to be woken.
+        """
+        if self.waiters[0] is not entry or self.active >= self.concurrency:
+            return None
+        self._refill()
+        if self.tokens < 1:
+            return (1 - self.tokens) / self.rate if self.rate > 0 else None
+        self.tokens -= 1
+        self.active += 1
+        heapq.heappop(self.waiters)
+        return 0
+
+    def wake_head(self):
+        if self.waiters and self.active < self.concurrency:
+            self.waiters[0][2].wake()
+
+    def remove(self, entry: tuple):
+        if entry in self.waiters:
+            self.waiters.remove(entry)
+            heapq.heapify(self.waiters)
+
+
+class Scheduler:
+    """
+    Central admission control for outbound model calls.
+
+    Every model has a concurrency limit and a token-bucket rate limit (MODEL_LIMITS).
+    Calls that cannot start wait in a per-model priority queue: interactive searches go
+    before batch work, which goes before background work such as pre-warming; within a
+    class calls start in arrival order. Works for async callers and for threads.
+    """
+
+    def __init__(self, limits: Dict[str, Tuple[int, float]] = None):
+        self.limits = dict(MODEL_LIMITS if limits is None else limits)
+        self._queues: Dict[str, _ModelQueue] = {}
+        self._lock = threading.Lock()
+        self._sequence = itertools.count()
+
+    def _queue(self, model: str) -> _ModelQueue:
+        queue = self._queues.get(model)
+        if queue is None:
+            queue = self._queues[model] = _ModelQueue(*self.limits.get(model, DEFAULT_LIMITS))
+        return queue
+
+    def _enqueue(self, model: str, wake) -> Tuple[_ModelQueue, tuple]:
+        level = _priority.get()
+        entry = (level, next(self._sequence), _Waiter(wake))
+        with self._lock:
+            queue = self._queue(model)
+            heapq.heappush(queue.waiters, entry)
+        return queue, entry
+
+    def _started(self, queue: _ModelQueue, entry: tuple, enqueued: float):
+        waited = time.monotonic() - enqueued
+        queue.started += 1
+        count, total = queue.queue_time.get(entry[0], (0, 0.0))
+        queue.queue_time[entry[0]] = (count + 1, total + waited)
+        queue.max_queue_time = max(queue.max_queue_time, waited)
+        marker = _admission.get()
+        if marker is not None:
+            marker.started = True
+        if waited > 1:
+            logging.info(f"Model call waited {waited:.2f}s in the queue")
+        # The next waiter may be able to start too
+        queue.wake_head()
+
+    def _release(self, model: str):
+        with self._lock:
+            queue = self._queue(model)
+            queue.active -= 1
+            queue.wake_head()
+
+    def _abandon(self, queue: _ModelQueue, entry: tuple):
+        with self._lock:
+            queue.remove(entry)
+            queue.wake_head()
+
+    @asynccontextmanager
+    async def slot(self, model: str):
+        """
+        Wait for a free slot of the model and hold it for the duration of the block.
+        """
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        queue, entry = self._enqueue(model, lambda: loop.call_soon_threadsafe(event.set))
+        enqueued = time.monotonic()
+        try:
+            while True:
+                with self._lock:
+                    delay = queue.try_start(entry)
+                    if delay == 0:
+                        self._started(queue, entry, enqueued)
+                        break
+                    event.clear()
+                try:
+                    await asyncio.wait_for(event.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            self._abandon(queue, entry)
+            raise
+        try:
+            yield
+        finally:
+            self._release(model)
+
+    @contextmanager
+    def slot_sync(self, model: str):
+        """
+        Blocking variant of slot for synchronous callers.
+        """
+        event = threading.Event()
+        queue, entry = self._enqueue(model, event.set)
+        enqueued = time.monotonic()
+        try:
+            while True:
+                with self._lock:
+                    delay = queue.try_start(entry)
+                    if delay == 0:
+                        self._started(queue, entry, enqueued)
+                        break
+                    event.clear()
+                event.wait(delay)
+        except BaseException:
+            self._abandon(queue, entry)
+            raise
+        try:
+            yield
+        finally:
+            self._release(model)
+
+    def stats(self) -> dict:
+        """
+        Return per-model limits, load and queue-time metrics.
+        """
+        with self._lock:
+            result = {}
+            for model, queue in self._queues.items():
+                by_priority = {
+                    PRIORITY_NAMES.get(level, str(level)): {
+                        "started": count,
+                        "queue_ms_avg": total / count * 1000 if count else 0.0,
+                    }
+                    for level, (count, total) in sorted(queue.queue_time.items())
+                }
+                result[model] = {
+                    "concurrency": queue.concurrency,
+                    "rpm": queue.rate * 60,
+                    "active": queue.active,
+                    "queued": len(queue.waiters),
+                    "started": queue.started,
+                    "queue_ms_max": queue.max_queue_time * 1000,
+                    "by_priority": by_priority,
+                }
+            return result
+
+
+scheduler = Scheduler()
+
+
+class ScheduledBackend:
+    """
+    Model backend admitting every call of the wrapped backend through the scheduler.
+    """
+
+    def __init__(self, backend, scheduler: Scheduler = scheduler):
+        self.backend = backend
+        self.scheduler = scheduler
+
+    def generate_content(self, model: str, contents, config):
+        with self.scheduler.slot_sync(model):
+            return self.backend.generate_content(model, contents, config)
+
+    async def generate_content_async(self, model: str, contents, config):
+        async with self.scheduler.slot(model):
+            return await self.backend.generate_content_async(model, contents, config)
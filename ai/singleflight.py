@@ -0,0 +1,47 @@
+import asyncio
+import copy
+import logging
+from typing import Awaitable, Callable, Dict, Hashable
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls with the same key into a single in-flight call.
+
+    The first caller starts the call; callers arriving while it is still running await
+    the same task. Every caller receives its own copy of the result, so callers may
+    mutate it. A caller being cancelled does not cancel the shared call for the others.
+    """
+
+    def __init__(self):
+        self._tasks: Dict[Hashable, asyncio.Task] = {}
+        self.calls = 0
+        self.shared = 0
+
+    async def do(self, key: Hashable, func: Callable[..., Awaitable], *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        # Tasks belong to one event loop, so keys are scoped per loop
+        key = (id(loop), key)
+        task = self._tasks.get(key)
+        if task is None:
+            self.calls += 1
+            task = loop.create_task(func(*args, **kwargs))
+            self._tasks[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            self.shared += 1
+            logging.info(f"Joining in-flight call for {key[1]}")
+        return copy.deepcopy(await asyncio.shield(task))
+
+    def _forget(self, key: Hashable, task: asyncio.Task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if not task.cancelled():
+            # Retrieve the exception so unawaited failures are not reported as never retrieved
+            task.exception()
+
+    def stats(self) -> dict:
+        return {"calls": self.calls, "shared": self.shared, "in_flight": len(self._tasks)}
+
+
+flights = SingleFlight()
@@ -0,0 +1,90 @@
+import importlib
+import logging
+import os
+import sys
+import threading
+import time
+from types import ModuleType
+from typing import Dict
+
+# Import the heavy modules and create the model client in the background when the app
+# starts, so they are ready before the first search needs them (see warm_up).
+WARMUP = os.getenv("WARMUP", "1") == "1"
+
+# Modules that are imported on first use instead of when the app loads.
+WARMUP_MODULES = ["google.genai", "httpx", "PIL.Image", "requests"]
+if os.getenv("BLOB_BACKEND", "vercel") == "vercel":
+    WARMUP_MODULES.append("vercel_blob")
+
+# module name -> seconds its deferred import took
+import_times: Dict[str, float] = {}
+# Deferred imports happen in request and worker threads. Importing a package with circular
+# imports (like google.genai) from two threads at once can hand one of them a partially
+# initialised module, so they are made one at a time.
+_import_lock = threading.RLock()
+
+
+def load(name: str) -> ModuleType:
+    """
+    Import a module now and record how long the import took if it was not loaded yet.
+    """
+    module = sys.modules.get(name)
+    if module is not None and not getattr(getattr(module, "__spec__", None), "_initializing", False):
+        return module
+    with _import_lock:
+        loaded = name in sys.modules
+        start = time.perf_counter()
+        module = importlib.import_module(name)
+    if not loaded:
+        seconds = time.perf_counter() - start
+        import_times.setdefault(name, seconds)
+        logging.info(f"Imported {name} in {seconds * 1000:.0f}ms")
+    return module
+
+
+class _LazyModule(ModuleType):
+    """
+    Stand-in for a module that is imported on first attribute access.
+    """
+
+    def __getattr__(self, attribute: str):
+        module = load(self.__name__)
+        # Later lookups find the attributes without going through __getattr__
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attribute)
+
+
+def lazy_import(name: str) -> ModuleType:
+    """
+    Return a module that is imported the first time one of its attributes is used.
+
+    For heavy dependencies that only some requests need, e.g. the Gemini SDK or Pillow:
+    `types = lazy_import("google.genai.types")` costs nothing until `types.Part` is read.
+    Annotations using such a module must not be evaluated at import time.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    return _LazyModule(name)
+
+
+def warm_up():
+    """
+    Import the deferred modules and create the model backend and client, so the first
+    search of a new instance does not pay for them. Blocking, run it in a worker thread.
+    """
+    from ai.utils import AI_BACKEND, GEMINI_API_KEY, gemini, get_backend
+
+    start = time.perf_counter()
+    for name in WARMUP_MODULES:
+        try:
+            load(name)
+        except ImportError as e:
+            logging.warning(f"Warm-up could not import {name}: {e}")
+    try:
+        get_backend()
+        if AI_BACKEND == "gemini" and GEMINI_API_KEY:
+            gemini()
+    except Exception as e:
+        # The first request creates them again and reports the error
+        logging.warning(f"Warm-up could not create the model client: {e}")
+    logging.info(f"Warm-up finished in {time.perf_counter() - start:.2f}s")
@@ -1,11 +1,53 @@
-from ai.utils import gemini, build_user_profile
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from datetime import date
+from typing import List, Optional
+
+from ai.cache import TTLCache
+from ai.scheduler import BACKGROUND, set_priority
+from ai.singleflight import flights
+from ai.tracing import traced
+from ai.utils import build_user_profile, canonical_profile, generate_content, generate_content_async, profile_key
+
+# Tips kept per intolerance set, how many are requested per refill and how often a pool may be refilled.
+TIP_POOL_SIZE = int(os.environ.get("TIP_POOL_SIZE", "30"))
+TIP_POOL_MAX = int(os.environ.get("TIP_POOL_MAX", "100"))
+TIP_BATCH_SIZE = int(os.environ.get("TIP_BATCH_SIZE", "10"))
+TIP_REFILL_INTERVAL = float(os.environ.get("TIP_REFILL_INTERVAL", "600"))
+
+# Canonical intolerance set -> {"tips": [...], "refilled": timestamp}
+tip_pools = TTLCache(
+    "tip_pools",
+    maxsize=int(os.environ.get("TIP_POOLS", "1000")),
+    ttl=float(os.environ.get("TIP_POOL_TTL", str(30 * 24 * 3600))),
+)
+# Canonical intolerance set -> time of the last refill attempt on this instance, successful
+# or not, so a failing model is asked at most once per TIP_REFILL_INTERVAL per pool.
+refill_attempts = TTLCache("tip_refill_attempts", maxsize=int(os.environ.get("TIP_POOLS", "1000")),
+                           ttl=TIP_REFILL_INTERVAL, persistent=False)
+
+# Served while the pool of a new intolerance set is being filled.
+FALLBACK_TIPS = [
+    "that keeping a simple food diary is one of the best ways to find out which foods you tolerate?",
+    "that portion size matters: many people tolerate small amounts of a problematic food without symptoms?",
+    "that home-cooked meals make it much easier to control which ingredients end up on your plate?",
+    "that reading the ingredient list often reveals hidden sources of sugars, lactose or additives?",
+]
+
+_refills = set()
+
 
 def get_daily_tips(user_profile: dict) -> str:
     """
     Get daily tips for the user.
     """
     prompt = f"Given the user's intolerance profile: \n\n {build_user_profile(user_profile)} \n\n, generate a daily tip for the user. It must start with 'Did you know that '"
-    response = gemini().models.generate_content(
+    response = generate_content(
         model="gemini-2.0-flash-lite",
         contents=prompt,
         config={"response_modalities": ["TEXT"], "temperature": 1.5},
@@ -14,9 +56,125 @@ def get_daily_tips(user_profile: dict) -> str:
     return response.candidates[0].content.parts[0].text.split("Did you know ")[1].strip()
 
 
+def _pool_key(user_profile: dict) -> str:
+    intolerances, _ = canonical_profile(user_profile)
+    return ",".join(intolerances)
+
+
+def _tips_prompt(intolerances: str, count: int) -> str:
+    profile = build_user_profile({"intolerances": intolerances.split(",") if intolerances else []})
+    return (
+        f"Given the user's intolerance profile: \n\n {profile} \n\n, generate {count} different daily tips for the user. "
+        "Each tip must start with 'Did you know that ' and be a single sentence. Cover different topics and foods. "
+        "Return a JSON list of strings. Do not include any other text or explanation."
+    )
+
+
+def _parse_tips(response) -> List[str]:
+    for part in response.candidates[0].content.parts:
+        if part.text is not None:
+            try:
+                match = re.search(r"\[.*\]", part.text, re.DOTALL)
+                if match:
+                    tips = json.loads(match.group(0))
+                    return [
+                        tip.split("Did you know ", 1)[1].strip()
+                        for tip in tips
+                        if isinstance(tip, str) and "Did you know " in tip
+                    ]
+            except Exception as e:
+                logging.error(f"Error parsing tips: {e}")
+    return []
+
+
+def _dedup_key(tip: str) -> str:
+    return " ".join(re.sub(r"[^\w\s]", "", tip.lower()).split())
+
+
+@traced("tips")
+async def refill_tip_pool_async(user_profile: dict) -> int:
+    """
+    Ask the model for a batch of tips and add the new ones to the profile's pool.
+
+    Returns:
+        int: The number of tips added.
+    """
+    key = _pool_key(user_profile)
+
+    async def fetch():
+        pool = await tip_pools.get_async(key) or {"tips": [], "refilled": 0}
+        response = await generate_content_async(
+            model="gemini-2.0-flash-lite",
+            contents=_tips_prompt(key, TIP_BATCH_SIZE),
+            config={"response_modalities": ["TEXT"], "temperature": 1.5},
+        )
+        seen = {_dedup_key(tip) for tip in pool["tips"]}
+        added = 0
+        for tip in _parse_tips(response):
+            if _dedup_key(tip) not in seen:
+                seen.add(_dedup_key(tip))
+                pool["tips"].append(tip)
+                added += 1
+        # Keep the newest tips
+        pool["tips"] = pool["tips"][-TIP_POOL_MAX:]
+        pool["refilled"] = time.time()
+        tip_pools.set(key, pool)
+        logging.info(f"Tip pool '{key}': added {added}, {len(pool['tips'])} in total")
+        return added
+
+    return await flights.do(("tips", key), fetch)
+
+
+def _schedule_refill(user_profile: dict, pool: Optional[dict]):
+    if pool is not None and (
+        len(pool["tips"]) >= TIP_POOL_SIZE or time.time() - pool["refilled"] < TIP_REFILL_INTERVAL
+    ):
+        return
+    key = _pool_key(user_profile)
+    if refill_attempts.get(key) is not None:
+        return
+    refill_attempts.set(key, time.time())
+
+    async def refill():
+        set_priority(BACKGROUND)
+        try:
+            await refill_tip_pool_async(user_profile)
+        except Exception as e:
+            logging.error(f"Tip pool refill failed: {e}")
+
+    task = asyncio.get_running_loop().create_task(refill())
+    # Keep a reference until the task is done so it is not garbage collected
+    _refills.add(task)
+    task.add_done_callback(_refills.discard)
+
+
+def _rotate(tips: List[str], user: str, day: date) -> str:
+    digest = hashlib.sha256(f"{user}|{day.isoformat()}".encode("utf-8")).digest()
+    return tips[int.from_bytes(digest[:8], "big") % len(tips)]
+
+
+async def get_tip_async(user_profile: dict, user_id: Optional[str] = None, day: Optional[date] = None) -> str:
+    """
+    Return today's tip for a user from the pool of their intolerance set.
+
+    Tips rotate per user and day. The pool is refilled in the background when it runs
+    low, so this never waits for the model; a generic tip is returned while the pool of
+    a new intolerance set is being filled.
+
+    Args:
+        user_profile (dict): The user's intolerance profile.
+        user_id (str): Identifies the user for rotation, defaults to the profile.
+        day (date): The day to pick the tip for, defaults to today.
+    """
+    pool = await tip_pools.get_async(_pool_key(user_profile))
+    _schedule_refill(user_profile, pool)
+    tips = pool["tips"] if pool and pool["tips"] else FALLBACK_TIPS
+    return _rotate(tips, user_id or profile_key(user_profile), day or date.today())
+
+
 if __name__ == "__main__":
     print(get_daily_tips({
         "intolerances": [
             "fructose"
         ]
-    }))
\ No newline at end of file
+    }))
@@ -0,0 +1,281 @@
+import asyncio
+import contextvars
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Upper bounds in seconds of the latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_trace: contextvars.ContextVar = contextvars.ContextVar("trace", default=None)
+_span: contextvars.ContextVar = contextvars.ContextVar("span", default=None)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in sorted(labels.items())) + "}"
+
+
+class Metrics:
+    """
+    Minimal thread-safe registry of counters and histograms rendered in the Prometheus
+    text exposition format.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> (type, help)
+        self._meta: Dict[str, Tuple[str, str]] = {}
+        # name -> {label tuple: value}
+        self._counters: Dict[str, Dict[tuple, float]] = {}
+        # name -> {label tuple: [bucket counts..., sum, count]}
+        self._histograms: Dict[str, Dict[tuple, list]] = {}
+
+    def inc(self, name: str, help: str, value: float = 1.0, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._meta.setdefault(name, ("counter", help))
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def observe(self, name: str, help: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._meta.setdefault(name, ("histogram", help))
+            series = self._histograms.setdefault(name, {})
+            counts = series.get(key)
+            if counts is None:
+                counts = series[key] = [0] * len(LATENCY_BUCKETS) + [0.0, 0]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def render(self) -> str:
+        """
+        Return every metric in the Prometheus text format.
+        """
+        lines = []
+        with self._lock:
+            for name, (kind, help) in sorted(self._meta.items()):
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                if kind == "counter":
+                    for key, value in sorted(self._counters[name].items()):
+                        lines.append(f"{name}{_labels(dict(key))} {value:g}")
+                    continue
+                for key, counts in sorted(self._histograms[name].items()):
+                    labels = dict(key)
+                    for i, bound in enumerate(LATENCY_BUCKETS):
+                        lines.append(f"{name}_bucket{_labels({**labels, 'le': f'{bound:g}'})} {counts[i]}")
+                    lines.append(f"{name}_bucket{_labels({**labels, 'le': '+Inf'})} {counts[-1]}")
+                    lines.append(f"{name}_sum{_labels(labels)} {counts[-2]:g}")
+                    lines.append(f"{name}_count{_labels(labels)} {counts[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+def render_gauges(name: str, help: str, samples: Iterable[Tuple[dict, float]], kind: str = "gauge") -> str:
+    """
+    Render values read at scrape time, e.g. cache or queue statistics, in the Prometheus text format.
+    """
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    lines += [f"{name}{_labels(labels)} {value:g}" for labels, value in samples]
+    return "\n".join(lines) + "\n"
+
+
+class Span:
+    """
+    A timed stage of a request with its attributes (model, cache result, sizes, ...).
+    """
+
+    __slots__ = ("name", "attributes", "start", "duration", "error", "model_calls")
+
+    def __init__(self, name: str, attributes: dict):
+        self.name = name
+        self.attributes = attributes
+        self.start = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.error = False
+        self.model_calls = 0
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+class Trace:
+    """
+    The spans recorded while handling one request.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans: List[Span] = []
+
+    def server_timing(self) -> str:
+        """
+        Return a Server-Timing header value with the total duration per finished stage.
+        """
+        totals: Dict[str, float] = {}
+        for span in list(self.spans):
+            if span.duration is not None:
+                totals[span.name] = totals.get(span.name, 0.0) + span.duration
+        entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in totals.items()]
+        entries.append(f"total;dur={(time.perf_counter() - self.start) * 1000:.1f}")
+        return ", ".join(entries)
+
+
+def _finish(current: Span):
+    current.duration = time.perf_counter() - current.start
+    trace = _trace.get()
+    if trace is not None:
+        trace.spans.append(current)
+
+
+@contextmanager
+def trace_request():
+    """
+    Collect the spans recorded in this context, including tasks created from it, in a Trace.
+    """
+    trace = Trace()
+    token = _trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _trace.reset(token)
+
+
+def current_span() -> Optional[Span]:
+    """
+    Return the innermost stage span of the current context, or None.
+    """
+    return _span.get()
+
+
+@contextmanager
+def span(name: str, cached: bool = True, **attributes):
+    """
+    Time a stage and record it in the current trace and the stage latency histogram.
+
+    Model calls made inside are attributed to the stage. Unless the "cache" attribute is
+    set on the yielded span, a cached stage counts as a cache hit if it made no model call
+    (answered from a cache, or by joining an identical call in flight) and as a miss
+    otherwise.
+    """
+    current = Span(name, attributes)
+    token = _span.set(current)
+    try:
+        yield current
+    except BaseException:
+        current.error = True
+        raise
+    finally:
+        _span.reset(token)
+        _finish(current)
+        cache = current.attributes.get("cache") or (
+            ("miss" if current.model_calls else "hit") if cached else "none"
+        )
+        current.attributes["cache"] = cache
+        metrics.observe("eatsafe_stage_duration_seconds", "Duration of pipeline stages.", current.duration,
+                        stage=name, cache=cache)
+        if current.error:
+            metrics.inc("eatsafe_stage_errors_total", "Pipeline stages that raised.", stage=name)
+
+
+def traced(name: str, cached: bool = True):
+    """
+    Decorator running every call of a function, sync or async, in a span (see span).
+    """
+
+    def decorate(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with span(name, cached):
+                    return await fn(*args, **kwargs)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with span(name, cached):
+                    return fn(*args, **kwargs)
+        return wrapper
+
+    return decorate
+
+
+def _request_size(contents) -> int:
+    if isinstance(contents, str):
+        return len(contents.encode("utf-8"))
+    try:
+        return len(json.dumps(contents, default=str).encode("utf-8"))
+    except (TypeError, ValueError):
+        return 0
+
+
+def _response_size(response) -> int:
+    size = 0
+    try:
+        for part in response.candidates[0].content.parts:
+            if getattr(part, "text", None):
+                size += len(part.text.encode("utf-8"))
+            elif getattr(part, "inline_data", None) and part.inline_data.data:
+                size += len(part.inline_data.data)
+    except (AttributeError, IndexError, TypeError):
+        pass
+    return size
+
+
+@contextmanager
+def model_span(model: str, contents):
+    """
+    Time one model call and record its sizes and token counts, labelled with the stage
+    it was made from. Pass the yielded span and the response to record_response.
+    """
+    parent = _span.get()
+    if parent is not None:
+        parent.model_calls += 1
+    stage = parent.name if parent is not None else "other"
+    current = Span(f"model.{model}", {"model": model, "stage": stage, "prompt_bytes": _request_size(contents)})
+    try:
+        yield current
+    except BaseException:
+        current.error = True
+        raise
+    finally:
+        _finish(current)
+        labels = {"model": model, "stage": stage}
+        metrics.observe("eatsafe_model_call_duration_seconds", "Duration of model calls.", current.duration, **labels)
+        metrics.inc("eatsafe_model_calls_total", "Model calls by outcome.",
+                    outcome="error" if current.error else "ok", **labels)
+        metrics.inc("eatsafe_model_prompt_bytes_total", "Bytes of prompts sent to models.",
+                    current.attributes["prompt_bytes"], **labels)
+        if "response_bytes" in current.attributes:
+            metrics.inc("eatsafe_model_response_bytes_total", "Bytes of model responses.",
+                        current.attributes["response_bytes"], **labels)
+        for kind in ("prompt", "response"):
+            tokens = current.attributes.get(f"{kind}_tokens")
+            if tokens:
+                metrics.inc("eatsafe_model_tokens_total", "Tokens used by model calls.", tokens, kind=kind, **labels)
+
+
+def record_response(current: Span, response):
+    """
+    Add the response size and token counts of a model call to its span.
+    """
+    usage = getattr(response, "usage_metadata", None)
+    current.set(
+        response_bytes=_response_size(response),
+        prompt_tokens=getattr(usage, "prompt_token_count", None),
+        response_tokens=getattr(usage, "candidates_token_count", None),
+    )
@@ -0,0 +1,198 @@
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from urllib.parse import quote, unquote
+
+from ai.blob_index import blob_index
+from ai.blob_store import get_blob_store
+from ai.cache import LOCAL_CACHE_DIR
+from ai.tracing import traced
+
+UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR", os.path.join(LOCAL_CACHE_DIR, "upload_spool"))
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "4"))
+# Attempts per upload and the delay before the first retry in seconds, doubled on every retry.
+UPLOAD_MAX_ATTEMPTS = int(os.getenv("UPLOAD_MAX_ATTEMPTS", "5"))
+UPLOAD_RETRY_DELAY = float(os.getenv("UPLOAD_RETRY_DELAY", "1"))
+
+
+class UploadQueue:
+    """
+    Write-behind queue of blob uploads.
+
+    put() writes the bytes to a local spool directory and returns immediately; worker
+    threads upload them to the blob store, retrying failures with exponential backoff,
+    and record the URL in the blob index. A pathname is uploaded at most once at a time,
+    putting it again while it is pending only replaces the spooled bytes. Spooled files
+    left behind by a previous process (or by uploads that ran out of attempts) are picked
+    up again when the queue starts.
+    """
+
+    def __init__(self, spool_dir: str = UPLOAD_SPOOL_DIR, workers: int = UPLOAD_WORKERS,
+                 max_attempts: int = UPLOAD_MAX_ATTEMPTS, retry_delay: float = UPLOAD_RETRY_DELAY):
+        self.spool_dir = spool_dir
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        # pathname -> attempts made so far, for every queued or uploading pathname
+        self._pending = {}
+        # (due time, sequence, pathname)
+        self._due = []
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+        self.uploaded = 0
+        self.retried = 0
+        self.failed = 0
+
+    def _file(self, pathname: str) -> str:
+        return os.path.join(self.spool_dir, quote(pathname, safe=""))
+
+    def _schedule(self, pathname: str, delay: float = 0.0):
+        heapq.heappush(self._due, (time.monotonic() + delay, next(self._sequence), pathname))
+        self._cond.notify()
+
+    def _start(self):
+        # Called with the condition held
+        if self._threads:
+            return
+        os.makedirs(self.spool_dir, exist_ok=True)
+        for name in os.listdir(self.spool_dir):
+            if name.endswith(".tmp"):
+                continue
+            pathname = unquote(name)
+            if pathname not in self._pending:
+                self._pending[pathname] = 0
+                self._schedule(pathname)
+        for _ in range(max(1, self.workers)):
+            thread = threading.Thread(target=self._work, name="blob-upload", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def put(self, pathname: str, data: bytes):
+        """
+        Spool data for upload under pathname and return without waiting for the upload.
+        """
+        with self._cond:
+            self._start()
+        file = self._file(pathname)
+        # Write to a temporary file first so workers and readers never see partial data
+        tmp = f"{file}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, file)
+        with self._cond:
+            if pathname not in self._pending:
+                self._pending[pathname] = 0
+                self._schedule(pathname)
+
+    def pending(self, pathname: str) -> bool:
+        """
+        Whether pathname is spooled and not uploaded yet.
+        """
+        with self._cond:
+            return pathname in self._pending
+
+    def read(self, pathname: str) -> bytes:
+        """
+        Return the spooled bytes of pathname, or None if it is not spooled.
+        """
+        try:
+            with open(self._file(pathname), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _next(self) -> str:
+        with self._cond:
+            while True:
+                if self._due:
+                    wait = self._due[0][0] - time.monotonic()
+                    if wait <= 0:
+                        return heapq.heappop(self._due)[2]
+                    self._cond.wait(wait)
+                else:
+                    self._cond.wait()
+
+    @traced("blob_upload", cached=False)
+    def _upload(self, pathname: str):
+        file = self._file(pathname)
+        try:
+            with open(file, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            with self._cond:
+                self._pending.pop(pathname, None)
+            return
+        try:
+            url = get_blob_store().put(pathname, data).get("url")
+            if not url:
+                raise RuntimeError("blob store returned no URL")
+        except Exception as e:
+            with self._cond:
+                attempts = self._pending[pathname] + 1
+                if attempts < self.max_attempts:
+                    self._pending[pathname] = attempts
+                    self.retried += 1
+                    delay = self.retry_delay * 2 ** (attempts - 1)
+                    logging.warning(f"Upload of {pathname} failed ({e}), retrying in {delay:.1f}s")
+                    self._schedule(pathname, delay)
+                else:
+                    # Keep the spooled file, it is retried when the queue starts again
+                    self._pending.pop(pathname)
+                    self.failed += 1
+                    logging.error(f"Upload of {pathname} failed after {attempts} attempts: {e}")
+                self._cond.notify_all()
+            return
+        blob_index.add(pathname, url)
+        with self._cond:
+            self.uploaded += 1
+            # Upload again if the spooled file was replaced during the upload
+            replaced = self.read(pathname)
+            if replaced is not None and replaced != data:
+                self._pending[pathname] = 0
+                self._schedule(pathname)
+                return
+            if replaced is not None:
+                os.remove(file)
+            self._pending.pop(pathname, None)
+            self._cond.notify_all()
+
+    def _work(self):
+        while True:
+            pathname = self._next()
+            try:
+                self._upload(pathname)
+            except Exception as e:
+                logging.error(f"Upload worker error for {pathname}: {e}")
+                with self._cond:
+                    self._pending.pop(pathname, None)
+                    self._cond.notify_all()
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Wait until every pending upload has finished or given up. Returns False on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "name": "uploads",
+                "pending": len(self._pending),
+                "uploaded": self.uploaded,
+                "retried": self.retried,
+                "failed": self.failed,
+            }
+
+
+upload_queue = UploadQueue()
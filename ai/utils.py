@@ -1,17 +1,243 @@
+from __future__ import annotations
+
+import hashlib
 import os
+import threading
+from typing import Tuple
 
 from dotenv import load_dotenv
-from google import genai
+
+from ai.resilience import resilience
+from ai.startup import lazy_import
+from ai.tracing import model_span, record_response
+
+# The Gemini SDK and httpx take most of the app's import time, load them on first use
+httpx = lazy_import("httpx")
+genai = lazy_import("google.genai")
+types = lazy_import("google.genai.types")
 
 load_dotenv()
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-if not GEMINI_API_KEY:
-    raise ValueError("GEMINI_API_KEY environment variable not set")
+
+# "gemini" calls the real API, "fake" replays canned responses (see ai.fake).
+AI_BACKEND = os.getenv("AI_BACKEND", "gemini")
+
+# Size of the shared HTTP connection pool and how long idle connections are kept alive.
+GEMINI_POOL_SIZE = int(os.getenv("GEMINI_POOL_SIZE", "20"))
+GEMINI_KEEPALIVE_EXPIRY = float(os.getenv("GEMINI_KEEPALIVE_EXPIRY", "120"))
+
+# Request timeout in seconds per model. Can be overridden with
+# GEMINI_TIMEOUTS="gemini-2.0-flash=10,gemini-2.0-flash-exp-image-generation=60".
+DEFAULT_TIMEOUT = float(os.getenv("GEMINI_DEFAULT_TIMEOUT", "60"))
+MODEL_TIMEOUTS = {
+    "gemini-2.0-flash-lite": 20.0,
+    "gemini-2.0-flash": 20.0,
+    "gemini-2.5-flash-preview-05-20": 60.0,
+    "gemini-2.0-flash-exp-image-generation": 90.0,
+}
+for _entry in filter(None, os.getenv("GEMINI_TIMEOUTS", "").split(",")):
+    _model, _, _seconds = _entry.partition("=")
+    MODEL_TIMEOUTS[_model.strip()] = float(_seconds)
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def gemini() -> genai.Client:
+    """
+    Return the process-wide Gemini client.
+
+    The client is created once and keeps its sync and async connection pools warm,
+    so repeated calls reuse TLS connections instead of opening new ones.
+    """
+    global _client
+    if _client is None:
+        if not GEMINI_API_KEY:
+            raise ValueError("GEMINI_API_KEY environment variable not set")
+        with _client_lock:
+            if _client is None:
+                limits = httpx.Limits(
+                    max_connections=GEMINI_POOL_SIZE,
+                    max_keepalive_connections=GEMINI_POOL_SIZE,
+                    keepalive_expiry=GEMINI_KEEPALIVE_EXPIRY,
+                )
+                _client = genai.Client(
+                    api_key=GEMINI_API_KEY,
+                    http_options=types.HttpOptions(
+                        client_args={"limits": limits},
+                        async_client_args={"limits": limits},
+                    ),
+                )
+    return _client
+
+
+def model_timeout(model: str) -> float:
+    """
+    Return the request timeout in seconds for a model.
+    """
+    return MODEL_TIMEOUTS.get(model, DEFAULT_TIMEOUT)
+
+
+def _with_timeout(model: str, config, timeout: float = None) -> types.GenerateContentConfig:
+    config = types.GenerateContentConfig.model_validate(config or {})
+    if config.http_options is None or config.http_options.timeout is None:
+        # HttpOptions.timeout is in milliseconds.
+        timeout = int((timeout or model_timeout(model)) * 1000)
+        config = config.model_copy(update={"http_options": types.HttpOptions(timeout=timeout)})
+    return config
 
 
-def gemini():
-    return genai.Client(api_key=GEMINI_API_KEY)
+class GeminiBackend:
+    """
+    Model backend calling the Gemini API through the shared client.
+
+    A backend provides generate_content and generate_content_async, both taking the model
+    name, the contents and a GenerateContentConfig and returning a GenerateContentResponse.
+    """
+
+    def generate_content(self, model: str, contents, config: types.GenerateContentConfig):
+        return gemini().models.generate_content(model=model, contents=contents, config=config)
+
+    async def generate_content_async(self, model: str, contents, config: types.GenerateContentConfig):
+        return await gemini().aio.models.generate_content(model=model, contents=contents, config=config)
+
+
+_backend = None
+
+
+def get_backend():
+    """
+    Return the model backend selected by AI_BACKEND, creating it on first use.
+
+    Every call is admitted through the scheduler (see ai.scheduler). Unless
+    RESPONSE_STORE_MODE is "passthrough", the backend is also wrapped so responses are
+    recorded to and replayed from the response store (see ai.response_store); replayed
+    responses do not wait for the scheduler.
+    """
+    global _backend
+    if _backend is None:
+        from ai.response_store import RESPONSE_STORE_MODE, RecordReplayBackend
+        from ai.scheduler import ScheduledBackend
+
+        if AI_BACKEND == "fake":
+            from ai.fake import FakeBackend
+
+            backend = FakeBackend()
+        else:
+            backend = GeminiBackend()
+        backend = ScheduledBackend(backend)
+        if RESPONSE_STORE_MODE != "passthrough":
+            backend = RecordReplayBackend(backend)
+        _backend = backend
+    return _backend
+
+
+def set_backend(backend):
+    """
+    Replace the model backend used by every module in ai/.
+    """
+    global _backend
+    _backend = backend
+
+
+def generate_content(model: str, contents, config=None) -> types.GenerateContentResponse:
+    """
+    Call a model through the configured backend.
+
+    The call is bounded by the model's timeout or the deadline of the current stage,
+    whichever is nearer, and fails fast with ModelUnavailable while the model's circuit
+    breaker is open (see ai.resilience).
+
+    Args:
+        model (str): The model name.
+        contents: The prompt or contents to send.
+        config: A dict or GenerateContentConfig.
+
+    Returns:
+        GenerateContentResponse: The raw model response.
+    """
+    config = _with_timeout(model, config, resilience.timeout(model, model_timeout(model)))
+    with model_span(model, contents) as span:
+        response = resilience.call(model, lambda: get_backend().generate_content(model, contents, config))
+        record_response(span, response)
+    return response
+
+
+async def generate_content_async(model: str, contents, config=None) -> types.GenerateContentResponse:
+    """
+    Async variant of generate_content using the client's async connection pool.
+
+    The deadline also covers the time queued in the scheduler, and slow temperature-0
+    calls are hedged with a second request.
+    """
+    timeout = resilience.timeout(model, model_timeout(model))
+    config = _with_timeout(model, config, timeout)
+    with model_span(model, contents) as span:
+        response = await resilience.call_async(
+            model, config, lambda: get_backend().generate_content_async(model, contents, config), timeout
+        )
+        record_response(span, response)
+    return response
+
+
+def normalize_food_name(name: str) -> str:
+    """
+    Normalise a food name for use as a cache key.
+    """
+    return " ".join(name.lower().split())
+
+
+def _singular(word: str) -> str:
+    if len(word) <= 3 or word.endswith(("ss", "us", "is")):
+        return word
+    if word.endswith("ies"):
+        return word[:-3] + "y"
+    if word.endswith(("oes", "ches", "shes", "sses", "xes", "zes")):
+        return word[:-2]
+    if word.endswith("s"):
+        return word[:-1]
+    return word
+
+
+def normalize_query(query: str) -> str:
+    """
+    Normalise a free-text food query for use as a cache key.
+
+    Besides case and whitespace, simple English plurals of the last word are folded, so
+    "Pizzas", " pizza " and "PIZZA" share a key. The result is only meant for keys, not
+    for display or prompts.
+    """
+    words = normalize_food_name(query).strip(" .,!?;:").split()
+    if words:
+        words[-1] = _singular(words[-1])
+    return " ".join(words)
+
+
+def canonical_profile(user_profile: dict) -> Tuple[Tuple[str, ...], str]:
+    """
+    Return the canonical form of a user profile.
+
+    Intolerances are lower-cased, de-duplicated and sorted so that equivalent profiles
+    compare equal. Notes are free text and are only represented by a short hash.
+
+    Returns:
+        Tuple[Tuple[str, ...], str]: The sorted intolerances and the hash of the notes ("" if none).
+    """
+    intolerances = tuple(
+        sorted({i.strip().lower() for i in user_profile.get("intolerances") or [] if i and i.strip()})
+    )
+    notes = " ".join((user_profile.get("notes") or "").split())
+    notes_hash = hashlib.sha256(notes.encode("utf-8")).hexdigest()[:16] if notes else ""
+    return intolerances, notes_hash
+
+
+def profile_key(user_profile: dict) -> str:
+    """
+    Return a string cache key for the canonical form of a user profile.
+    """
+    intolerances, notes_hash = canonical_profile(user_profile)
+    return f"{','.join(intolerances)}|{notes_hash}"
 
 
 def build_user_profile(user_profile: dict) -> str:
@@ -19,7 +245,7 @@ def build_user_profile(user_profile: dict) -> str:
     Build a user profile string from a dictionary.
     """
 
-    intolerances = user_profile.get("intolerances", [])
-    notes = user_profile.get("notes", "")
+    intolerances, _ = canonical_profile(user_profile)
+    notes = user_profile.get("notes") or ""
 
     return f"The user is intolerant to {' and '.join(intolerances)}. He also has the following notes: {notes}"
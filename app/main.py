@@ -1,8 +1,15 @@
-from fastapi import FastAPI
+import asyncio
+import math
+
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 
-from app.routers import hello, search, tip
+from ai.resilience import MODEL_UNAVAILABLE_DETAIL, ModelUnavailable
+from ai.startup import WARMUP, warm_up
+from ai.upload_queue import upload_queue
+from app.routers import hello, image, metrics, prewarm, search, tip
+from app.tracing import TracingMiddleware
 
 app = FastAPI(
     title="FastAPI Server",
@@ -17,9 +24,37 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],
 )
+app.add_middleware(TracingMiddleware)
 
 # Include routers
 app.include_router(hello.router, tags=["hello"])
 app.include_router(search.router, tags=["search"])
-app.include_router(tip.router, tags=["tip"])
\ No newline at end of file
+app.include_router(tip.router, tags=["tip"])
+app.include_router(image.router, tags=["image"])
+app.include_router(prewarm.router, tags=["prewarm"])
+app.include_router(metrics.router, tags=["metrics"])
+
+
+@app.exception_handler(ModelUnavailable)
+async def model_unavailable(request: Request, exc: ModelUnavailable) -> JSONResponse:
+    # A model is down or too slow and no fallback could answer: ask the client to retry later
+    return JSONResponse(
+        status_code=503,
+        content={"detail": MODEL_UNAVAILABLE_DETAIL},
+        headers={"Retry-After": str(max(1, math.ceil(exc.retry_after)))},
+    )
+
+
+@app.on_event("startup")
+async def start_warm_up():
+    # In the background, so the instance answers while the heavy modules load
+    if WARMUP:
+        app.state.warm_up = asyncio.create_task(asyncio.to_thread(warm_up))
+
+
+@app.on_event("shutdown")
+async def flush_uploads():
+    # Uploads that do not finish in time stay spooled and are retried on the next start
+    await asyncio.to_thread(upload_queue.flush, 10)
@@ -0,0 +1,61 @@
+import asyncio
+import hashlib
+import os
+from typing import Literal
+
+from fastapi import APIRouter, HTTPException, Request, Response
+
+from ai.cache import TTLCache
+from ai.image_gen import image_formats, load_image, media_type
+from ai.response_cache import etag_matches
+
+router = APIRouter()
+
+IMAGE_MAX_AGE = int(os.environ.get("IMAGE_MAX_AGE", str(7 * 24 * 3600)))
+
+# (food, size, format) -> ETag of the last image served, so revalidations can be answered without a download.
+etags = TTLCache("image_etags", maxsize=10000, ttl=IMAGE_MAX_AGE, persistent=False)
+
+
+def _etag(image_bytes: bytes) -> str:
+    return '"' + hashlib.sha256(image_bytes).hexdigest()[:32] + '"'
+
+
+def _negotiate_format(format: str, accept: str) -> str:
+    if format != "auto":
+        return format if format in image_formats() else "jpeg"
+    for candidate in ("avif", "webp"):
+        if candidate in image_formats() and media_type(candidate) in accept:
+            return candidate
+    return "jpeg"
+
+
+@router.get("/image/{food}")
+async def get_image(
+    food: str,
+    request: Request,
+    size: Literal["thumb", "medium", "full"] = "full",
+    format: Literal["auto", "jpeg", "webp", "avif"] = "auto",
+) -> Response:
+    """
+    Return the stored image for a food as raw bytes.
+
+    With format "auto" the best format the client accepts is chosen from its Accept header.
+    """
+    format = _negotiate_format(format, request.headers.get("accept", ""))
+    headers = {"Cache-Control": f"public, max-age={IMAGE_MAX_AGE}", "Vary": "Accept"}
+    key = f"{food}|{size}|{format}"
+
+    etag = etags.get(key)
+    if etag is not None and etag_matches(etag, request.headers.get("if-none-match")):
+        return Response(status_code=304, headers={**headers, "ETag": etag})
+
+    image_bytes = await asyncio.to_thread(load_image, food, size, format)
+    if not image_bytes:
+        raise HTTPException(status_code=404, detail="Image not found.")
+
+    etag = _etag(image_bytes)
+    etags.set(key, etag)
+    if etag_matches(etag, request.headers.get("if-none-match")):
+        return Response(status_code=304, headers={**headers, "ETag": etag})
+    return Response(content=image_bytes, media_type=media_type(format), headers={**headers, "ETag": etag})
@@ -0,0 +1,99 @@
+import hmac
+import os
+from typing import Optional
+
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import PlainTextResponse
+
+from ai.cache import all_caches
+from ai.resilience import resilience
+from ai.scheduler import scheduler
+from ai.startup import import_times
+from ai.tracing import metrics, render_gauges
+from ai.upload_queue import upload_queue
+
+router = APIRouter()
+
+# Bearer token required by /metrics; without one the endpoint is public.
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+
+def _cache_metrics() -> str:
+    stats = [cache.stats() for cache in all_caches()]
+    return "".join([
+        render_gauges("eatsafe_cache_hits_total", "Cache hits per tier.", [
+            ({"cache": s["name"], "tier": tier}, hits) for s in stats for tier, hits in s["tier_hits"].items()
+        ], kind="counter"),
+        render_gauges("eatsafe_cache_misses_total", "Cache misses.", [
+            ({"cache": s["name"]}, s["misses"]) for s in stats
+        ], kind="counter"),
+        render_gauges("eatsafe_cache_entries", "Entries held in memory.", [
+            ({"cache": s["name"]}, s["size"]) for s in stats
+        ]),
+    ])
+
+
+def _scheduler_metrics() -> str:
+    stats = scheduler.stats()
+    queue_time = [
+        (model, priority, values) for model, s in stats.items() for priority, values in s["by_priority"].items()
+    ]
+    return "".join([
+        render_gauges("eatsafe_model_active_calls", "Model calls in progress.", [
+            ({"model": model}, s["active"]) for model, s in stats.items()
+        ]),
+        render_gauges("eatsafe_model_queued_calls", "Model calls waiting for the scheduler.", [
+            ({"model": model}, s["queued"]) for model, s in stats.items()
+        ]),
+        render_gauges("eatsafe_model_queue_seconds_avg", "Mean time model calls waited in the scheduler.", [
+            ({"model": model, "priority": priority}, values["queue_ms_avg"] / 1000) for model, priority, values in queue_time
+        ]),
+        render_gauges("eatsafe_model_queue_seconds_max", "Longest time a model call waited in the scheduler.", [
+            ({"model": model}, s["queue_ms_max"] / 1000) for model, s in stats.items()
+        ]),
+    ])
+
+
+def _resilience_metrics() -> str:
+    stats = resilience.stats()
+    states = ("closed", "half_open", "open")
+    return "".join([
+        render_gauges("eatsafe_model_breaker_state", "Circuit breaker state per model (1 for the current state).", [
+            ({"model": model, "state": state}, 1 if s["state"] == state else 0) for model, s in stats.items() for state in states
+        ]),
+        render_gauges("eatsafe_model_latency_p95_seconds", "Recent p95 latency of model calls, the hedging delay.", [
+            ({"model": model}, s["p95"]) for model, s in stats.items() if s["p95"] is not None
+        ]),
+    ])
+
+
+def _startup_metrics() -> str:
+    return render_gauges("eatsafe_deferred_import_seconds", "Time taken by deferred imports of heavy modules.", [
+        ({"module": module}, seconds) for module, seconds in sorted(import_times.items())
+    ])
+
+
+def _upload_metrics() -> str:
+    stats = upload_queue.stats()
+    return "".join([
+        render_gauges("eatsafe_uploads_pending", "Blob uploads waiting in the spool.", [({}, stats["pending"])]),
+        render_gauges("eatsafe_uploads_total", "Finished blob uploads by outcome.", [
+            ({"outcome": "uploaded"}, stats["uploaded"]),
+            ({"outcome": "retried"}, stats["retried"]),
+            ({"outcome": "failed"}, stats["failed"]),
+        ], kind="counter"),
+    ])
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics(authorization: Optional[str] = Header(default=None)) -> PlainTextResponse:
+    """
+    Return stage, model call, cache, scheduler, circuit breaker, upload and startup metrics in the Prometheus text format.
+    """
+    if METRICS_TOKEN and not hmac.compare_digest(authorization or "", f"Bearer {METRICS_TOKEN}"):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    body = (
+        metrics.render() + _cache_metrics() + _scheduler_metrics() + _resilience_metrics()
+        + _upload_metrics() + _startup_metrics()
+    )
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4")
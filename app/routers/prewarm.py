@@ -0,0 +1,33 @@
+import hmac
+import os
+from typing import Optional
+
+from fastapi import APIRouter, Header, HTTPException
+from pydantic import BaseModel
+
+from ai.prewarm import prewarm
+
+router = APIRouter()
+
+# Vercel cron jobs send "Authorization: Bearer $CRON_SECRET"; without a secret the endpoint is disabled.
+CRON_SECRET = os.environ.get("CRON_SECRET")
+
+
+class PrewarmResponse(BaseModel):
+    foods: int
+    warmed: int
+    cached: int
+    skipped: int
+    failed: int
+    calls: int
+
+
+@router.get("/prewarm", response_model=PrewarmResponse)
+async def run_prewarm(authorization: Optional[str] = Header(default=None)) -> PrewarmResponse:
+    """
+    Fill the caches for the most popular foods (see ai.prewarm), e.g. from a cron job.
+    """
+    expected = f"Bearer {CRON_SECRET}" if CRON_SECRET else None
+    if expected is None or not hmac.compare_digest(authorization or "", expected):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    return PrewarmResponse(**await prewarm())
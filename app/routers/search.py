@@ -1,29 +1,50 @@
 import json
+import logging
+import os
 from datetime import datetime
-from typing import List, Optional
+from typing import List, Literal, Optional
 
-from fastapi import APIRouter, HTTPException
-from pydantic import BaseModel
+from fastapi import APIRouter, Header, HTTPException, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field
 
-from ai.dish_analysis import analyze_dish
-from ai.image_gen import get_image
-from ai.ingredient_analysis import analyze_ingredient
-from ai.safety import is_safe
+from ai.batch import analyze_batch_async
+from ai.dish_analysis import DISH_ANALYSIS_MODE, analyze_dish_async
+from ai.image_gen import get_image_async, get_image_url_async, image_formats, is_local_url
+from ai.ingredient_analysis import analyze_ingredient_async
+from ai.prewarm import record_query
+from ai.resilience import MODEL_UNAVAILABLE_DETAIL, ModelUnavailable, fallback, track_fallbacks
+from ai.response_cache import etag_matches, response_etag, search_responses
+from ai.safety import is_safe_async, is_safe_batch_async
+from ai.scheduler import BACKGROUND, BATCH, set_priority
+from ai.tracing import span
+from ai.utils import normalize_query, profile_key
 
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
 
 router = APIRouter()
 
+# Maximum number of queries accepted by /search/batch.
+SEARCH_BATCH_MAX = int(os.environ.get("SEARCH_BATCH_MAX", "50"))
+
 
 class SearchRequest(BaseModel):
     query: str
     user_profile: dict
+    # "url" returns a cacheable image URL; "base64" embeds the image (legacy clients)
+    image_mode: Literal["url", "base64"] = "url"
+    image_size: Literal["thumb", "medium", "full"] = "full"
+    # "avif" falls back to "jpeg" if the server cannot encode it
+    image_format: Literal["jpeg", "webp", "avif"] = "jpeg"
+    # Dish analysis as one structured model call ("single") or four calls ("graph"),
+    # defaults to DISH_ANALYSIS_MODE
+    analysis_mode: Optional[Literal["graph", "single"]] = None
 
 
 class SearchResult(BaseModel):
     status: str
-    imageBase64: str
+    imageBase64: Optional[str] = None
+    imageUrl: Optional[str] = None
     name: str
     overall_rating: float
     text: List[dict]
@@ -32,61 +53,374 @@ class SearchResult(BaseModel):
     is_ingredient: bool
 
 
-def get_image_sync(food_query):
-    # Helper to run get_image in a thread
-    return get_image(food_query)
+class SearchStreamRequest(SearchRequest):
+    # "ndjson" emits one JSON object per line, "sse" emits Server-Sent Events
+    stream_format: Literal["ndjson", "sse"] = "ndjson"
+
+
+class BatchSearchRequest(BaseModel):
+    queries: List[str] = Field(min_length=1, max_length=SEARCH_BATCH_MAX)
+    user_profile: dict
+    # Hints cost one model call per food, without them the whole batch takes a fixed number of calls
+    include_hints: bool = False
+    # "none" skips images, which is the cheapest way to scan a menu
+    image_mode: Literal["none", "url", "base64"] = "none"
+    image_size: Literal["thumb", "medium", "full"] = "thumb"
+    image_format: Literal["jpeg", "webp", "avif"] = "jpeg"
+    # Stream one event per item as it finishes instead of returning a single response
+    stream_format: Optional[Literal["ndjson", "sse"]] = None
+
+
+class BatchSearchItem(BaseModel):
+    query: str
+    # "success", "invalid" (not a food query) or "error"
+    status: str
+    detail: Optional[str] = None
+    result: Optional[SearchResult] = None
+
+
+class BatchSearchResponse(BaseModel):
+    status: str
+    results: List[BatchSearchItem]
+
+
+def _image_fields(request: SearchRequest, image: str) -> dict:
+    if request.image_mode == "base64":
+        return {"imageBase64": image}
+    return {"imageUrl": image}
+
+
+def _image_format(request: SearchRequest) -> str:
+    return request.image_format if request.image_format in image_formats() else "jpeg"
+
+
+async def _get_image(request: SearchRequest, food_query: str, base_url: str) -> Optional[str]:
+    # Results are returned without an image rather than failing when the image model is down
+    try:
+        if request.image_mode == "base64":
+            return await get_image_async(food_query, request.image_size, _image_format(request))
+        url = await get_image_url_async(food_query, request.image_size, _image_format(request))
+    except ModelUnavailable as e:
+        fallback("image", e)
+        return None
+    # /image URLs of pending uploads are relative unless IMAGE_BASE_URL is set
+    if url and url.startswith("/"):
+        url = base_url.rstrip("/") + url
+    return url
+
+
+async def _classify(request: SearchRequest):
+    safe, food_query, is_ingredient = await is_safe_async(request.query)
+
+    if not safe:
+        raise HTTPException(status_code=400, detail="Please enter a valid food query.")
+    record_query(request.query, request.user_profile)
+    return food_query, is_ingredient
+
+
+async def _search(request: SearchRequest, food_query: str, is_ingredient: bool, base_url: str) -> SearchResult:
+    # Start image generation in parallel
+    image_task = _get_image(request, food_query, base_url)
+
+    if not is_ingredient:
+        dish_task = analyze_dish_async(food_query, request.user_profile, mode=request.analysis_mode)
+        dish_analysis, image = await asyncio.gather(dish_task, image_task)
+        if not dish_analysis:
+            raise HTTPException(status_code=500, detail="Failed to analyze dish.")
+
+        return SearchResult(
+            status="success",
+            **_image_fields(request, image),
+            name=food_query,
+            overall_rating=dish_analysis.get("overall_rating", 0),
+            text=dish_analysis.get("text", []),
+            ingredients_rating=list(dish_analysis.get("ingredients", [])),
+            timestamp=datetime.now(),
+            is_ingredient=is_ingredient,
+        )
+    else:
+        ingredient_task = analyze_ingredient_async(food_query, request.user_profile)
+        ingredient_analysis, image = await asyncio.gather(ingredient_task, image_task)
+        if not ingredient_analysis:
+            raise HTTPException(status_code=500, detail="Failed to analyze ingredient.")
+
+        return SearchResult(
+            status="success",
+            **_image_fields(request, image),
+            name=food_query,
+            overall_rating=ingredient_analysis.get("overall_rating", 0),
+            text=ingredient_analysis.get("text", []),
+            ingredients_rating=[],
+            timestamp=datetime.now(),
+            is_ingredient=is_ingredient,
+        )
+
+
+def _response_key(request: SearchRequest, food_query: str, is_ingredient: bool) -> str:
+    analysis = "ingredient" if is_ingredient else request.analysis_mode or DISH_ANALYSIS_MODE
+    return search_responses.key(
+        normalize_query(food_query), profile_key(request.user_profile), analysis,
+        request.image_mode, request.image_size, _image_format(request),
+    )
+
+
+def _json_response(value: dict, etag: str, if_none_match: Optional[str]) -> Response:
+    if etag_matches(etag, if_none_match):
+        return Response(status_code=304, headers={"ETag": etag})
+    return JSONResponse(content=value, headers={"ETag": etag})
+
+
+async def _search_and_cache(request: SearchRequest, key: str, food_query: str, is_ingredient: bool,
+                            base_url: str, previous: dict = None):
+    with track_fallbacks() as fallbacks:
+        result = await _search(request, food_query, is_ingredient, base_url)
+    value = result.model_dump(mode="json")
+    if request.image_mode == "base64" or any(stage != "image" for stage in fallbacks):
+        # Embedded images are too large to cache, the image caches still serve them. Ratings
+        # or hints computed locally (model down or its answer unusable) are never cached, a
+        # stale response is kept instead until a refresh gets the model's answer.
+        return value, response_etag(value)
+    # Without an image, or with one still being uploaded and served by this instance, the
+    # response is cached stale so the next request refreshes it
+    degraded = not result.imageUrl or is_local_url(result.imageUrl)
+    return value, await search_responses.set_async(key, value, degraded=degraded, previous=previous)
 
 
 @router.post("/search", response_model=SearchResult)
-async def search_items(request: SearchRequest) -> SearchResult:
+async def search_items(request: SearchRequest, http_request: Request,
+                       if_none_match: Optional[str] = Header(default=None)) -> Response:
     """
     Search for items based on the query string.
+
+    Complete responses are cached per food, canonical profile and response mode (see
+    ai.response_cache), so a repeated search only costs the safety check. Stale cached
+    responses are served while they are refreshed in the background. Responses carry an
+    ETag; a matching If-None-Match header is answered with 304.
     """
-    safe, food_query, is_ingredient = is_safe(request.query)
+    food_query, is_ingredient = await _classify(request)
+    base_url = str(http_request.base_url)
 
-    if not safe:
-        raise HTTPException(status_code=400, detail="Please enter a valid food query.")
+    key = _response_key(request, food_query, is_ingredient)
+    with span("response_cache") as current:
+        cached = await search_responses.get_async(key) if request.image_mode != "base64" else None
+        current.set(cache="miss" if cached is None else "stale" if cached[2] else "hit")
+    if cached is not None:
+        value, etag, stale = cached
+        if stale:
+            async def refresh():
+                set_priority(BACKGROUND)
+                await _search_and_cache(request, key, food_query, is_ingredient, base_url, previous=value)
 
-    loop = asyncio.get_running_loop()
-    with ThreadPoolExecutor() as pool:
-        # Start image generation in parallel
-        image_task = loop.run_in_executor(pool, get_image_sync, food_query)
+            search_responses.revalidate(key, refresh)
+        return _json_response(value, etag, if_none_match)
 
-        if not is_ingredient:
-            # Analyze dish (assume this is sync, so run in thread)
-            dish_task = loop.run_in_executor(pool, analyze_dish, food_query, request.user_profile)
-            dish_analysis, image_base64 = await asyncio.gather(dish_task, image_task)
-            if not image_base64:
-                raise HTTPException(status_code=500, detail="Image generation failed.")
-            if not dish_analysis:
-                raise HTTPException(status_code=500, detail="Failed to analyze dish.")
-
-            return SearchResult(
-                status="success",
-                imageBase64=image_base64,
-                name=food_query,
-                overall_rating=dish_analysis.get("overall_rating", 0),
-                text=dish_analysis.get("text", []),
-                ingredients_rating=list(dish_analysis.get("ingredients", [])),
-                timestamp=datetime.now(),
-                is_ingredient=is_ingredient,
-            )
+    value, etag = await _search_and_cache(request, key, food_query, is_ingredient, base_url)
+    return _json_response(value, etag, if_none_match)
+
+
+def _encode_event(event: str, data: dict, stream_format: str) -> str:
+    if stream_format == "sse":
+        return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+    return json.dumps({"event": event, "data": data}, default=str) + "\n"
+
+
+@router.post("/search/stream")
+async def search_items_stream(request: SearchStreamRequest, http_request: Request) -> StreamingResponse:
+    """
+    Search for items and stream each part of the result as soon as it is ready.
+
+    Events are emitted in completion order: "safety", then for dishes "ingredients" and
+    "ratings", then "overall", "hints" and "image" in whichever order they finish, and
+    finally "done" with the complete SearchResult (or "error").
+    """
+    food_query, is_ingredient = await _classify(request)
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def on_step(step: str, result, elapsed_ms: float):
+        if step == "ingredients":
+            data = {
+                "ingredients": [
+                    {"ingredient_name": name, "g_100": value.get("g_100") if isinstance(value, dict) else None}
+                    for name, value in result.items()
+                ]
+            }
+        elif step == "ratings":
+            data = {
+                "ingredients_rating": [
+                    {"ingredient_name": name, "rating": value.get("rating", 0)}
+                    for name, value in result.items()
+                ]
+            }
+        elif step == "overall":
+            data = {"overall_rating": result}
+        elif step == "hints":
+            data = {"text": result}
         else:
-            # Analyze ingredient (assume this is sync, so run in thread)
-            ingredient_task = loop.run_in_executor(pool, analyze_ingredient, food_query, request.user_profile)
-            ingredient_analysis, image_base64 = await asyncio.gather(ingredient_task, image_task)
-            if not image_base64:
-                raise HTTPException(status_code=500, detail="Image generation failed.")
-            if not ingredient_analysis:
-                raise HTTPException(status_code=500, detail="Failed to analyze ingredient.")
-
-            return SearchResult(
-                status="success",
-                imageBase64=image_base64,
-                name=food_query,
-                overall_rating=ingredient_analysis.get("overall_rating", 0),
-                text=ingredient_analysis.get("text", []),
-                ingredients_rating=[],
-                timestamp=datetime.now(),
-                is_ingredient=is_ingredient,
+            return
+        await queue.put((step, data))
+
+    async def analyze() -> dict:
+        if not is_ingredient:
+            return await analyze_dish_async(
+                food_query, request.user_profile, on_complete=on_step, mode=request.analysis_mode
             )
+        result = await analyze_ingredient_async(food_query, request.user_profile)
+        await on_step("overall", result.get("overall_rating", 0), 0)
+        await on_step("hints", result.get("text", []), 0)
+        return result
+
+    async def image() -> str:
+        image = await _get_image(request, food_query, str(http_request.base_url))
+        if image:
+            await queue.put(("image", _image_fields(request, image)))
+        return image
+
+    async def run():
+        try:
+            analysis, image_result = await asyncio.gather(analyze(), image())
+            if not analysis:
+                await queue.put(("error", {"detail": "Failed to analyze food."}))
+            else:
+                result = SearchResult(
+                    status="success",
+                    **_image_fields(request, image_result),
+                    name=food_query,
+                    overall_rating=analysis.get("overall_rating", 0),
+                    text=analysis.get("text", []),
+                    ingredients_rating=list(analysis.get("ingredients", [])),
+                    timestamp=datetime.now(),
+                    is_ingredient=is_ingredient,
+                )
+                await queue.put(("done", result.model_dump(mode="json")))
+        except ModelUnavailable:
+            await queue.put(("error", {"detail": MODEL_UNAVAILABLE_DETAIL}))
+        except Exception:
+            logging.exception(f"Streaming analysis of {food_query} failed")
+            await queue.put(("error", {"detail": "Failed to analyze food."}))
+        finally:
+            await queue.put(None)
+
+    async def events():
+        runner = asyncio.create_task(run())
+        try:
+            yield _encode_event("safety", {"name": food_query, "is_ingredient": is_ingredient}, request.stream_format)
+            while (item := await queue.get()) is not None:
+                yield _encode_event(*item, request.stream_format)
+        finally:
+            # Stop the remaining work if the client went away
+            runner.cancel()
+
+    media_type = "text/event-stream" if request.stream_format == "sse" else "application/x-ndjson"
+    return StreamingResponse(
+        events(),
+        media_type=media_type,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.post("/search/batch", response_model=BatchSearchResponse)
+async def search_items_batch(request: BatchSearchRequest, http_request: Request):
+    """
+    Search many queries for one user profile, e.g. a whole menu or shopping list.
+
+    Queries are de-duplicated, classified together and analyzed with shared model calls
+    (see ai.batch). Results are returned per query in request order. With stream_format
+    set, an "item" event is emitted per query as soon as it is ready, followed by "done".
+    Model calls of a batch yield to interactive searches (see ai.scheduler).
+    """
+    set_priority(BATCH)
+    # De-duplicate queries that only differ in case, whitespace or plural
+    unique = list(dict.fromkeys(normalize_query(query) for query in request.queries))
+    representatives = {normalize_query(query): query for query in reversed(request.queries)}
+    verdicts = dict(zip(unique, await is_safe_batch_async([representatives[key] for key in unique])))
+
+    foods = {}
+    for safe, food_query, is_ingredient in verdicts.values():
+        if safe and food_query:
+            foods.setdefault(food_query, is_ingredient)
+    queries_by_food = {}
+    for query in request.queries:
+        safe, food_query, _ = verdicts[normalize_query(query)]
+        if safe and food_query:
+            queries_by_food.setdefault(food_query, {})[query] = None
+            record_query(query, request.user_profile)
+
+    images = {}
+    if request.image_mode != "none":
+        base_url = str(http_request.base_url)
+        images = {food: asyncio.create_task(_get_image(request, food, base_url)) for food in foods}
+
+    items = {
+        query: BatchSearchItem(query=query, status="invalid", detail="Please enter a valid food query.")
+        for query in request.queries
+        if not verdicts[normalize_query(query)][0] or not verdicts[normalize_query(query)][1]
+    }
+    queue: asyncio.Queue = asyncio.Queue()
+    for item in items.values():
+        queue.put_nowait(item)
+
+    async def on_complete(food: str, analysis):
+        image = await images[food] if food in images else None
+        detail = None if analysis else "Failed to analyze food."
+        for query in queries_by_food[food]:
+            if detail:
+                item = BatchSearchItem(query=query, status="error", detail=detail)
+            else:
+                item = BatchSearchItem(
+                    query=query,
+                    status="success",
+                    result=SearchResult(
+                        status="success",
+                        **(_image_fields(request, image) if image else {}),
+                        name=food,
+                        overall_rating=analysis.get("overall_rating", 0),
+                        text=analysis.get("text", []),
+                        ingredients_rating=list(analysis.get("ingredients", [])),
+                        timestamp=datetime.now(),
+                        is_ingredient=foods[food],
+                    ),
+                )
+            items[query] = item
+            await queue.put(item)
+
+    async def run():
+        try:
+            await analyze_batch_async(foods, request.user_profile, request.include_hints, on_complete=on_complete)
+        finally:
+            await queue.put(None)
+
+    if request.stream_format is None:
+        try:
+            await run()
+        finally:
+            # Image generation outlives a failed or cancelled batch otherwise
+            for task in images.values():
+                task.cancel()
+        return BatchSearchResponse(status="success", results=[
+            items.get(query) or BatchSearchItem(query=query, status="error", detail="Failed to analyze food.")
+            for query in request.queries
+        ])
+
+    async def events():
+        runner = asyncio.create_task(run())
+        try:
+            while (item := await queue.get()) is not None:
+                yield _encode_event("item", item.model_dump(mode="json"), request.stream_format)
+            await runner
+            yield _encode_event("done", {"count": len(request.queries)}, request.stream_format)
+        except ModelUnavailable:
+            yield _encode_event("error", {"detail": MODEL_UNAVAILABLE_DETAIL}, request.stream_format)
+        except Exception:
+            logging.exception("Streaming batch analysis failed")
+            yield _encode_event("error", {"detail": "Failed to analyze food."}, request.stream_format)
+        finally:
+            runner.cancel()
+            for task in images.values():
+                task.cancel()
+
+    media_type = "text/event-stream" if request.stream_format == "sse" else "application/x-ndjson"
+    return StreamingResponse(
+        events(),
+        media_type=media_type,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -5,13 +5,15 @@ from typing import List, Optional
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
 
-from ai.tips_generator import get_daily_tips
+from ai.tips_generator import get_tip_async
 
 router = APIRouter()
 
 
 class ProfileRequest(BaseModel):
     user_profile: dict
+    # Tips rotate per user and day; without an id, users with the same profile share a tip
+    user_id: Optional[str] = None
 
 
 class TipResponse(BaseModel):
@@ -20,6 +22,6 @@ class TipResponse(BaseModel):
 @router.post("/tip", response_model=TipResponse)
 async def get_tip(request: ProfileRequest) -> TipResponse:
     """
-    Get a daily tip for the user.
+    Get a daily tip for the user from the pool of their intolerance set.
     """
-    return TipResponse(tip=get_daily_tips(request.user_profile))
\ No newline at end of file
+    return TipResponse(tip=await get_tip_async(request.user_profile, request.user_id))
\ No newline at end of file
@@ -0,0 +1,43 @@
+import time
+
+from starlette.datastructures import MutableHeaders
+
+from ai.tracing import metrics, trace_request
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware collecting the spans of each request (see ai.tracing).
+
+    Adds a Server-Timing header with the duration of every stage finished before the
+    response starts (for streamed responses that is only the stages before the first
+    event) and records the request duration per route and status.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        with trace_request() as trace:
+
+            async def send_with_timing(message):
+                nonlocal status
+                if message["type"] == "http.response.start":
+                    status = message["status"]
+                    MutableHeaders(scope=message).append("Server-Timing", trace.server_timing())
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_with_timing)
+            finally:
+                route = scope.get("route")
+                metrics.observe(
+                    "eatsafe_http_request_duration_seconds", "Duration of HTTP requests until the last byte.",
+                    time.perf_counter() - trace.start,
+                    method=scope["method"], path=getattr(route, "path", "unmatched"), status=str(status),
+                )
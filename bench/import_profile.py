@@ -0,0 +1,74 @@
+"""
+Startup profile: how long importing the app takes, broken down per module.
+
+Imports the app in a fresh interpreter with `python -X importtime` and reports the total
+and the modules with the largest cumulative import time, plus the self time per top-level
+package:
+
+    python -m bench.import_profile --top 20
+
+Modules loaded with ai.startup.lazy_import are not imported at startup and do not appear;
+add --warm-up to also run the warm-up and see what it loads.
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+
+LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def profile(module: str, warm_up: bool) -> list:
+    """
+    Return (module, self µs, cumulative µs, depth) for every module imported by importing module.
+    """
+    code = f"import {module}"
+    if warm_up:
+        code += "; from ai.startup import warm_up; warm_up()"
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [os.getcwd(), os.environ.get("PYTHONPATH")]))}
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, env=env)
+    if result.returncode != 0:
+        raise SystemExit(result.stderr)
+    rows = []
+    for line in result.stderr.splitlines():
+        match = LINE.match(line)
+        if match:
+            rows.append((match.group(4), int(match.group(1)), int(match.group(2)), len(match.group(3)) // 2))
+    return rows
+
+
+def main(args):
+    rows = profile(args.module, args.warm_up)
+    total = sum(self_us for _, self_us, _, _ in rows)
+    packages = {}
+    for name, self_us, _, _ in rows:
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0) + self_us
+
+    print(f"Interpreter startup and importing {args.module}: {total / 1000:.0f}ms, {len(rows)} modules\n")
+    print(f"{'cumulative':>12} {'self':>9}  module")
+    for name, self_us, cumulative_us, depth in sorted(rows, key=lambda r: -r[2])[:args.top]:
+        print(f"{cumulative_us / 1000:10.1f}ms {self_us / 1000:7.1f}ms  {'  ' * depth}{name}")
+    print(f"\n{'self':>12}  package")
+    for package, self_us in sorted(packages.items(), key=lambda p: -p[1])[:args.top]:
+        print(f"{self_us / 1000:10.1f}ms  {package}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"module": args.module, "total_ms": total / 1000, "packages_ms": {
+                package: self_us / 1000 for package, self_us in packages.items()
+            }, "modules": [
+                {"module": name, "self_ms": self_us / 1000, "cumulative_ms": cumulative_us / 1000}
+                for name, self_us, cumulative_us, _ in rows
+            ]}, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default="app.main", help="Module to import")
+    parser.add_argument("--top", type=int, default=15, help="Modules and packages to list")
+    parser.add_argument("--warm-up", action="store_true", help="Also run ai.startup.warm_up()")
+    parser.add_argument("--json", help="Also write the profile to this JSON file")
+    main(parser.parse_args())
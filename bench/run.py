@@ -0,0 +1,141 @@
+"""
+Load benchmark for the API.
+
+By default the app is driven in-process with the fake model backend and fake blob store,
+so no API key or network access is needed:
+
+    python -m bench.run --concurrency 1 8 32 --requests 200
+
+Use --url to benchmark a running server instead (it then uses whatever backend that
+server is configured with).
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+
+import httpx
+
+DISHES = ["pizza", "burger", "lasagne", "sushi", "pad thai", "risotto", "ramen", "tacos"]
+INGREDIENTS = ["apple", "banana", "tomato", "milk", "egg", "garlic", "honey", "rice"]
+PROFILES = [
+    {"intolerances": ["lactose"], "notes": ""},
+    {"intolerances": ["fructose", "lactose"], "notes": ""},
+    {"intolerances": ["histamine"], "notes": "Mild symptoms only."},
+]
+
+
+def _payload(scenario: str, i: int, unique: bool) -> tuple:
+    profile = PROFILES[i % len(PROFILES)]
+    if scenario == "tip":
+        return "/tip", {"user_profile": profile}
+    foods = DISHES if scenario == "dish" else INGREDIENTS
+    query = foods[i % len(foods)]
+    if unique:
+        # A distinct query per request defeats every cache, measuring the cold path
+        query = f"{query} {i}"
+    return "/search", {"query": query, "user_profile": profile}
+
+
+def _percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(q / 100 * len(values)) - 1))
+    return values[index]
+
+
+async def run_level(client: httpx.AsyncClient, scenario: str, concurrency: int, requests: int, unique: bool,
+                    offset: int) -> dict:
+    latencies, errors = [], 0
+    counter = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            path, payload = _payload(scenario, offset + i, unique)
+            start = time.perf_counter()
+            try:
+                response = await client.post(path, json=payload)
+                if response.status_code != 200:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": errors,
+        "p50_ms": _percentile(latencies, 50),
+        "p95_ms": _percentile(latencies, 95),
+        "p99_ms": _percentile(latencies, 99),
+        "mean_ms": statistics.fmean(latencies) if latencies else 0.0,
+        "req_per_s": requests / elapsed if elapsed else 0.0,
+    }
+
+
+async def main(args):
+    if args.url:
+        transport = None
+        base_url = args.url
+    else:
+        from app.main import app
+
+        transport = httpx.ASGITransport(app=app)
+        base_url = "http://bench"
+
+    results = []
+    offset = 0
+    async with httpx.AsyncClient(transport=transport, base_url=base_url, timeout=args.timeout) as client:
+        for scenario in args.scenarios:
+            for concurrency in args.concurrency:
+                result = await run_level(client, scenario, concurrency, args.requests, args.unique, offset)
+                offset += args.requests
+                results.append(result)
+                print(
+                    f"{scenario:<11} c={concurrency:<4} n={result['requests']:<5} err={result['errors']:<4} "
+                    f"p50={result['p50_ms']:8.1f}ms p95={result['p95_ms']:8.1f}ms p99={result['p99_ms']:8.1f}ms "
+                    f"{result['req_per_s']:8.1f} req/s",
+                    flush=True,
+                )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", default=["dish", "ingredient", "tip"],
+                        choices=["dish", "ingredient", "tip"])
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=100, help="Requests per scenario and concurrency level")
+    parser.add_argument("--unique", action="store_true", help="Use a distinct query per request (cold caches)")
+    parser.add_argument("--latency-scale", type=float, default=1.0,
+                        help="Multiplier for the fake backend's model latencies (in-process runs only)")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Relative jitter of fake model latencies")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--url", help="Benchmark a running server instead of the in-process app")
+    parser.add_argument("--json", help="Also write the results to this JSON file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not args.url:
+        # Must be configured before the app and the ai package are imported
+        os.environ.setdefault("AI_BACKEND", "fake")
+        os.environ.setdefault("BLOB_BACKEND", "fake")
+        os.environ.setdefault("LOCAL_CACHE_DIR", tempfile.mkdtemp(prefix="bench-cache-"))
+        os.environ["FAKE_LATENCY_SCALE"] = str(args.latency_scale)
+        os.environ["FAKE_JITTER"] = str(args.jitter)
+    asyncio.run(main(args))